@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+bench_n8n_pipe.py
+
+Benchmark Pipe.pipe from n8n_pipe.py against an in-process stub n8n webhook.
+
+Reports requests/sec, latency and time-to-first-token percentiles, event-loop
+blocking and memory per in-flight request as JSON, so results from two
+versions can be compared with --compare. Runs fully offline.
+
+    python -m benchmarks.bench_n8n_pipe --concurrency 50 --requests 1000
+    python -m benchmarks.bench_n8n_pipe --stream --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_servers import StubN8nConfig, StubN8nServer  # noqa: E402
+
+
+@dataclass
+class BenchmarkConfig:
+    requests: int = 500
+    concurrency: int = 20
+    warmup: int = 20
+    lag_interval: float = 0.005
+
+
+def percentile(values: list, q: float):
+    """Nearest-rank percentile of ``values`` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize_ms(values: list) -> dict:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3) if values else None,
+        **{
+            name: (round(value * 1000, 3) if value is not None else None)
+            for name, value in (
+                ("p50", percentile(values, 0.50)),
+                ("p95", percentile(values, 0.95)),
+                ("p99", percentile(values, 0.99)),
+                ("max", max(values) if values else None),
+            )
+        },
+    }
+
+
+class LoopLagMonitor:
+    """Measure how long the event loop is blocked.
+
+    A ticker sleeps ``interval`` seconds at a time; any extra delay before it
+    wakes up is time the loop spent unable to run ready callbacks.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags: list[float] = []
+        self._task = None
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._tick())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def summary(self) -> dict:
+        return {
+            "blocked_total_ms": round(sum(self.lags) * 1000, 3),
+            "max_ms": round(max(self.lags, default=0.0) * 1000, 3),
+            "p99_ms": round((percentile(self.lags, 0.99) or 0.0) * 1000, 3),
+        }
+
+
+def pipe_version() -> str:
+    """Version from the n8n_pipe.py frontmatter, to tell results apart."""
+    import n8n_pipe
+
+    match = re.search(r"^version:\s*(\S+)", n8n_pipe.__doc__ or "", re.MULTILINE)
+    return match.group(1) if match else "unknown"
+
+
+def make_pipe(url: str, stream: bool):
+    from n8n_pipe import Pipe
+
+    pipe = Pipe()
+    pipe.valves.n8n_url = url
+    pipe.valves.n8n_bearer_token = "bench"
+    pipe.valves.stream_response = stream
+    pipe.valves.enable_status_indicator = False
+    pipe.valves.cache_enabled = False
+    pipe.valves.coalesce_requests = False
+    pipe.valves.max_retries = 0
+    pipe.valves.circuit_failure_threshold = 0
+    return pipe
+
+
+async def call_pipe(pipe, index: int, stream: bool) -> tuple[float, float, bool]:
+    """Run one chat turn; returns (latency, time-to-first-token, ok)."""
+    body = {"messages": [{"role": "user", "content": f"benchmark question {index}"}]}
+    started = time.perf_counter()
+    first_token = None
+    result = await pipe.pipe(body)
+    if stream and not isinstance(result, dict):
+        ok = True
+        async for token in result:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            ok = not token.startswith("Error:")
+    else:
+        ok = not isinstance(result, dict)
+    latency = time.perf_counter() - started
+    return latency, first_token if first_token is not None else latency, ok
+
+
+async def drive(pipe, count: int, concurrency: int, stream: bool, offset: int = 0):
+    results = []
+    next_index = iter(range(offset, offset + count))
+
+    async def worker():
+        for index in next_index:
+            results.append(await call_pipe(pipe, index, stream))
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return results
+
+
+async def run_benchmark(config: BenchmarkConfig, stub: StubN8nConfig) -> dict:
+    async with StubN8nServer(stub) as server:
+        pipe = make_pipe(server.url, stub.stream)
+        try:
+            await drive(pipe, config.warmup, config.concurrency, stub.stream, offset=-config.warmup)
+
+            monitor = LoopLagMonitor(config.lag_interval)
+            monitor.start()
+            started = time.perf_counter()
+            results = await drive(pipe, config.requests, config.concurrency, stub.stream)
+            duration = time.perf_counter() - started
+            await monitor.stop()
+
+            # tracemalloc slows allocation-heavy code down considerably, so
+            # memory is sampled in a separate, shorter pass.
+            tracemalloc.start()
+            baseline, _ = tracemalloc.get_traced_memory()
+            await drive(pipe, config.concurrency * 2, config.concurrency, stub.stream)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            await pipe.close()
+
+    latencies = [latency for latency, _, ok in results if ok]
+    first_tokens = [ttft for _, ttft, ok in results if ok]
+    errors = sum(1 for *_, ok in results if not ok)
+    in_flight = max(1, min(config.concurrency, config.requests))
+    return {
+        "benchmark": "n8n_pipe",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "pipe_version": pipe_version(),
+        "python": platform.python_version(),
+        "config": asdict(config),
+        "stub": asdict(stub),
+        "requests": len(results),
+        "errors": errors,
+        "duration_s": round(duration, 4),
+        "requests_per_s": round(len(results) / duration, 2) if duration else None,
+        "latency_ms": summarize_ms(latencies),
+        "ttft_ms": summarize_ms(first_tokens),
+        "event_loop": monitor.summary(),
+        "memory": {
+            "peak_bytes": peak - baseline,
+            "per_inflight_request_bytes": (peak - baseline) // in_flight,
+        },
+    }
+
+
+def compare_results(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return regressions beyond ``tolerance`` (a fraction, e.g. 0.1 = 10%)."""
+    regressions = []
+
+    def check(name: str, now, before, higher_is_better: bool):
+        if now is None or not before:
+            return
+        change = (now - before) / before
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {before} -> {now} ({change:+.1%})")
+
+    check("requests_per_s", current["requests_per_s"], baseline.get("requests_per_s"), True)
+    for section in ("latency_ms", "ttft_ms"):
+        for key in ("p50", "p95", "p99"):
+            check(
+                f"{section}.{key}",
+                current[section][key],
+                baseline.get(section, {}).get(key),
+                False,
+            )
+    return regressions
+
+
+def format_report(result: dict) -> str:
+    latency, ttft = result["latency_ms"], result["ttft_ms"]
+    return "\n".join(
+        [
+            f"requests: {result['requests']} ({result['errors']} errors) "
+            f"in {result['duration_s']}s -> {result['requests_per_s']} req/s",
+            f"latency ms: p50={latency['p50']} p95={latency['p95']} "
+            f"p99={latency['p99']} max={latency['max']}",
+            f"ttft ms:    p50={ttft['p50']} p95={ttft['p95']} p99={ttft['p99']}",
+            f"event loop: blocked={result['event_loop']['blocked_total_ms']}ms "
+            f"max lag={result['event_loop']['max_ms']}ms",
+            f"memory:     {result['memory']['per_inflight_request_bytes']} bytes per in-flight request",
+        ]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the n8n pipe against a stub webhook.")
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests (default: 500)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent chats (default: 20)")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured warm-up requests (default: 20)")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Stub workflow latency (default: 50)")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform +/- latency jitter (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 replies (default: 0)")
+    parser.add_argument("--stream", action="store_true", help="Stream NDJSON tokens and enable stream_response")
+    parser.add_argument("--tokens", type=int, default=20, help="Tokens per reply (default: 20)")
+    parser.add_argument("--token-interval-ms", type=float, default=0.0, help="Delay between streamed tokens")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for jitter/error injection")
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    parser.add_argument("--compare", help="Baseline JSON result to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed regression as a fraction before --compare fails (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    config = BenchmarkConfig(requests=args.requests, concurrency=args.concurrency, warmup=args.warmup)
+    stub = StubN8nConfig(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        stream=args.stream,
+        tokens=args.tokens,
+        token_interval=args.token_interval_ms / 1000,
+        seed=args.seed,
+    )
+    result = asyncio.run(run_benchmark(config, stub))
+
+    print(format_report(result), file=sys.stderr)
+    encoded = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(encoded + "\n")
+    else:
+        print(encoded)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare_results(result, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+loadtest_stack.py
+
+End-to-end load test of the chat path Pipe.pipe -> n8n webhook -> Ollama,
+with in-process stand-ins for n8n and the Ollama chat API.
+
+Multi-turn chat transcripts are replayed through Pipe.pipe at rising
+concurrency. Each level reports throughput, time-to-first-token and tail
+latency, and the run finds the concurrency where throughput stops scaling,
+so replica counts for n8n and Ollama can be sized from it. Runs fully
+offline and writes JSON plus a text report.
+
+    python -m benchmarks.loadtest_stack --levels 1,2,4,8,16,32
+    python -m benchmarks.loadtest_stack --ollama-parallel 4 --ollama-replicas 2 --n8n-replicas 2 \\
+        --target-users 200 --output loadtest.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_n8n_pipe import make_pipe, pipe_version, summarize_ms  # noqa: E402
+from benchmarks.stub_servers import (  # noqa: E402
+    StubN8nAgentServer,
+    StubN8nConfig,
+    StubOllamaConfig,
+    StubOllamaServer,
+)
+
+# A handful of conversations shaped like the RAG agent's real traffic:
+# a question, follow-ups that lean on the earlier answers, and a wrap-up.
+DEFAULT_TRANSCRIPTS = [
+    [
+        "What does our onboarding guide say about setting up the VPN?",
+        "Which client version does it recommend for macOS?",
+        "And what should I do if the connection drops every few minutes?",
+        "Summarize the steps in a short checklist.",
+    ],
+    [
+        "Find the Q3 sales numbers for the EMEA region.",
+        "How do they compare with Q2?",
+        "Which product line grew the most?",
+    ],
+    [
+        "Draft a polite reply declining the meeting invitation from the vendor.",
+        "Make it a bit shorter and mention we can talk next month instead.",
+    ],
+    [
+        "What tables are in the analytics Postgres database?",
+        "Write a SQL query for the ten most active users last week.",
+        "Add the number of sessions per user to that query.",
+        "Explain what the JOIN in that query does.",
+        "Could an index speed it up? Which column?",
+    ],
+    [
+        "Search the docs for how to rotate the n8n encryption key.",
+        "Is any downtime needed for that?",
+        "What happens to existing credentials afterwards?",
+    ],
+]
+
+
+@dataclass
+class LoadTestConfig:
+    levels: list = field(default_factory=lambda: [1, 2, 4, 8, 16, 32])
+    conversations_per_user: int = 2
+    think_time: float = 0.0
+    stream: bool = True
+    saturation_gain: float = 0.10
+    n8n_replicas: int = 1
+    ollama_replicas: int = 1
+
+
+def load_transcripts(path: str) -> list:
+    """Read conversations from a JSON file.
+
+    Accepts a list of conversations, each a list of user messages (strings)
+    or of ``{"role": ..., "content": ...}`` messages, of which the user
+    turns are replayed.
+    """
+    with open(path) as handle:
+        data = json.load(handle)
+    transcripts = []
+    for conversation in data:
+        turns = [
+            turn if isinstance(turn, str) else turn.get("content", "")
+            for turn in conversation
+            if isinstance(turn, str) or turn.get("role", "user") == "user"
+        ]
+        if turns:
+            transcripts.append(turns)
+    if not transcripts:
+        raise ValueError(f"{path} contains no user turns")
+    return transcripts
+
+
+def chat_emitter(chat_id: str):
+    """A no-op event emitter carrying ``chat_id`` the way Open WebUI does."""
+    request_info = {"chat_id": chat_id, "message_id": "loadtest"}
+
+    async def emitter(event):
+        return request_info
+
+    return emitter
+
+
+async def chat_turn(pipe, messages: list, emitter, stream: bool) -> tuple:
+    """Send one user turn; returns (latency, ttft, ok, reply, tokens)."""
+    started = time.perf_counter()
+    first_token = None
+    tokens = 0
+    result = await pipe.pipe({"messages": messages}, __event_emitter__=emitter)
+    if stream and not isinstance(result, dict):
+        parts = []
+        async for token in result:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            tokens += 1
+            parts.append(token)
+        reply = "".join(parts)
+        ok = not reply.startswith("Error:")
+    else:
+        ok = isinstance(result, str)
+        reply = result if ok else ""
+        tokens = len(reply.split())
+    latency = time.perf_counter() - started
+    return latency, first_token if first_token is not None else latency, ok, reply, tokens
+
+
+async def run_level(pipe, concurrency: int, transcripts: list, config: LoadTestConfig, level_index: int = 0):
+    """Run ``concurrency`` virtual users, each replaying whole conversations."""
+    turns = []
+
+    async def user(user_index: int):
+        for round_index in range(config.conversations_per_user):
+            conversation = transcripts[(user_index + round_index) % len(transcripts)]
+            emitter = chat_emitter(f"level{level_index}-user{user_index}-chat{round_index}")
+            messages = []
+            for question in conversation:
+                messages.append({"role": "user", "content": question})
+                latency, ttft, ok, reply, tokens = await chat_turn(pipe, messages, emitter, config.stream)
+                if ok:
+                    messages.append({"role": "assistant", "content": reply})
+                turns.append((latency, ttft, ok, tokens))
+                if config.think_time:
+                    await asyncio.sleep(config.think_time)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(index) for index in range(concurrency)))
+    duration = time.perf_counter() - started
+
+    ok_turns = [turn for turn in turns if turn[2]]
+    return {
+        "concurrency": concurrency,
+        "turns": len(turns),
+        "errors": len(turns) - len(ok_turns),
+        "duration_s": round(duration, 4),
+        "turns_per_s": round(len(ok_turns) / duration, 3) if duration else None,
+        "tokens_per_s": round(sum(turn[3] for turn in ok_turns) / duration, 1) if duration else None,
+        "ttft_ms": summarize_ms([turn[1] for turn in ok_turns]),
+        "latency_ms": summarize_ms([turn[0] for turn in ok_turns]),
+    }
+
+
+def find_saturation(levels: list, min_gain: float = 0.10):
+    """The last concurrency level that still raised throughput by ``min_gain``.
+
+    Returns None when every level kept scaling, i.e. the test never reached
+    the point where adding chats stops adding throughput.
+    """
+    for previous, current in zip(levels, levels[1:]):
+        before, after = previous["turns_per_s"] or 0, current["turns_per_s"] or 0
+        if after < before * (1 + min_gain):
+            return {
+                "concurrency": previous["concurrency"],
+                "turns_per_s": previous["turns_per_s"],
+                "tokens_per_s": previous["tokens_per_s"],
+                "latency_p95_ms": previous["latency_ms"]["p95"],
+                "ttft_p95_ms": previous["ttft_ms"]["p95"],
+            }
+    return None
+
+
+def replica_plan(saturation, config: LoadTestConfig, target_users):
+    """Replicas needed for ``target_users`` concurrent chats, scaling the tested topology."""
+    if not saturation or not target_users:
+        return None
+    units = math.ceil(target_users / saturation["concurrency"])
+    return {
+        "target_users": target_users,
+        "n8n_replicas": units * config.n8n_replicas,
+        "ollama_replicas": units * config.ollama_replicas,
+    }
+
+
+@contextlib.asynccontextmanager
+async def stack(ollama: StubOllamaConfig, n8n: StubN8nConfig, config: LoadTestConfig):
+    """Start the Ollama and n8n stand-ins; yields (n8n urls, ollama servers)."""
+    async with contextlib.AsyncExitStack() as servers:
+        ollamas = [
+            await servers.enter_async_context(StubOllamaServer(ollama))
+            for _ in range(max(1, config.ollama_replicas))
+        ]
+        n8ns = [
+            await servers.enter_async_context(
+                StubN8nAgentServer(n8n, ollama_urls=[server.url for server in ollamas])
+            )
+            for _ in range(max(1, config.n8n_replicas))
+        ]
+        yield [server.url for server in n8ns], ollamas
+
+
+async def run_load_test(config: LoadTestConfig, ollama: StubOllamaConfig, n8n: StubN8nConfig,
+                        transcripts=None, target_users=None) -> dict:
+    transcripts = transcripts or DEFAULT_TRANSCRIPTS
+    n8n.stream = config.stream
+    levels = []
+    async with stack(ollama, n8n, config) as (n8n_urls, ollamas):
+        pipe = make_pipe(",".join(n8n_urls), config.stream)
+        pipe.valves.load_balancing = "session_affinity"
+        try:
+            for index, concurrency in enumerate(config.levels):
+                for server in ollamas:
+                    server.reset_stats()
+                level = await run_level(pipe, concurrency, transcripts, config, index)
+                level["ollama_max_queue"] = max(server.max_waiting for server in ollamas)
+                levels.append(level)
+                print(f"concurrency {concurrency:>4}: {level['turns_per_s']} turns/s, "
+                      f"ttft p95 {level['ttft_ms']['p95']} ms, latency p95 {level['latency_ms']['p95']} ms",
+                      file=sys.stderr)
+        finally:
+            await pipe.close()
+
+    saturation = find_saturation(levels, config.saturation_gain)
+    return {
+        "benchmark": "stack_loadtest",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "pipe_version": pipe_version(),
+        "python": platform.python_version(),
+        "config": asdict(config),
+        "ollama": asdict(ollama),
+        "n8n": asdict(n8n),
+        "transcripts": len(transcripts),
+        "levels": levels,
+        "saturation": saturation,
+        "replica_plan": replica_plan(saturation, config, target_users),
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"{'CHATS':>5}  {'TURNS/S':>8}  {'TOK/S':>8}  {'TTFT p50':>9}  {'TTFT p95':>9}  "
+        f"{'LAT p50':>9}  {'LAT p95':>9}  {'LAT p99':>9}  {'QUEUE':>5}  {'ERR':>4}",
+    ]
+    for level in result["levels"]:
+        ttft, latency = level["ttft_ms"], level["latency_ms"]
+        lines.append(
+            f"{level['concurrency']:>5}  {level['turns_per_s']:>8}  {level['tokens_per_s']:>8}  "
+            f"{ttft['p50']!s:>9}  {ttft['p95']!s:>9}  {latency['p50']!s:>9}  {latency['p95']!s:>9}  "
+            f"{latency['p99']!s:>9}  {level['ollama_max_queue']:>5}  {level['errors']:>4}"
+        )
+    saturation = result["saturation"]
+    config = result["config"]
+    topology = (f"{config['n8n_replicas']} n8n / {config['ollama_replicas']} Ollama replica(s), "
+                f"OLLAMA_NUM_PARALLEL={result['ollama']['num_parallel']}")
+    if saturation:
+        lines.append(
+            f"Saturation: {topology} stops scaling beyond {saturation['concurrency']} concurrent chats "
+            f"({saturation['turns_per_s']} turns/s, p95 latency {saturation['latency_p95_ms']} ms)."
+        )
+    else:
+        lines.append(f"Saturation: {topology} kept scaling up to {config['levels'][-1]} chats; "
+                     "add higher --levels to find the limit.")
+    plan = result["replica_plan"]
+    if plan:
+        lines.append(f"For {plan['target_users']} concurrent chats plan {plan['n8n_replicas']} n8n and "
+                     f"{plan['ollama_replicas']} Ollama replica(s).")
+    return "\n".join(lines)
+
+
+def parse_levels(value: str) -> list:
+    levels = sorted({int(part) for part in value.split(",") if part.strip()})
+    if not levels or levels[0] < 1:
+        raise argparse.ArgumentTypeError("levels must be positive integers, e.g. 1,2,4,8")
+    return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the Pipe -> n8n -> Ollama chat path with stand-ins.")
+    parser.add_argument("--levels", type=parse_levels, default=[1, 2, 4, 8, 16, 32],
+                        help="Concurrent chats per step (default: 1,2,4,8,16,32)")
+    parser.add_argument("--conversations-per-user", type=int, default=2,
+                        help="Conversations each virtual user replays per level (default: 2)")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Pause between a user's turns (default: 0)")
+    parser.add_argument("--transcripts", help="JSON file of conversations to replay instead of the built-in ones")
+    parser.add_argument("--no-stream", action="store_true", help="Use n8n's JSON response instead of streaming")
+    parser.add_argument("--n8n-replicas", type=int, default=1, help="n8n stand-ins behind the pipe (default: 1)")
+    parser.add_argument("--n8n-overhead-ms", type=float, default=30.0,
+                        help="Workflow overhead before the model call (default: 30)")
+    parser.add_argument("--ollama-replicas", type=int, default=1, help="Ollama stand-ins (default: 1)")
+    parser.add_argument("--ollama-parallel", type=int, default=4,
+                        help="Requests each Ollama decodes at once, like OLLAMA_NUM_PARALLEL (default: 4)")
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="Base time to first token (default: 200)")
+    parser.add_argument("--prompt-rate", type=float, default=2000.0,
+                        help="Prompt evaluation speed in tokens/s (default: 2000)")
+    parser.add_argument("--token-rate", type=float, default=30.0,
+                        help="Generation speed per request in tokens/s (default: 30)")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens per answer (default: 64)")
+    parser.add_argument("--batch-slowdown", type=float, default=0.15,
+                        help="Per-request slowdown for each other request decoding concurrently (default: 0.15)")
+    parser.add_argument("--saturation-gain", type=float, default=0.10,
+                        help="Minimum throughput gain per level before it counts as saturated (default: 0.10)")
+    parser.add_argument("--target-users", type=int, help="Concurrent chats to size replicas for")
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    config = LoadTestConfig(
+        levels=args.levels,
+        conversations_per_user=args.conversations_per_user,
+        think_time=args.think_ms / 1000,
+        stream=not args.no_stream,
+        saturation_gain=args.saturation_gain,
+        n8n_replicas=args.n8n_replicas,
+        ollama_replicas=args.ollama_replicas,
+    )
+    ollama = StubOllamaConfig(
+        ttft=args.ttft_ms / 1000,
+        prompt_tokens_per_s=args.prompt_rate,
+        tokens_per_s=args.token_rate,
+        tokens=args.tokens,
+        num_parallel=args.ollama_parallel,
+        batch_slowdown=args.batch_slowdown,
+    )
+    n8n = StubN8nConfig(latency=args.n8n_overhead_ms / 1000)
+    transcripts = load_transcripts(args.transcripts) if args.transcripts else None
+    result = asyncio.run(run_load_test(config, ollama, n8n, transcripts, args.target_users))
+
+    print(format_report(result), file=sys.stderr)
+    encoded = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(encoded + "\n")
+    else:
+        print(encoded)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+stub_servers.py
+
+Lightweight in-process stand-ins for the n8n webhook, used by the benchmark
+and load-test scripts. Only the standard library is used so they run offline.
+"""
+
+import asyncio
+import json
+import random
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+
+@dataclass
+class StubN8nConfig:
+    """Behaviour of the stub n8n webhook."""
+
+    latency: float = 0.05
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    stream: bool = False
+    tokens: int = 20
+    token_interval: float = 0.0
+    response_field: str = "output"
+    seed: Optional[int] = None
+
+
+@dataclass
+class HttpRequest:
+    method: str
+    path: str
+    headers: dict
+    body: bytes
+
+    def json(self):
+        return json.loads(self.body or b"null")
+
+
+class StubHttpServer:
+    """Minimal HTTP/1.1 server with keep-alive and chunked responses.
+
+    Subclasses implement ``handle(request, respond)``. It is deliberately
+    small: enough protocol for httpx and urllib clients, nothing more.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[HttpRequest]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        method, path, _ = request_line.split(" ", 2)
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+        return HttpRequest(method, path, headers, body)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                self.requests += 1
+                await self.handle(request, Responder(writer))
+                if request.headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, request: HttpRequest, respond: "Responder"):
+        raise NotImplementedError
+
+
+class Responder:
+    """Writes a plain or chunked HTTP/1.1 response."""
+
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def _head(self, status: int, content_type: str, extra: str) -> bytes:
+        reason = self.REASONS.get(status, "Status")
+        return (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n{extra}\r\n"
+        ).encode("latin-1")
+
+    async def send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.writer.write(
+            self._head(status, content_type, f"Content-Length: {len(body)}\r\n") + body
+        )
+        await self.writer.drain()
+
+    async def send_json(self, status: int, data):
+        await self.send(status, json.dumps(data).encode("utf-8"))
+
+    async def stream(
+        self,
+        chunks: Callable[[], AsyncIterator[bytes]],
+        content_type: str = "application/json",
+    ):
+        self.writer.write(self._head(200, content_type, "Transfer-Encoding: chunked\r\n"))
+        await self.writer.drain()
+        async for chunk in chunks():
+            self.writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await self.writer.drain()
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+class StubN8nServer(StubHttpServer):
+    """Stand-in for an n8n webhook answering like the RAG agent workflows.
+
+    Replies with ``{"output": ...}`` after ``latency`` +/- ``jitter`` seconds,
+    fails ``error_rate`` of requests with a 503, and in stream mode sends
+    n8n's NDJSON streaming chunks one token every ``token_interval`` seconds.
+    """
+
+    def __init__(self, config: Optional[StubN8nConfig] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.config = config or StubN8nConfig()
+        self.errors = 0
+        self._random = random.Random(self.config.seed)
+
+    def _delay(self) -> float:
+        config = self.config
+        return max(0.0, config.latency + self._random.uniform(-config.jitter, config.jitter))
+
+    async def reply_tokens(self, request: HttpRequest) -> list[str]:
+        """Tokens of the answer; override to generate them some other way."""
+        payload = request.json() or {}
+        question = str(payload.get("chatInput", ""))
+        return [f"token{i} " for i in range(self.config.tokens - 1)] + [question[:32]]
+
+    async def iter_tokens(self, request: HttpRequest, paced: bool = True) -> AsyncIterator[str]:
+        """Yield the answer token by token, ``token_interval`` apart when ``paced``."""
+        for token in await self.reply_tokens(request):
+            if paced and self.config.token_interval:
+                await asyncio.sleep(self.config.token_interval)
+            yield token
+
+    async def handle(self, request: HttpRequest, respond: Responder):
+        config = self.config
+        await asyncio.sleep(self._delay())
+        if self._random.random() < config.error_rate:
+            self.errors += 1
+            await respond.send(503, b"stub n8n: injected failure", "text/plain")
+            return
+
+        if not config.stream:
+            tokens = [token async for token in self.iter_tokens(request, paced=False)]
+            await respond.send_json(200, {config.response_field: "".join(tokens)})
+            return
+
+        async def chunks():
+            yield b'{"type":"begin","metadata":{}}\n'
+            async for token in self.iter_tokens(request):
+                yield (json.dumps({"type": "item", "content": token}) + "\n").encode("utf-8")
+            yield b'{"type":"end","metadata":{}}\n'
+
+        await respond.stream(chunks)
+
+
+@dataclass
+class StubOllamaConfig:
+    """Behaviour of the stub Ollama API.
+
+    Time to first token is ``ttft`` plus prompt evaluation at
+    ``prompt_tokens_per_s``. Tokens then stream at ``tokens_per_s``, slowed
+    by ``batch_slowdown`` for every other request decoding at the same
+    time. At most ``num_parallel`` requests run at once (OLLAMA_NUM_PARALLEL);
+    the rest queue.
+    """
+
+    ttft: float = 0.2
+    prompt_tokens_per_s: float = 2000.0
+    tokens_per_s: float = 30.0
+    tokens: int = 64
+    num_parallel: int = 4
+    batch_slowdown: float = 0.15
+    model: str = "stub-model"
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)."""
+    return max(1, len(text) // 4)
+
+
+class StubOllamaServer(StubHttpServer):
+    """Stand-in for Ollama's ``/api/generate`` and ``/api/chat`` endpoints."""
+
+    def __init__(self, config: Optional[StubOllamaConfig] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.config = config or StubOllamaConfig()
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def reset_stats(self):
+        self.requests = 0
+        self.max_waiting = self.waiting
+
+    def _prompt(self, payload: dict) -> str:
+        if "messages" in payload:
+            return "".join(str(message.get("content", "")) for message in payload["messages"])
+        return str(payload.get("prompt", ""))
+
+    def _chunk(self, path: str, token: str, done: bool, **extra) -> bytes:
+        data = {"model": self.config.model, "done": done, **extra}
+        if path == "/api/chat":
+            data["message"] = {"role": "assistant", "content": token}
+        else:
+            data["response"] = token
+        return (json.dumps(data) + "\n").encode("utf-8")
+
+    async def handle(self, request: HttpRequest, respond: Responder):
+        if request.method == "GET" and request.path == "/api/tags":
+            await respond.send_json(200, {"models": [{"name": self.config.model, "size": 0}]})
+            return
+        if request.path not in ("/api/generate", "/api/chat"):
+            await respond.send_json(404, {"error": "not found"})
+            return
+
+        config = self.config
+        payload = request.json() or {}
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(1, config.num_parallel))
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        await self._slots.acquire()
+        self.waiting -= 1
+        self.active += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
+                self._slots.release()
+
+        async def generate():
+            try:
+                prompt_tokens = estimate_tokens(self._prompt(payload))
+                await asyncio.sleep(config.ttft + prompt_tokens / config.prompt_tokens_per_s)
+                for index in range(config.tokens):
+                    yield f"word{index} "
+                    rate = config.tokens_per_s / (1 + config.batch_slowdown * (self.active - 1))
+                    await asyncio.sleep(1 / rate)
+            finally:
+                release()
+
+        try:
+            if payload.get("stream", True):
+                async def chunks():
+                    async for token in generate():
+                        yield self._chunk(request.path, token, False)
+                    yield self._chunk(request.path, "", True, eval_count=config.tokens)
+
+                await respond.stream(chunks, "application/x-ndjson")
+            else:
+                text = "".join([token async for token in generate()])
+                await respond.send(200, self._chunk(request.path, text, True, eval_count=config.tokens))
+        finally:
+            release()
+
+
+async def stream_json_lines(url: str, path: str, payload: dict) -> AsyncIterator[dict]:
+    """POST ``payload`` and yield each JSON line of the (chunked) reply.
+
+    A bare asyncio HTTP/1.1 client, so the stand-ins can call each other
+    without third-party packages.
+    """
+    host, _, port = url.removeprefix("http://").rstrip("/").partition(":")
+    reader, writer = await asyncio.open_connection(host, int(port or 80))
+    try:
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        status = int(head.split(" ", 2)[1])
+        if status != 200:
+            raise ConnectionError(f"{url}{path} answered {status}")
+        buffer = b""
+        chunked = "transfer-encoding: chunked" in head.lower()
+        while True:
+            if chunked:
+                size = int((await reader.readline()).strip(), 16)
+                data = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                buffer += data[:-2]
+            else:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if buffer.strip():
+            yield json.loads(buffer)
+    finally:
+        writer.close()
+
+
+class StubN8nAgentServer(StubN8nServer):
+    """n8n stand-in that behaves like the RAG agent workflows.
+
+    It keeps chat memory per ``sessionId`` (the last ``memory_messages``
+    messages, like n8n's Postgres chat memory) and generates each answer with
+    a streaming ``/api/chat`` call to one of ``ollama_urls``, round-robin.
+    ``latency`` is the workflow's own overhead before the model is called.
+    """
+
+    def __init__(self, config: Optional[StubN8nConfig] = None, ollama_urls=(), memory_messages: int = 10,
+                 **kwargs):
+        super().__init__(config, **kwargs)
+        self.ollama_urls = list(ollama_urls)
+        self.memory_messages = memory_messages
+        self.memory: dict[str, list] = {}
+        self._next_ollama = 0
+
+    async def iter_tokens(self, request: HttpRequest, paced: bool = True) -> AsyncIterator[str]:
+        payload = request.json() or {}
+        session = str(payload.get("sessionId", ""))
+        history = self.memory.setdefault(session, [])
+        messages = history + [{"role": "user", "content": str(payload.get("chatInput", ""))}]
+        url = self.ollama_urls[self._next_ollama % len(self.ollama_urls)]
+        self._next_ollama += 1
+
+        reply = []
+        async for chunk in stream_json_lines(url, "/api/chat", {"model": "stub-model", "messages": messages}):
+            token = chunk.get("message", {}).get("content", "")
+            if token:
+                reply.append(token)
+                yield token
+        history[:] = (messages + [{"role": "assistant", "content": "".join(reply)}])[-self.memory_messages:]
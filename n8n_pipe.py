@@ -2,31 +2,980 @@
 title: n8n Pipe Function
 author: Cole Medin
 author_url: https://www.youtube.com/@ColeMedin
-version: 0.1.0
+version: 0.2.0
+requirements: httpx
 
 This module defines a Pipe class that utilizes N8N for an Agent
 """
 
-from typing import Optional, Callable, Awaitable, Union
+from typing import AsyncIterator, Optional, Callable, Awaitable, Union
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel, Field
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import json
+import logging
 import os
+import random
+import re
+import tempfile
 import time
-import requests
+import weakref
+import httpx
+
+try:
+    from langfuse import Langfuse
+except ImportError:
+    Langfuse = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
 
 def extract_event_info(event_emitter) -> tuple[Optional[str], Optional[str]]:
-    if not event_emitter or not event_emitter.__closure__:
+    closure = getattr(event_emitter, "__closure__", None)
+    if not event_emitter or not closure:
         return None, None
-    for cell in event_emitter.__closure__:
+    for cell in closure:
         if isinstance(request_info := cell.cell_contents, dict):
             chat_id = request_info.get("chat_id")
             message_id = request_info.get("message_id")
             return chat_id, message_id
     return None, None
 
+# Chunk types emitted by n8n webhooks configured with "Response Mode: Streaming"
+N8N_STREAM_EVENT_TYPES = {"begin", "item", "end", "error"}
+
+
+def json_dumps(value) -> bytes:
+    """Serialize to compact UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(raw: Union[bytes, str]):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def extract_json_field(raw: Union[bytes, str], field: str):
+    """Return ``raw[field]`` for a JSON object, decoding as little as possible."""
+    if orjson is not None:
+        return orjson.loads(raw)[field]
+    text = raw.decode("utf-8") if isinstance(raw, (bytes, bytearray)) else raw
+    ws = _JSON_WHITESPACE.match
+    pos = ws(text).end()
+    if text[pos : pos + 1] == "{":
+        pos = ws(text, pos + 1).end()
+        try:
+            while text[pos : pos + 1] == '"':
+                key, pos = _JSON_DECODER.raw_decode(text, pos)
+                pos = ws(text, pos).end()
+                if text[pos : pos + 1] != ":":
+                    break
+                value, pos = _JSON_DECODER.raw_decode(text, ws(text, pos + 1).end())
+                if key == field:
+                    return value
+                pos = ws(text, pos).end()
+                if text[pos : pos + 1] != ",":
+                    break
+                pos = ws(text, pos + 1).end()
+        except ValueError:
+            pass
+    return json.loads(text)[field]
+
+
+def parse_json_line(line: str) -> Optional[dict]:
+    try:
+        item = json_loads(line)
+    except ValueError:
+        return None
+    return item if isinstance(item, dict) else None
+
+
+class ResponseTooLargeError(Exception):
+    """Raised when an n8n response exceeds ``max_response_bytes``."""
+
+
+class ResponseCache:
+    """Bounded in-memory cache of n8n replies with TTL expiry and LRU eviction."""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+        }
+
+
+def message_text(content) -> str:
+    """Flatten Open WebUI message content (plain text or content parts) to text."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "")
+            for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return "" if content is None else str(content)
+
+
+class ContextTracker:
+    """Track, per chat, how much of the conversation n8n has already been sent."""
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self._cursors: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def _digest(messages: list) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for message in messages:
+            digest.update(str(message.get("role")).encode("utf-8"))
+            digest.update(b"\0")
+            digest.update(message_text(message.get("content")).encode("utf-8"))
+            digest.update(b"\1")
+        return digest.hexdigest()
+
+    @staticmethod
+    def _trim(messages: list, char_budget: int) -> tuple[list, bool]:
+        """Keep the newest messages that fit in ``char_budget`` characters."""
+        kept, used = [], 0
+        for message in reversed(messages):
+            text = message_text(message.get("content"))
+            if char_budget > 0 and used + len(text) > char_budget:
+                remaining = char_budget - used
+                if remaining > 0:
+                    kept.append({"role": message.get("role"), "content": text[-remaining:]})
+                return kept[::-1], True
+            kept.append({"role": message.get("role"), "content": text})
+            used += len(text)
+        return kept[::-1], False
+
+    def delta(
+        self, chat_id: Optional[str], messages: list, char_budget: int
+    ) -> tuple[dict, Optional[tuple]]:
+        """Return the context to forward and the cursor to commit on success."""
+        cursor = self._cursors.get(chat_id) if chat_id else None
+        start, reset = 0, True
+        if cursor is not None:
+            count, digest = cursor
+            if count <= len(messages) and self._digest(messages[:count]) == digest:
+                start, reset = count, False
+            self._cursors.move_to_end(chat_id)
+        context_messages, truncated = self._trim(messages[start:-1], char_budget)
+        context = {"reset": reset, "messages": context_messages}
+        if truncated:
+            context["truncated"] = True
+        pending = (chat_id, len(messages), self._digest(messages)) if chat_id else None
+        return context, pending
+
+    def commit(self, pending: Optional[tuple]):
+        if pending is None:
+            return
+        chat_id, count, digest = pending
+        self._cursors[chat_id] = (count, digest)
+        self._cursors.move_to_end(chat_id)
+        while len(self._cursors) > max(self.max_sessions, 0):
+            self._cursors.popitem(last=False)
+
+
+class SingleFlight:
+    """Share one in-flight upstream call between concurrent callers with one key."""
+
+    def __init__(self):
+        self._calls: dict = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, fn: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def __contains__(self, key) -> bool:
+        return key in self._calls
+
+    def stats(self) -> dict:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
+
+
+_MISSING = object()
+
+
+class MicroBatcher:
+    """Collect requests arriving close together and send them as one batch."""
+
+    def __init__(
+        self,
+        send: Callable[[list], Awaitable[dict]],
+        max_size: int = 16,
+        max_wait: float = 0.01,
+    ):
+        self._send = send
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._ids = itertools.count(1)
+        self._pending: list[tuple[str, object, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((str(next(self._ids)), item, future))
+        if len(self._pending) >= max(self.max_size, 1):
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(max(self.max_wait, 0.0), self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self._send([(request_id, item) for request_id, item, _ in batch])
+        except BaseException as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for request_id, _, future in batch:
+            if future.done():
+                continue
+            result = results.get(request_id, _MISSING)
+            if result is _MISSING:
+                future.set_exception(
+                    Exception(f"Error: no result for request {request_id} in batch response")
+                )
+            elif isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "pending": len(self._pending),
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+# Failures where n8n cannot have started the workflow, so a retry is safe.
+# RemoteProtocolError is left out: a connection dropped after n8n read the
+# request (a crash or restart mid-workflow) may already have run it.
+RETRYABLE_STATUS_CODES = {502, 503}
+RETRYABLE_EXCEPTIONS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling n8n while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures, probing again after a cool-down."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started_at: Optional[float] = None
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def available(self) -> bool:
+        """Whether ``allow`` would let a call through, without claiming a probe."""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.reset_timeout
+        return (
+            self._probe_started_at is None
+            or now - self._probe_started_at >= self.reset_timeout
+        )
+
+    def allow(self) -> bool:
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_started_at = None
+        # Half-open: one probe at a time; a probe that never reports back
+        # (cancelled caller) is abandoned after reset_timeout.
+        if (
+            self._probe_started_at is not None
+            and now - self._probe_started_at < self.reset_timeout
+        ):
+            return False
+        self._probe_started_at = now
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold <= 0:
+            return
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_started_at = None
+
+
+def parse_endpoints(value: str) -> list[str]:
+    """Split a comma or newline separated list of webhook URLs."""
+    endpoints = []
+    for url in re.split(r"[,\n]", value or ""):
+        url = url.strip()
+        if url and url not in endpoints:
+            endpoints.append(url)
+    return endpoints
+
+
+class Endpoint:
+    """One n8n webhook URL with its passive health state."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.breaker = CircuitBreaker()
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.recovered_at: Optional[float] = None
+        self.current_weight = 0.0
+
+    def weight(self, slow_start: float, now: float) -> float:
+        """Ramp traffic back up linearly over ``slow_start`` seconds after recovery."""
+        if self.recovered_at is None or slow_start <= 0:
+            return 1.0
+        elapsed = now - self.recovered_at
+        if elapsed >= slow_start:
+            self.recovered_at = None
+            return 1.0
+        return max(0.1, elapsed / slow_start)
+
+    def observe_latency(self, seconds: float, alpha: float = 0.3):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += alpha * (seconds - self.latency_ewma)
+
+
+class LoadBalancer:
+    """Spread calls over several n8n endpoints with the configured strategy."""
+
+    STRATEGIES = ("round_robin", "least_outstanding", "session_affinity")
+
+    def __init__(self):
+        self.endpoints: dict[str, Endpoint] = {}
+
+    def configure(self, urls: list[str], failure_threshold: int, reset_timeout: float):
+        self.endpoints = {
+            url: self.endpoints.get(url) or Endpoint(url) for url in urls
+        }
+        for endpoint in self.endpoints.values():
+            endpoint.breaker.failure_threshold = failure_threshold
+            endpoint.breaker.reset_timeout = reset_timeout
+
+    def pick(
+        self,
+        strategy: str,
+        session_id: Optional[str] = None,
+        exclude: tuple = (),
+        slow_start: float = 0.0,
+    ) -> Optional[Endpoint]:
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints.values()
+            if endpoint.breaker.available()
+        ]
+        # Prefer endpoints this call has not tried yet, but fall back to them.
+        untried = [e for e in candidates if e.url not in exclude]
+        candidates = untried or candidates
+        while candidates:
+            endpoint = self._choose(strategy, candidates, session_id, slow_start)
+            if endpoint.breaker.allow():
+                return endpoint
+            candidates.remove(endpoint)
+        return None
+
+    def _choose(
+        self,
+        strategy: str,
+        candidates: list[Endpoint],
+        session_id: Optional[str],
+        slow_start: float,
+    ) -> Endpoint:
+        if len(candidates) == 1:
+            return candidates[0]
+        if strategy == "session_affinity" and session_id not in (None, "None"):
+            return max(
+                candidates,
+                key=lambda e: hashlib.blake2b(
+                    f"{session_id}|{e.url}".encode(), digest_size=8
+                ).digest(),
+            )
+        now = time.monotonic()
+        weights = {e.url: e.weight(slow_start, now) for e in candidates}
+        if strategy == "least_outstanding" or strategy == "session_affinity":
+            return min(
+                candidates, key=lambda e: (e.outstanding + 1) / weights[e.url]
+            )
+        total = sum(weights.values())
+        for endpoint in candidates:
+            endpoint.current_weight += weights[endpoint.url]
+        chosen = max(candidates, key=lambda e: e.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+    def state(self) -> str:
+        states = {e.breaker.state for e in self.endpoints.values()}
+        if not states or CircuitBreaker.CLOSED in states:
+            return CircuitBreaker.CLOSED
+        if CircuitBreaker.HALF_OPEN in states:
+            return CircuitBreaker.HALF_OPEN
+        return CircuitBreaker.OPEN
+
+    def retry_after(self) -> float:
+        return min(
+            (e.breaker.retry_after() for e in self.endpoints.values()), default=0.0
+        )
+
+    def stats(self) -> dict:
+        return {
+            url: {
+                "state": e.breaker.state,
+                "outstanding": e.outstanding,
+                "latency_ewma": e.latency_ewma,
+                "failures": e.breaker.failures,
+            }
+            for url, e in self.endpoints.items()
+        }
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+    120.0, 300.0, float("inf"),
+)
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, float("inf"),
+)
+PHASES = ("queue_wait", "connect", "ttfb", "first_token", "decode", "total")
+
+
+class Histogram:
+    """Fixed-bucket histogram, only updated from the event loop thread."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-2]
+
+
+class CallMetrics:
+    """Timings and sizes collected for a single pipe call."""
+
+    def __init__(self, session_id: Optional[str] = None):
+        self.session_id = session_id
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, float, float]] = []
+        self.endpoint = ""
+        self.status_code: Optional[int] = None
+        self.outcome = "upstream"
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self._marks: dict[str, float] = {}
+
+    def span(self, phase: str, start: float, end: Optional[float] = None):
+        self.spans.append((phase, start, time.perf_counter() if end is None else end))
+
+    def duration(self, phase: str) -> Optional[float]:
+        durations = [end - start for name, start, end in self.spans if name == phase]
+        return sum(durations) if durations else None
+
+    async def trace(self, event_name: str, info: dict):
+        """httpx/httpcore trace hook recording connect and time-to-first-byte."""
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started":
+            self._marks["connect"] = now
+        elif event_name in (
+            "connection.connect_tcp.complete",
+            "connection.start_tls.complete",
+        ) and "connect" in self._marks:
+            self.spans = [s for s in self.spans if s[0] != "connect"]
+            self.span("connect", self._marks["connect"], now)
+        elif event_name.endswith(".send_request_headers.started"):
+            self._marks["request"] = now
+        elif event_name.endswith(".receive_response_headers.complete"):
+            self.span("ttfb", self._marks.get("request", self.started), now)
+
+
+class PipeMetrics:
+    """In-process latency/size histograms and counters, labelled per endpoint."""
+
+    def __init__(self):
+        self.latency: dict[tuple[str, str], Histogram] = {}
+        self.sizes: dict[tuple[str, str], Histogram] = {}
+        self.counters: dict[tuple[str, tuple], int] = {}
+
+    def _inc(self, name: str, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    def record(self, call: CallMetrics):
+        endpoint = call.endpoint
+        for phase in PHASES:
+            seconds = call.duration(phase)
+            if seconds is not None:
+                key = (phase, endpoint)
+                self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+        for direction, size in (
+            ("request", call.request_bytes),
+            ("response", call.response_bytes),
+        ):
+            if size:
+                key = (direction, endpoint)
+                self.sizes.setdefault(key, Histogram(SIZE_BUCKETS)).observe(size)
+        self._inc("calls", outcome=call.outcome)
+        if call.status_code is not None:
+            self._inc("responses", endpoint=endpoint, status=str(call.status_code))
+
+    def percentiles(self, phase: str = "total", endpoint: Optional[str] = None) -> dict:
+        histograms = [
+            histogram
+            for (name, url), histogram in self.latency.items()
+            if name == phase and (endpoint is None or url == endpoint)
+        ]
+        merged = Histogram(LATENCY_BUCKETS)
+        for histogram in histograms:
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        return {
+            "count": merged.count,
+            "p50": merged.quantile(0.50),
+            "p95": merged.quantile(0.95),
+            "p99": merged.quantile(0.99),
+        }
+
+    def snapshot(self) -> dict:
+        endpoints = sorted({url for _, url in self.latency})
+        return {
+            endpoint or "local": {
+                phase: self.percentiles(phase, endpoint)
+                for phase in PHASES
+                if (phase, endpoint) in self.latency
+            }
+            for endpoint in endpoints
+        }
+
+    def render_prometheus(self, extra_gauges: Optional[dict] = None) -> str:
+        lines = []
+
+        def labels(**values) -> str:
+            escaped = (
+                k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                for k, v in values.items()
+            )
+            return "{" + ",".join(escaped) + "}"
+
+        def histogram_family(name: str, help_text: str, series: dict, label: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (value, endpoint), histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"{name}_bucket{labels(**{label: value}, endpoint=endpoint, le=le)} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{labels(**{label: value}, endpoint=endpoint)} {histogram.sum}")
+                lines.append(f"{name}_count{labels(**{label: value}, endpoint=endpoint)} {histogram.count}")
+
+        histogram_family(
+            "n8n_pipe_phase_seconds", "Pipe call phase latency.", self.latency, "phase"
+        )
+        histogram_family(
+            "n8n_pipe_payload_bytes", "Request and response body sizes.", self.sizes, "direction"
+        )
+        for counter in ("calls", "responses"):
+            name = f"n8n_pipe_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for (key, label_items), count in sorted(self.counters.items()):
+                if key == counter:
+                    lines.append(f"{name}{labels(**dict(label_items))} {count}")
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class QueueFullError(Exception):
+    """Raised when the n8n wait queue is at capacity."""
+
+
+class ConcurrencyLimiter:
+    """Cap concurrent n8n calls, queueing the excess in strict FIFO order."""
+
+    def __init__(self, max_concurrent: int = 0, max_queue: int = 0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.rejected = 0
+        # (ticket, future) in arrival order; tickets only ever increase.
+        self._waiters: deque = deque()
+        self._tickets = itertools.count()
+        # Tickets that left the queue from the middle, sorted.
+        self._cancelled: list = []
+        # (head ticket, ticket, future): wake a waiter once the head reaches it.
+        self._checkpoints: list = []
+
+    def configure(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        while (
+            self.max_concurrent <= 0 or self.active < self.max_concurrent
+        ) and self._grant_next():
+            self.active += 1
+
+    def _wake_checkpoints(self):
+        head = self._waiters[0][0] if self._waiters else float("inf")
+        while self._checkpoints and self._checkpoints[0][0] <= head:
+            _, _, wake = heapq.heappop(self._checkpoints)
+            if not wake.done():
+                wake.set_result(None)
+
+    def _grant_next(self) -> bool:
+        while self._waiters:
+            _, waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._wake_checkpoints()
+                return True
+        return False
+
+    def _position(self, ticket: int) -> int:
+        """Waiters queued ahead of ``ticket``, without scanning the queue."""
+        head = self._waiters[0][0]
+        del self._cancelled[: bisect.bisect_left(self._cancelled, head)]
+        return ticket - head - bisect.bisect_left(self._cancelled, ticket)
+
+    async def acquire(
+        self, on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ):
+        if self.max_concurrent <= 0 or (
+            self.active < self.max_concurrent and not self._waiters
+        ):
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(
+                f"n8n request queue is full ({len(self._waiters)} waiting)"
+            )
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        ticket = next(self._tickets)
+        self._waiters.append((ticket, waiter))
+        try:
+            if on_queued is None:
+                await waiter
+            reported = None
+            while not waiter.done():
+                position = self._position(ticket)
+                if position != reported:
+                    reported = position
+                    await on_queued(position)
+                    if waiter.done():
+                        break
+                # Near the head every move is reported; further back only once
+                # the position has shrunk by a quarter, so a drain stays O(n log n).
+                step = 1 if position <= 8 else position // 4
+                wake = loop.create_future()
+                heapq.heappush(
+                    self._checkpoints, (self._waiters[0][0] + step, ticket, wake)
+                )
+                await asyncio.wait([waiter, wake], return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove((ticket, waiter))
+                bisect.insort(self._cancelled, ticket)
+                self._wake_checkpoints()
+            raise
+
+    def release(self):
+        if not self._grant_next():
+            self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self, on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ):
+        await self.acquire(on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+        }
+
+
+class _StatusSession:
+    __slots__ = ("last_sent", "pending", "timer", "queue", "worker")
+
+    def __init__(self):
+        self.last_sent = float("-inf")
+        self.pending: Optional[tuple] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.queue: deque = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+    @property
+    def idle(self) -> bool:
+        return (
+            self.pending is None
+            and not self.queue
+            and (self.worker is None or self.worker.done())
+        )
+
+
+class StatusEmitter:
+    """Throttle, coalesce and deliver status events per chat message."""
+
+    def __init__(self, max_sessions: int = 1024):
+        self.max_sessions = max_sessions
+        self.coalesced = 0
+        self.delivery_errors = 0
+        self._ids: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._sessions: dict = {}
+
+    def event_info(self, emitter) -> tuple[Optional[str], Optional[str]]:
+        """``extract_event_info`` memoised per emitter, to skip the closure scan."""
+        try:
+            return self._ids[emitter]
+        except (KeyError, TypeError):
+            pass
+        ids = extract_event_info(emitter)
+        try:
+            self._ids[emitter] = ids
+        except TypeError:
+            pass
+        return ids
+
+    def _session_key(self, emitter):
+        ids = self.event_info(emitter)
+        return ids if any(ids) else ("emitter", id(emitter))
+
+    def _session(self, key) -> _StatusSession:
+        session = self._sessions.get(key)
+        if session is None:
+            if len(self._sessions) >= self.max_sessions:
+                for stale in [k for k, s in self._sessions.items() if s.idle]:
+                    del self._sessions[stale]
+            session = self._sessions[key] = _StatusSession()
+        return session
+
+    async def emit(self, emitter, event: dict, done: bool, interval: float):
+        key = self._session_key(emitter)
+        session = self._session(key)
+        if done:
+            self._cancel_pending(session)
+            self._enqueue(session, emitter, event)
+            await asyncio.shield(session.worker)
+            if self._sessions.get(key) is session and session.idle:
+                del self._sessions[key]
+            return
+
+        now = time.monotonic()
+        wait = session.last_sent + interval - now
+        if wait <= 0:
+            self._cancel_pending(session)
+            session.last_sent = now
+            self._enqueue(session, emitter, event)
+            return
+
+        if session.pending is not None:
+            self.coalesced += 1
+        session.pending = (emitter, event)
+        if session.timer is None:
+            session.timer = asyncio.get_running_loop().call_later(
+                wait, self._send_pending, session
+            )
+
+    def _cancel_pending(self, session: _StatusSession):
+        if session.pending is not None:
+            self.coalesced += 1
+            session.pending = None
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+
+    def _send_pending(self, session: _StatusSession):
+        session.timer = None
+        if session.pending is not None:
+            emitter, event = session.pending
+            session.pending = None
+            session.last_sent = time.monotonic()
+            self._enqueue(session, emitter, event)
+
+    def _enqueue(self, session: _StatusSession, emitter, event: dict):
+        session.queue.append((emitter, event))
+        if session.worker is None or session.worker.done():
+            session.worker = asyncio.ensure_future(self._deliver(session))
+
+    async def _deliver(self, session: _StatusSession):
+        while session.queue:
+            emitter, event = session.queue.popleft()
+            try:
+                await emitter(event)
+            except Exception:
+                self.delivery_errors += 1
+                log.debug("Status event delivery failed", exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "coalesced": self.coalesced,
+            "delivery_errors": self.delivery_errors,
+        }
+
+
 class Pipe:
     class Valves(BaseModel):
         n8n_url: str = Field(
-            default="https://n8n.[your domain].com/webhook/[your webhook URL]"
+            default="https://n8n.[your domain].com/webhook/[your webhook URL]",
+            description="Webhook URL, or several comma-separated URLs to load balance across",
         )
         n8n_bearer_token: str = Field(default="...")
         input_field: str = Field(default="chatInput")
@@ -37,14 +986,882 @@ class Pipe:
         enable_status_indicator: bool = Field(
             default=True, description="Enable or disable status indicator emissions"
         )
+        pool_max_connections: int = Field(
+            default=100,
+            description="Maximum number of concurrent connections to n8n",
+        )
+        pool_max_keepalive_connections: int = Field(
+            default=20,
+            description="Maximum number of idle connections kept alive for reuse",
+        )
+        keepalive_expiry: float = Field(
+            default=30.0,
+            description="Seconds an idle keep-alive connection stays in the pool",
+        )
+        http2: bool = Field(
+            default=False,
+            description="Use HTTP/2 when the n8n endpoint supports it (requires h2)",
+        )
+        max_response_bytes: int = Field(
+            default=32 * 1024 * 1024,
+            description="Abort n8n responses larger than this many bytes (0 = unlimited)",
+        )
+        stream_response: bool = Field(
+            default=False,
+            description="Stream tokens from n8n (SSE/NDJSON) as they arrive",
+        )
+        cache_enabled: bool = Field(
+            default=False,
+            description="Answer repeated questions from an in-memory response cache",
+        )
+        cache_scope: str = Field(
+            default="session",
+            description="Cache key scope: 'session' (per chat) or 'global'",
+        )
+        cache_ttl: float = Field(
+            default=300.0, description="Seconds a cached response stays valid"
+        )
+        cache_max_entries: int = Field(
+            default=256, description="Maximum number of cached responses"
+        )
+        coalesce_requests: bool = Field(
+            default=True,
+            description="Share one n8n call between identical concurrent requests",
+        )
+        coalesce_scope: str = Field(
+            default="session",
+            description="Coalescing scope: 'session' (same chat) or 'global' (any chat)",
+        )
+        batch_enabled: bool = Field(
+            default=False,
+            description="Send concurrent non-streamed chats as one JSON array (n8n_url must be a batch-aware webhook)",
+        )
+        batch_max_size: int = Field(
+            default=16, description="Maximum requests per batch"
+        )
+        batch_max_wait_ms: float = Field(
+            default=10.0,
+            description="Milliseconds to wait for more requests before sending a batch",
+        )
+        batch_id_field: str = Field(
+            default="requestId",
+            description="Field matching each batch item to its entry in the array response",
+        )
+        max_concurrent_requests: int = Field(
+            default=0,
+            description="Maximum simultaneous n8n workflow calls (0 = unlimited)",
+        )
+        max_queue_size: int = Field(
+            default=100,
+            description="Requests allowed to wait for a slot before new ones are rejected",
+        )
+        connect_timeout: float = Field(
+            default=10.0, description="Seconds to wait for a connection to n8n"
+        )
+        read_timeout: float = Field(
+            default=300.0,
+            description="Seconds to wait for n8n to send data before giving up",
+        )
+        max_retries: int = Field(
+            default=2,
+            description="Retries for failures where n8n did not run the workflow (502/503, connect errors)",
+        )
+        retry_backoff_base: float = Field(
+            default=0.5, description="Base delay in seconds for exponential retry backoff"
+        )
+        retry_backoff_max: float = Field(
+            default=8.0, description="Upper bound in seconds for a single retry delay"
+        )
+        circuit_failure_threshold: int = Field(
+            default=5,
+            description="Consecutive n8n failures that open the circuit breaker (0 = disabled)",
+        )
+        circuit_reset_timeout: float = Field(
+            default=30.0,
+            description="Seconds the circuit stays open before a probe request is allowed",
+        )
+        load_balancing: str = Field(
+            default="round_robin",
+            description="Endpoint strategy: round_robin, least_outstanding or session_affinity",
+        )
+        endpoint_slow_threshold: float = Field(
+            default=0.0,
+            description="Count responses slower than this many seconds as endpoint failures (0 = off)",
+        )
+        endpoint_slow_start: float = Field(
+            default=30.0,
+            description="Seconds over which a recovered endpoint ramps back to full traffic",
+        )
+        forward_context: bool = Field(
+            default=False,
+            description="Send the messages added since the previous call with each request",
+        )
+        context_field: str = Field(
+            default="context",
+            description="Payload field carrying forwarded conversation context",
+        )
+        context_char_budget: int = Field(
+            default=8000,
+            description="Maximum characters of conversation context per request (0 = unlimited)",
+        )
+        context_max_sessions: int = Field(
+            default=1000, description="Chats whose context cursor is remembered"
+        )
+        metrics_textfile: str = Field(
+            default="",
+            description="Write Prometheus metrics to this file (node_exporter textfile collector)",
+        )
+        metrics_textfile_interval: float = Field(
+            default=15.0, description="Minimum seconds between metrics file writes"
+        )
+        langfuse_enabled: bool = Field(
+            default=False,
+            description="Forward per-call phase timings to Langfuse as spans "
+            "(requires the langfuse<3 package in Open WebUI)",
+        )
+        langfuse_host: str = Field(default="http://langfuse-web:3000")
+        langfuse_public_key: str = Field(default="")
+        langfuse_secret_key: str = Field(default="")
 
     def __init__(self):
         self.type = "pipe"
         self.id = "n8n_pipe"
         self.name = "N8N Pipe"
         self.valves = self.Valves()
-        self.last_emit_time = 0
-        pass
+        self._client = None
+        self._client_config = None
+        self._inflight = 0
+        self._cache = ResponseCache()
+        self._single_flight = SingleFlight()
+        self._batcher = MicroBatcher(self._send_batch)
+        self._limiter = ConcurrencyLimiter()
+        self._balancer = LoadBalancer()
+        self._metrics = PipeMetrics()
+        self._context = ContextTracker()
+        self._status = StatusEmitter()
+        self._metrics_written_at = 0.0
+        self._langfuse = None
+        self._langfuse_warned = False
+        self._headers: Optional[tuple] = None
+
+    def _transport_config(self) -> tuple:
+        http2 = self.valves.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            log.warning("HTTP/2 requested but the 'h2' package is not installed")
+            http2 = False
+        return (
+            self.valves.pool_max_connections,
+            self.valves.pool_max_keepalive_connections,
+            self.valves.keepalive_expiry,
+            http2,
+        )
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the pooled client; rebuilt once idle after transport valves change."""
+        config = self._transport_config()
+        if self._client is not None and not self._client.is_closed:
+            if config == self._client_config or self._inflight:
+                return self._client
+            stale, self._client = self._client, None
+            self._retire_client(stale)
+
+        max_connections, max_keepalive, keepalive_expiry, http2 = config
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=None,
+            http2=http2,
+        )
+        self._client_config = config
+        return self._client
+
+    def _retire_client(self, client: httpx.AsyncClient):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(client.aclose())
+
+    async def close(self):
+        """Close pooled connections. Safe to call more than once."""
+        client, self._client = self._client, None
+        self._client_config = None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+    async def on_shutdown(self):
+        await self.close()
+
+    def _request_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            self.valves.read_timeout, connect=self.valves.connect_timeout
+        )
+
+    def _encode_payload(self, payload) -> bytes:
+        return json_dumps(payload)
+
+    def _request_headers(self) -> dict:
+        """Request headers, rebuilt only when the bearer token valve changes."""
+        token = self.valves.n8n_bearer_token
+        if self._headers is None or self._headers[0] != token:
+            self._headers = (
+                token,
+                {
+                    "Authorization": f"Bearer {token}",
+                    "Content-Type": "application/json",
+                },
+            )
+        return self._headers[1]
+
+    async def _read_body(self, response: httpx.Response) -> bytes:
+        """Read a response body incrementally, aborting past max_response_bytes."""
+        limit = self.valves.max_response_bytes
+        declared = response.headers.get("content-length", "")
+        if limit > 0 and declared.isdigit() and int(declared) > limit:
+            raise ResponseTooLargeError(
+                f"n8n response of {declared} bytes exceeds the {limit} byte limit"
+            )
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if limit > 0 and len(body) > limit:
+                raise ResponseTooLargeError(
+                    f"n8n response exceeds the {limit} byte limit"
+                )
+        return bytes(body)
+
+    async def _post(
+        self, url: str, content: bytes, headers: dict, call: CallMetrics
+    ) -> tuple[httpx.Response, bytes]:
+        """POST ``content`` and return the response with its size-checked body."""
+        async with self._stream_once(url, content, headers, call) as response:
+            return response, await self._read_body(response)
+
+    @contextlib.asynccontextmanager
+    async def _stream_once(
+        self, url: str, content: bytes, headers: dict, call: CallMetrics
+    ):
+        client = self._get_client()
+        self._inflight += 1
+        try:
+            async with client.stream(
+                "POST",
+                url,
+                content=content,
+                headers=headers,
+                timeout=self._request_timeout(),
+                extensions={"trace": call.trace},
+            ) as response:
+                yield response
+        finally:
+            self._inflight -= 1
+
+    @contextlib.asynccontextmanager
+    async def _stream(
+        self,
+        payload: dict,
+        headers: dict,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ):
+        content = self._encode_payload(payload)
+        call.request_bytes = len(content)
+
+        async def open_attempt(url: str):
+            attempt = contextlib.AsyncExitStack()
+            try:
+                response = await attempt.enter_async_context(
+                    self._stream_once(url, content, headers, call)
+                )
+            except BaseException:
+                await attempt.aclose()
+                raise
+            return response, attempt.aclose
+
+        response, close = await self._send_with_retries(
+            open_attempt, payload.get("sessionId"), call, __event_emitter__
+        )
+        try:
+            yield response
+        finally:
+            await close()
+
+    def circuit_state(self) -> str:
+        return self._balancer.state()
+
+    def endpoint_stats(self) -> dict:
+        return self._balancer.stats()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff."""
+        ceiling = min(
+            self.valves.retry_backoff_max,
+            self.valves.retry_backoff_base * (2**attempt),
+        )
+        return random.uniform(0, max(ceiling, 0))
+
+    async def _pick_endpoint(
+        self,
+        session_id: Optional[str],
+        tried: tuple,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> Endpoint:
+        urls = parse_endpoints(self.valves.n8n_url)
+        if not urls:
+            raise Exception("No n8n webhook URL configured")
+        self._balancer.configure(
+            urls,
+            self.valves.circuit_failure_threshold,
+            self.valves.circuit_reset_timeout,
+        )
+        endpoint = self._balancer.pick(
+            self.valves.load_balancing,
+            session_id,
+            exclude=tried,
+            slow_start=self.valves.endpoint_slow_start,
+        )
+        if endpoint is None:
+            raise CircuitOpenError(
+                "n8n circuit breaker is open after repeated failures; "
+                f"retrying in {self._balancer.retry_after():.0f}s"
+            )
+        if endpoint.breaker.state == CircuitBreaker.HALF_OPEN:
+            await self.emit_status(
+                __event_emitter__, "warning", "n8n circuit half-open, probing...", False
+            )
+        return endpoint
+
+    async def _record_upstream_result(
+        self,
+        endpoint: Endpoint,
+        ok: bool,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ):
+        breaker = endpoint.breaker
+        previous = breaker.state
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        if breaker.state == previous:
+            return
+        where = f" ({endpoint.url})" if len(self._balancer.endpoints) > 1 else ""
+        if breaker.state == CircuitBreaker.OPEN:
+            await self.emit_status(
+                __event_emitter__,
+                "error",
+                f"n8n circuit open{where}, failing fast for {breaker.reset_timeout:.0f}s",
+                False,
+            )
+        elif breaker.state == CircuitBreaker.CLOSED:
+            endpoint.recovered_at = time.monotonic()
+            await self.emit_status(
+                __event_emitter__, "info", f"n8n circuit closed{where}, n8n recovered", False
+            )
+
+    async def _send_with_retries(
+        self,
+        open_attempt: Callable[[str], Awaitable[tuple]],
+        session_id: Optional[str],
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> tuple:
+        """Send under the endpoint breaker; retry only calls that cannot have run."""
+        attempts = max(self.valves.max_retries, 0) + 1
+        tried = ()
+        for attempt in range(attempts):
+            endpoint = await self._pick_endpoint(session_id, tried, __event_emitter__)
+            tried += (endpoint.url,)
+            call.endpoint = endpoint.url
+            last = attempt == attempts - 1
+            endpoint.outstanding += 1
+            started = time.monotonic()
+            try:
+                response, close = await open_attempt(endpoint.url)
+            except RETRYABLE_EXCEPTIONS:
+                endpoint.outstanding -= 1
+                await self._record_upstream_result(endpoint, False, __event_emitter__)
+                if last:
+                    raise
+            except BaseException as e:
+                endpoint.outstanding -= 1
+                if isinstance(e, httpx.TransportError):
+                    await self._record_upstream_result(
+                        endpoint, False, __event_emitter__
+                    )
+                raise
+            else:
+                elapsed = time.monotonic() - started
+                call.status_code = response.status_code
+                endpoint.observe_latency(elapsed)
+                slow = 0 < self.valves.endpoint_slow_threshold < elapsed
+                retryable = response.status_code in RETRYABLE_STATUS_CODES
+                await self._record_upstream_result(
+                    endpoint, response.status_code < 500 and not slow, __event_emitter__
+                )
+                if last or not retryable:
+                    return response, self._release_endpoint(endpoint, close)
+                endpoint.outstanding -= 1
+                if close is not None:
+                    await close()
+
+            delay = self._backoff_delay(attempt)
+            await self.emit_status(
+                __event_emitter__,
+                "warning",
+                f"n8n unavailable, retrying in {delay:.1f}s "
+                f"({attempt + 1}/{attempts - 1})",
+                False,
+            )
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _release_endpoint(
+        endpoint: Endpoint, close: Optional[Callable[[], Awaitable[None]]]
+    ) -> Callable[[], Awaitable[None]]:
+        released = False
+
+        async def release():
+            nonlocal released
+            if not released:
+                released = True
+                endpoint.outstanding -= 1
+            if close is not None:
+                await close()
+
+        return release
+
+    def _cache_key(
+        self, chat_id: Optional[str], question, history: list
+    ) -> Optional[tuple]:
+        """Key a question on its normalized text and the history it follows."""
+        if not self.valves.cache_enabled or not isinstance(question, str):
+            return None
+        scope = f"{chat_id}" if self.valves.cache_scope == "session" else ""
+        normalized = " ".join(question.split()).casefold()
+        return (
+            self.valves.n8n_url,
+            self.valves.input_field,
+            self.valves.response_field,
+            scope,
+            ContextTracker._digest(history),
+            normalized,
+        )
+
+    def _cached_reply(self, cache_key: Optional[tuple]):
+        if cache_key is None:
+            return None
+        self._cache.max_entries = self.valves.cache_max_entries
+        self._cache.ttl = self.valves.cache_ttl
+        return self._cache.get(cache_key)
+
+    def cache_stats(self) -> dict:
+        return self._cache.stats()
+
+    def coalesce_stats(self) -> dict:
+        return self._single_flight.stats()
+
+    def _coalesce_key(self, payload: dict, content: bytes) -> Optional[tuple]:
+        if not self.valves.coalesce_requests:
+            return None
+        if self.valves.coalesce_scope == "global":
+            content = self._encode_payload(
+                {k: v for k, v in payload.items() if k != "sessionId"}
+            )
+        return (self.valves.n8n_url, self.valves.response_field, content)
+
+    def limiter_stats(self) -> dict:
+        return self._limiter.stats()
+
+    @contextlib.asynccontextmanager
+    async def _upstream_slot(
+        self,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ):
+        """Reserve a concurrency slot, reporting queue position while waiting."""
+        self._limiter.configure(
+            self.valves.max_concurrent_requests, self.valves.max_queue_size
+        )
+
+        async def on_queued(ahead: int):
+            await self.emit_status(
+                __event_emitter__, "info", f"Queued ({ahead} ahead)", False
+            )
+
+        queued_at = time.perf_counter()
+        async with self._limiter.slot(on_queued):
+            call.span("queue_wait", queued_at)
+            yield
+
+    async def _fetch_reply(
+        self,
+        payload: dict,
+        headers: dict,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        content: Optional[bytes] = None,
+    ):
+        if content is None:
+            content = self._encode_payload(payload)
+        call.request_bytes = len(content)
+        raw = b""
+
+        async def open_attempt(url: str):
+            nonlocal raw
+            # The body is already read, so there is nothing to release.
+            response, raw = await self._post(url, content, headers, call)
+            return response, None
+
+        async with self._upstream_slot(call, __event_emitter__):
+            response, close = await self._send_with_retries(
+                open_attempt, payload.get("sessionId"), call, __event_emitter__
+            )
+            await close()
+        call.response_bytes = len(raw)
+        if response.status_code != 200:
+            raise Exception(
+                f"Error: {response.status_code} - {raw.decode('utf-8', 'replace')}"
+            )
+        decode_started = time.perf_counter()
+        reply = extract_json_field(raw, self.valves.response_field)
+        call.span("decode", decode_started)
+        return reply
+
+    async def _request_reply(
+        self,
+        payload: dict,
+        headers: dict,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ):
+        # Encoded once and shared by the coalescing key, the request body and
+        # every retry.
+        content = self._encode_payload(payload)
+        fetch = self._fetch_batched if self.valves.batch_enabled else self._fetch_reply
+        coalesce_key = self._coalesce_key(payload, content)
+        if coalesce_key is None:
+            return await fetch(payload, headers, call, __event_emitter__, content)
+        if coalesce_key in self._single_flight:
+            call.outcome = "coalesced"
+        return await self._single_flight.do(
+            coalesce_key,
+            lambda: fetch(payload, headers, call, __event_emitter__, content),
+        )
+
+    async def _fetch_batched(
+        self,
+        payload: dict,
+        headers: dict,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        content: Optional[bytes] = None,
+    ):
+        self._batcher.max_size = self.valves.batch_max_size
+        self._batcher.max_wait = self.valves.batch_max_wait_ms / 1000
+        call.outcome = "batched"
+        if content is None:
+            content = self._encode_payload(payload)
+        return await self._batcher.submit((content, headers, call))
+
+    async def _send_batch(self, entries: list) -> dict:
+        """Send one batch and map each item's reply (or error) to its request id."""
+        id_field = self.valves.batch_id_field
+        id_key = json_dumps(id_field)
+        headers = entries[0][1][1]
+        # Splice the id into each already-encoded payload object rather than
+        # serializing every payload again.
+        content = b"[" + b",".join(
+            b"{" + id_key + b":" + json_dumps(request_id)
+            + (b"," if item[1:-1].strip() else b"") + item[1:]
+            for request_id, (item, _, _) in entries
+        ) + b"]"
+        batch = CallMetrics("batch")
+        batch.request_bytes = len(content)
+        raw = b""
+
+        async def open_attempt(url: str):
+            nonlocal raw
+            response, raw = await self._post(url, content, headers, batch)
+            return response, None
+
+        slot_acquired = None
+        try:
+            async with self._upstream_slot(batch):
+                slot_acquired = time.perf_counter()
+                response, close = await self._send_with_retries(
+                    open_attempt, None, batch
+                )
+                await close()
+            batch.response_bytes = len(raw)
+            if response.status_code != 200:
+                raise Exception(
+                    f"Error: {response.status_code} - {raw.decode('utf-8', 'replace')}"
+                )
+            decode_started = time.perf_counter()
+            data = json_loads(raw)
+            batch.span("decode", decode_started)
+        finally:
+            for _, (_, _, call) in entries:
+                call.endpoint = batch.endpoint
+                call.status_code = batch.status_code
+                call.spans.extend(s for s in batch.spans if s[0] != "queue_wait")
+                if slot_acquired is not None:
+                    call.span("queue_wait", call.started, slot_acquired)
+
+        if isinstance(data, dict):
+            data = data.get("results", data.get(self.valves.response_field))
+        if not isinstance(data, list):
+            raise Exception("Error: batch webhook did not return a JSON array")
+        results = {}
+        for item in data:
+            if not isinstance(item, dict) or item.get(id_field) is None:
+                continue
+            request_id = str(item[id_field])
+            if self.valves.response_field in item:
+                results[request_id] = item[self.valves.response_field]
+            else:
+                results[request_id] = Exception(
+                    f"Error: {item.get('error') or 'missing ' + self.valves.response_field}"
+                )
+        return results
+
+    def batch_stats(self) -> dict:
+        return self._batcher.stats()
+
+    def metrics_snapshot(self) -> dict:
+        """p50/p95/p99 per endpoint and phase, plus cache/coalescing/queue/batch counters."""
+        return {
+            "latency": self._metrics.snapshot(),
+            "cache": self.cache_stats(),
+            "coalescing": self.coalesce_stats(),
+            "queue": self.limiter_stats(),
+            "batching": self.batch_stats(),
+            "endpoints": self.endpoint_stats(),
+        }
+
+    def prometheus_metrics(self) -> str:
+        """Render all pipe metrics in the Prometheus text exposition format."""
+        cache, coalescing, queue = (
+            self.cache_stats(),
+            self.coalesce_stats(),
+            self.limiter_stats(),
+        )
+        return self._metrics.render_prometheus(
+            {
+                "n8n_pipe_cache_hits": cache["hits"],
+                "n8n_pipe_cache_misses": cache["misses"],
+                "n8n_pipe_cache_entries": cache["size"],
+                "n8n_pipe_coalesced_calls": coalescing["coalesced"],
+                "n8n_pipe_active_requests": queue["active"],
+                "n8n_pipe_queued_requests": queue["queued"],
+                "n8n_pipe_rejected_requests": queue["rejected"],
+            }
+        )
+
+    def _record_call(self, call: CallMetrics):
+        call.span("total", call.started)
+        self._metrics.record(call)
+        self._write_metrics_textfile()
+        self._export_langfuse(call)
+
+    def _write_metrics_textfile(self):
+        path = self.valves.metrics_textfile
+        now = time.monotonic()
+        if not path or now - self._metrics_written_at < self.valves.metrics_textfile_interval:
+            return
+        self._metrics_written_at = now
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, delete=False, suffix=".tmp"
+            ) as handle:
+                handle.write(self.prometheus_metrics())
+            os.replace(handle.name, path)
+        except OSError as e:
+            log.warning("Could not write n8n pipe metrics to %s: %s", path, e)
+
+    def _langfuse_client(self):
+        if not self.valves.langfuse_enabled or Langfuse is None:
+            return None
+        if self._langfuse is None:
+            self._langfuse = Langfuse(
+                public_key=self.valves.langfuse_public_key,
+                secret_key=self.valves.langfuse_secret_key,
+                host=self.valves.langfuse_host,
+            )
+        return self._langfuse
+
+    def _export_langfuse(self, call: CallMetrics):
+        """Forward the call's phases as Langfuse spans; the SDK batches in the background."""
+        client = self._langfuse_client()
+        if client is None:
+            return
+
+        def at(offset: float) -> datetime:
+            return call.started_at + timedelta(seconds=offset - call.started)
+
+        try:
+            if not hasattr(client, "trace"):
+                raise RuntimeError("the installed langfuse SDK has no trace() API; install langfuse<3")
+            trace = client.trace(
+                name="n8n_pipe",
+                session_id=call.session_id,
+                metadata={
+                    "endpoint": call.endpoint,
+                    "status_code": call.status_code,
+                    "outcome": call.outcome,
+                    "request_bytes": call.request_bytes,
+                    "response_bytes": call.response_bytes,
+                },
+            )
+            for phase, start, end in call.spans:
+                trace.span(name=phase, start_time=at(start), end_time=at(end))
+        except Exception as e:
+            if self._langfuse_warned:
+                log.debug("Could not export n8n pipe spans to Langfuse: %s", e)
+                return
+            self._langfuse_warned = True
+            log.warning(
+                "Could not export n8n pipe spans to Langfuse (further failures are logged at debug level): %s",
+                e,
+            )
+
+    def _token_from_item(self, item: dict) -> Optional[str]:
+        """Pull the text token out of one decoded stream chunk."""
+        event_type = item.get("type")
+        if event_type == "error":
+            raise Exception(f"Error: {item.get('content') or item}")
+        if event_type in N8N_STREAM_EVENT_TYPES:
+            return item.get("content") if event_type == "item" else None
+        token = item.get(self.valves.response_field, item.get("content"))
+        return token if isinstance(token, str) else None
+
+    async def _iter_lines(self, response: httpx.Response) -> AsyncIterator[str]:
+        """``aiter_lines`` that aborts once max_response_bytes have been received."""
+        limit = self.valves.max_response_bytes
+        received = 0
+        async for line in response.aiter_lines():
+            received += len(line) + 1
+            if limit > 0 and received > limit:
+                raise ResponseTooLargeError(
+                    f"n8n response exceeds the {limit} byte limit"
+                )
+            yield line
+
+    async def _iter_sse_tokens(self, response: httpx.Response) -> AsyncIterator[str]:
+        data_lines = []
+        async for line in self._iter_lines(response):
+            if line.startswith("data:"):
+                data_lines.append(line[5:].removeprefix(" "))
+                continue
+            if line or not data_lines:
+                continue
+            data, data_lines = "\n".join(data_lines), []
+            if data == "[DONE]":
+                return
+            if token := self._token_from_sse_data(data):
+                yield token
+        if data_lines and (token := self._token_from_sse_data("\n".join(data_lines))):
+            if token != "[DONE]":
+                yield token
+
+    def _token_from_sse_data(self, data: str) -> Optional[str]:
+        item = parse_json_line(data)
+        return self._token_from_item(item) if item is not None else data
+
+    async def _iter_stream_tokens(
+        self, response: httpx.Response
+    ) -> AsyncIterator[str]:
+        """Yield tokens from an SSE or NDJSON body, or answer a plain JSON body."""
+        content_type = response.headers.get("content-type", "")
+        if "text/event-stream" in content_type:
+            async for token in self._iter_sse_tokens(response):
+                yield token
+            return
+
+        streaming = "ndjson" in content_type or "jsonl" in content_type or None
+        buffered = []
+        async for line in self._iter_lines(response):
+            if streaming is False:
+                buffered.append(line)
+                continue
+            if not line.strip():
+                continue
+            item = parse_json_line(line)
+            if streaming is None:
+                streaming = item is not None and item.get("type") in N8N_STREAM_EVENT_TYPES
+                if not streaming:
+                    buffered.append(line)
+                    continue
+            if item is not None and (token := self._token_from_item(item)):
+                yield token
+
+        if not streaming and buffered:
+            yield extract_json_field("\n".join(buffered), self.valves.response_field)
+
+    async def _stream_reply(
+        self,
+        body: dict,
+        payload: dict,
+        headers: dict,
+        call: CallMetrics,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        cache_key: Optional[tuple] = None,
+        cached: Optional[str] = None,
+        context_cursor: Optional[tuple] = None,
+    ) -> AsyncIterator[str]:
+        if cached is not None:
+            call.outcome = "cache_hit"
+            call.span("first_token", call.started)
+            yield cached
+            body["messages"].append({"role": "assistant", "content": cached})
+            self._record_call(call)
+            await self.emit_status(__event_emitter__, "info", "Complete", True)
+            return
+
+        headers = {
+            **headers,
+            "Accept": "text/event-stream, application/x-ndjson, application/json",
+        }
+        chunks = []
+        try:
+            async with self._upstream_slot(call, __event_emitter__), self._stream(
+                payload, headers, call, __event_emitter__
+            ) as response:
+                if response.status_code != 200:
+                    raw = await self._read_body(response)
+                    raise Exception(
+                        f"Error: {response.status_code} - {raw.decode('utf-8', 'replace')}"
+                    )
+                async for token in self._iter_stream_tokens(response):
+                    if not chunks:
+                        call.span("first_token", call.started)
+                    chunks.append(token)
+                    call.response_bytes += len(token.encode("utf-8"))
+                    yield token
+        except Exception as e:
+            call.outcome = "error"
+            self._record_call(call)
+            await self.emit_status(
+                __event_emitter__,
+                "error",
+                f"Error during sequence execution: {str(e)}",
+                True,
+            )
+            yield f"Error: {str(e)}"
+            return
+
+        reply = "".join(chunks)
+        self._record_call(call)
+        self._context.commit(context_cursor)
+        if cache_key is not None:
+            self._cache.set(cache_key, reply)
+        body["messages"].append({"role": "assistant", "content": reply})
+        await self.emit_status(__event_emitter__, "info", "Complete", True)
 
     async def emit_status(
         self,
@@ -53,26 +1870,25 @@ class Pipe:
         message: str,
         done: bool,
     ):
-        current_time = time.time()
-        if (
-            __event_emitter__
-            and self.valves.enable_status_indicator
-            and (
-                current_time - self.last_emit_time >= self.valves.emit_interval or done
-            )
-        ):
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": "complete" if done else "in_progress",
-                        "level": level,
-                        "description": message,
-                        "done": done,
-                    },
-                }
-            )
-            self.last_emit_time = current_time
+        if not __event_emitter__ or not self.valves.enable_status_indicator:
+            return
+        await self._status.emit(
+            __event_emitter__,
+            {
+                "type": "status",
+                "data": {
+                    "status": "complete" if done else "in_progress",
+                    "level": level,
+                    "description": message,
+                    "done": done,
+                },
+            },
+            done,
+            self.valves.emit_interval,
+        )
+
+    def status_stats(self) -> dict:
+        return self._status.stats()
 
     async def pipe(
         self,
@@ -80,11 +1896,11 @@ class Pipe:
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[dict], Awaitable[None]] = None,
         __event_call__: Callable[[dict], Awaitable[dict]] = None,
-    ) -> Optional[Union[str, dict]]:
+    ) -> Optional[Union[str, dict, AsyncIterator[str]]]:
         await self.emit_status(
             __event_emitter__, "info", "/Calling N8N Workflow...", False
         )
-        chat_id, _ = extract_event_info(__event_emitter__)
+        chat_id, _ = self._status.event_info(__event_emitter__)
         messages = body.setdefault("messages", [])
 
         if not isinstance(messages, list):
@@ -103,19 +1919,47 @@ class Pipe:
             try:
                 question = messages[-1]["content"]
                 # Invoke N8N workflow
-                headers = {
-                    "Authorization": f"Bearer {self.valves.n8n_bearer_token}",
-                    "Content-Type": "application/json",
-                }
+                headers = self._request_headers()
                 payload = {"sessionId": f"{chat_id}"}
                 payload[self.valves.input_field] = question
-                response = requests.post(
-                    self.valves.n8n_url, json=payload, headers=headers
-                )
-                if response.status_code == 200:
-                    n8n_response = response.json()[self.valves.response_field]
+                context_cursor = None
+                if self.valves.forward_context:
+                    self._context.max_sessions = self.valves.context_max_sessions
+                    payload[self.valves.context_field], context_cursor = (
+                        self._context.delta(
+                            chat_id, messages, self.valves.context_char_budget
+                        )
+                    )
+                call = CallMetrics(f"{chat_id}")
+                cache_key = self._cache_key(chat_id, question, messages[:-1])
+                n8n_response = self._cached_reply(cache_key)
+                if self.valves.stream_response:
+                    return self._stream_reply(
+                        body,
+                        payload,
+                        headers,
+                        call,
+                        __event_emitter__,
+                        cache_key=cache_key,
+                        cached=n8n_response,
+                        context_cursor=context_cursor,
+                    )
+                if n8n_response is not None:
+                    call.outcome = "cache_hit"
+                    self._record_call(call)
                 else:
-                    raise Exception(f"Error: {response.status_code} - {response.text}")
+                    try:
+                        n8n_response = await self._request_reply(
+                            payload, headers, call, __event_emitter__
+                        )
+                    except Exception:
+                        call.outcome = "error"
+                        raise
+                    finally:
+                        self._record_call(call)
+                    self._context.commit(context_cursor)
+                    if cache_key is not None and n8n_response is not None:
+                        self._cache.set(cache_key, n8n_response)
 
                 # Set assistant message with chain reply
                 body["messages"].append({"role": "assistant", "content": n8n_response})
@@ -9,15 +9,192 @@ import os
 import subprocess
 import shutil
 import argparse
-import platform
 import time
 import re
+import json
+import hashlib
+import tempfile
+import random
+import threading
+import socket
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
+import contextlib
+import base64
+import gzip
+import hmac
+import secrets
+import itertools
+import difflib
+
+
+class Tracer:
+    """Collect timed spans for startup phases and the subprocesses they run."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._origin = time.perf_counter()
+        self.started_at = time.time()
+
+    @contextlib.contextmanager
+    def span(self, name, category="phase", **attributes):
+        """Time the enclosed block; yields the span's attribute dict to fill in."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        record = {
+            "id": next(self._ids),
+            "parent": stack[-1]["id"] if stack else None,
+            "name": name,
+            "category": category,
+            "thread": threading.get_ident(),
+            "start": time.perf_counter() - self._origin,
+            "attributes": attributes,
+        }
+        stack.append(record)
+        try:
+            yield attributes
+        except BaseException as exc:
+            if not (isinstance(exc, SystemExit) and not exc.code):
+                attributes.setdefault("error", f"{type(exc).__name__}: {exc}"[:200])
+            raise
+        finally:
+            stack.pop()
+            record["duration"] = time.perf_counter() - self._origin - record["start"]
+            with self._lock:
+                self.spans.append(record)
+
+    def chrome_trace(self):
+        """Spans as Chrome trace-event JSON (chrome://tracing, Perfetto, speedscope)."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        threads = {}
+        events = []
+        for span in spans:
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": round(span["start"] * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"span_id": span["id"], "parent_span_id": span["parent"], **span["attributes"]},
+            })
+        phases = {}
+        for span in spans:
+            if span["category"] == "phase":
+                phases[span["name"]] = phases.get(span["name"], 0.0) + round(span["duration"] * 1000, 3)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "tool": "start_services.py",
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+                "argv": sys.argv[1:],
+                "phases_ms": phases,
+            },
+        }
+
+    def summary_lines(self):
+        """Phase timings followed by the subprocesses that took the most time."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        total = sum(span["duration"] for span in spans if span["parent"] is None and span["category"] == "phase")
+        lines = [f"{'PHASE':<32}  {'SECONDS':>8}  {'SHARE':>6}"]
+        for span in spans:
+            if span["category"] == "phase" and span["parent"] is None:
+                share = span["duration"] / total if total else 0.0
+                status = "  (failed)" if "error" in span["attributes"] else ""
+                lines.append(f"{span['name']:<32}  {span['duration']:>8.2f}  {share:>6.0%}{status}")
+        lines.append(f"{'total':<32}  {total:>8.2f}")
+
+        commands = {}
+        for span in spans:
+            if span["category"] == "subprocess":
+                entry = commands.setdefault(span["name"], {"count": 0, "seconds": 0.0, "max": 0.0, "failed": 0})
+                entry["count"] += 1
+                entry["seconds"] += span["duration"]
+                entry["max"] = max(entry["max"], span["duration"])
+                exit_code = span["attributes"].get("exit_code")
+                entry["failed"] += bool(exit_code) or "error" in span["attributes"]
+        if commands:
+            lines.append("")
+            lines.append(f"{'COMMAND':<32}  {'CALLS':>5}  {'SECONDS':>8}  {'MAX':>7}  {'FAILED':>6}")
+            for name, entry in sorted(commands.items(), key=lambda item: -item[1]["seconds"])[:10]:
+                lines.append(f"{name:<32}  {entry['count']:>5}  {entry['seconds']:>8.2f}  "
+                             f"{entry['max']:>7.2f}  {entry['failed']:>6}")
+        return lines
+
+
+TRACER = Tracer()
+
+# Options whose value is a separate argument, skipped when labelling commands.
+_VALUE_OPTIONS = {"-p", "-f", "--profile", "--file", "--project-name", "--filter", "--format"}
+
+
+def command_label(cmd):
+    """Short, stable name for a command: the program and its first two subcommands."""
+    words = [os.path.basename(cmd[0])]
+    args = iter(cmd[1:])
+    for arg in args:
+        if len(words) == 3:
+            break
+        if arg.startswith("-"):
+            if arg in _VALUE_OPTIONS:
+                next(args, None)
+            continue
+        words.append(arg)
+    return " ".join(words)
+
+
+def _output_size(*streams):
+    return sum(len(stream.encode("utf-8") if isinstance(stream, str) else stream)
+               for stream in streams if stream)
+
+
+def run_process(cmd, redact=(), **kwargs):
+    """subprocess.run() recorded as a span; values in ``redact`` are masked in the recorded command."""
+    command = " ".join(cmd)
+    for secret in redact:
+        command = command.replace(secret, "***")
+    with TRACER.span(command_label(cmd), "subprocess", command=command) as attributes:
+        try:
+            result = subprocess.run(cmd, **kwargs)
+        except subprocess.CalledProcessError as e:
+            attributes.update(exit_code=e.returncode, output_bytes=_output_size(e.stdout, e.stderr))
+            raise
+        attributes.update(exit_code=result.returncode,
+                          output_bytes=_output_size(result.stdout, result.stderr))
+        return result
+
+
+def write_trace(path, tracer=None):
+    """Write the Chrome trace to ``path`` and print the phase summary."""
+    tracer = tracer or TRACER
+    write_json_atomic(tracer.chrome_trace(), path)
+    print("")
+    for line in tracer.summary_lines():
+        print(line)
+    print(f"Trace written to {path} (open in chrome://tracing or https://ui.perfetto.dev)")
 
 
 def run_command(cmd, cwd=None):
     """Run a shell command and print it."""
     print("Running:", " ".join(cmd))
-    subprocess.run(cmd, cwd=cwd, check=True)
+    run_process(cmd, cwd=cwd, check=True)
+
+
+# Generated by --profile auto; applied to every compose command while it exists.
+LIMITS_OVERRIDE_FILE = "docker-compose.override.limits.yml"
+CLICKHOUSE_LIMITS_FILE = "clickhouse-limits.xml"
+# Set once --profile auto has sized this host; an explicit profile never picks up the override.
+_limits_override_active = False
 
 
 def compose_base_command(profile=None, environment=None):
@@ -30,63 +207,437 @@ def compose_base_command(profile=None, environment=None):
         cmd.extend(["-f", "docker-compose.override.private.yml"])
     if environment == "public":
         cmd.extend(["-f", "docker-compose.override.public.yml"])
+    if _limits_override_active and os.path.exists(LIMITS_OVERRIDE_FILE):
+        cmd.extend(["-f", LIMITS_OVERRIDE_FILE])
     return cmd
 
 
-def get_update_services(profile=None):
+def get_update_services(profile=None, environment=None, config=None):
     """Return Compose services that should be refreshed for Ollama/Open WebUI updates."""
+    config = config or load_compose_config(profile=profile, environment=environment)
     services = ["open-webui"]
+    for name, definition in config.get("services", {}).items():
+        image = definition.get("image", "")
+        if image.startswith("ollama/ollama") and not definition.get("entrypoint"):
+            services.append(name)
+    return services
 
-    if profile == "gpu-amd":
-        services.append("ollama-gpu-amd")
-    elif profile == "gpu-nvidia":
-        services.append("ollama-gpu")
-    elif profile == "cpu":
-        services.append("ollama-cpu")
 
-    return services
+def write_text_atomic(content, path, mode=None):
+    """Write text through a temp file and rename, keeping the file's mode (``mode`` or 0600 when new)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+    fd, tmp_path = tempfile.mkstemp(prefix=".localai-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", newline="") as file:
+            file.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
-def pull_services_with_retry(profile=None, environment=None, services=None, retries=3, delay_seconds=3):
-    """Pull Docker Compose services with retries to handle transient failures."""
-    services = services or []
-    if not services:
-        return
+def write_json_atomic(data, path):
+    """Write JSON atomically so an interrupted run never leaves a corrupt file."""
+    write_text_atomic(json.dumps(data, indent=2, sort_keys=True), path)
+
+
+def render_file(path, content, mode=None):
+    """Atomically write ``content`` to ``path`` unless it is already there; True if written."""
+    try:
+        with open(path, newline="") as file:
+            if file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    write_text_atomic(content, path, mode=mode)
+    return True
+
+
+# Resolved configs already loaded in this run, by cache key. Only kept in
+# memory: shell variables and included/env_file files also feed the model.
+_compose_configs = {}
+
+
+def compose_files(profile=None, environment=None):
+    """Files that determine the resolved Compose model: the -f files plus .env."""
+    cmd = compose_base_command(profile=profile, environment=environment)
+    files = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-f"]
+    return files + [".env"]
+
+
+def file_digest(path):
+    """sha256 of ``path``, or None when it does not exist."""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def load_compose_config(profile=None, environment=None):
+    """Return the fully resolved Compose model as a dict, resolved once per run and file content."""
+    digests = {path: file_digest(path) for path in compose_files(profile, environment)}
+    key = json.dumps([profile, environment, digests], sort_keys=True)
+    if key not in _compose_configs:
+        cmd = compose_base_command(profile=profile, environment=environment)
+        cmd.extend(["config", "--format", "json"])
+        result = run_process(cmd, capture_output=True, text=True, check=True)
+        _compose_configs[key] = json.loads(result.stdout)
+    return _compose_configs[key]
+
+
+def searxng_cap_drop_active(config):
+    """True when the resolved searxng service drops all capabilities."""
+    cap_drop = config.get("services", {}).get("searxng", {}).get("cap_drop") or []
+    return "ALL" in cap_drop
+
+
+def service_dependencies(config, service):
+    """Return the services ``service`` depends on (short or long depends_on form)."""
+    depends_on = config.get("services", {}).get(service, {}).get("depends_on") or []
+    return list(depends_on)
+
+
+def resolve_service_images(config, services=None, include_dependencies=True):
+    """Map services (all when ``services`` is None) to images, following depends_on; build-only ones are skipped."""
+    all_services = config.get("services", {})
+    pending = list(all_services if services is None else services)
+    images = {}
+    seen = set()
+    while pending:
+        service = pending.pop(0)
+        if service in seen or service not in all_services:
+            continue
+        seen.add(service)
+        image = all_services[service].get("image")
+        if image:
+            images[service] = image
+        if include_dependencies:
+            pending.extend(service_dependencies(config, service))
+    return images
+
+
+def local_image_digests(image):
+    """Return the registry digests (``sha256:...``) of the local copy of ``image``."""
+    result = run_process(
+        ["docker", "image", "inspect", "--format", "{{json .RepoDigests}}", image],
+        capture_output=True, text=True, check=False,
+    )
+    if result.returncode != 0:
+        return set()
+    try:
+        repo_digests = json.loads(result.stdout.strip() or "[]") or []
+    except ValueError:
+        return set()
+    return {digest.split("@", 1)[1] for digest in repo_digests if "@" in digest}
+
+
+def remote_image_digest(image):
+    """Return the registry digest ``image`` currently points at, or None if unknown."""
+    result = run_process(
+        ["docker", "buildx", "imagetools", "inspect", image, "--format", "{{json .Manifest}}"],
+        capture_output=True, text=True, check=False,
+    )
+    if result.returncode != 0:
+        return None
+    try:
+        return json.loads(result.stdout).get("digest")
+    except (ValueError, AttributeError):
+        return None
+
+
+def image_is_up_to_date(image):
+    """True when the local image digest already matches the registry."""
+    local = local_image_digests(image)
+    if not local:
+        return False
+    remote = remote_image_digest(image)
+    return remote is not None and remote in local
+
+
+def pull_image(image, retries=3, delay_seconds=3, skip_up_to_date=True, log=print):
+    """Pull one image with exponential backoff; returns its status, attempts and elapsed seconds."""
+    started = time.monotonic()
+    if skip_up_to_date and image_is_up_to_date(image):
+        return {"image": image, "status": "up-to-date", "attempts": 0,
+                "seconds": time.monotonic() - started}
 
     for attempt in range(1, retries + 1):
-        print(
-            f"Pulling services {', '.join(services)} "
-            f"(attempt {attempt}/{retries})..."
+        result = run_process(
+            ["docker", "pull", "--quiet", image],
+            capture_output=True, text=True, check=False,
         )
-        cmd = compose_base_command(profile=profile, environment=environment)
-        cmd.extend(["pull", *services])
-        result = subprocess.run(cmd, check=False)
         if result.returncode == 0:
-            print("Successfully pulled update services.")
-            return
-
+            return {"image": image, "status": "pulled", "attempts": attempt,
+                    "seconds": time.monotonic() - started}
+        error = (result.stderr or result.stdout).strip().splitlines()
+        reason = error[-1] if error else f"exit code {result.returncode}"
         if attempt < retries:
-            print(f"Pull failed. Retrying in {delay_seconds} seconds...")
-            time.sleep(delay_seconds)
+            backoff = delay_seconds * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+            log(f"  {image}: pull failed ({reason}); retrying in {backoff:.1f}s "
+                f"(attempt {attempt}/{retries})")
+            time.sleep(backoff)
+        else:
+            log(f"  {image}: pull failed ({reason})")
+
+    return {"image": image, "status": "failed", "attempts": retries,
+            "seconds": time.monotonic() - started}
+
+
+def pull_images_parallel(images, parallelism=4, retries=3, delay_seconds=3, skip_up_to_date=True):
+    """Pull ``images`` concurrently, each retried on its own; raises RuntimeError naming any that failed."""
+    images = list(dict.fromkeys(images))
+    if not images:
+        return []
+
+    lock = threading.Lock()
+
+    def log(message):
+        with lock:
+            print(message, flush=True)
+
+    log(f"Pulling {len(images)} image(s) with up to {parallelism} in parallel...")
+    started = time.monotonic()
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        futures = [
+            pool.submit(pull_image, image, retries, delay_seconds, skip_up_to_date, log)
+            for image in images
+        ]
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            log(f"[{done}/{len(images)}] {result['image']}: {result['status']} "
+                f"in {result['seconds']:.1f}s")
+
+    print_pull_summary(results, time.monotonic() - started)
+    failed = [result["image"] for result in results if result["status"] == "failed"]
+    if failed:
+        raise RuntimeError(f"Failed to pull images {', '.join(failed)} after {retries} attempts.")
+    return results
+
+
+def print_pull_summary(results, elapsed):
+    width = max(len(result["image"]) for result in results)
+    print(f"{'IMAGE':<{width}}  {'STATUS':<10}  {'ATTEMPTS':>8}  {'SECONDS':>8}")
+    for result in sorted(results, key=lambda r: -r["seconds"]):
+        print(f"{result['image']:<{width}}  {result['status']:<10}  "
+              f"{result['attempts']:>8}  {result['seconds']:>8.1f}")
+    serial = sum(result["seconds"] for result in results)
+    print(f"Pulled in {elapsed:.1f}s wall time ({serial:.1f}s if pulled one at a time).")
+
+
+def pull_services_with_retry(profile=None, environment=None, services=None, retries=3, delay_seconds=3,
+                             parallelism=4):
+    """Pull the images of Compose services (and their dependencies) in parallel."""
+    services = services or []
+    if not services:
+        return
 
-    raise RuntimeError(
-        f"Failed to pull services {', '.join(services)} after {retries} attempts."
+    print(f"Resolving images for services {', '.join(services)}...")
+    config = load_compose_config(profile=profile, environment=environment)
+    images = resolve_service_images(config, services)
+    pull_images_parallel(
+        images.values(), parallelism=parallelism, retries=retries, delay_seconds=delay_seconds
     )
+    print("Successfully pulled update services.")
+
 
+def pull_all_images(profile=None, environment=None, parallelism=4):
+    """Pull every image the selected profile needs before starting the stack."""
+    config = load_compose_config(profile=profile, environment=environment)
+    pull_images_parallel(resolve_service_images(config).values(), parallelism=parallelism)
 
-def update_ollama_and_openwebui_images(profile=None, environment=None):
+
+def update_ollama_and_openwebui_images(profile=None, environment=None, parallelism=4):
     """Pull fresh, Compose-compatible Ollama and Open WebUI images."""
     print("Updating Ollama and Open WebUI images...")
-    services = get_update_services(profile)
-    pull_services_with_retry(profile=profile, environment=environment, services=services)
+    services = get_update_services(profile, environment)
+    pull_services_with_retry(
+        profile=profile, environment=environment, services=services, parallelism=parallelism
+    )
+
+
+IMAGE_BUNDLE_ARCHIVE = "images.tar.gz"
+IMAGE_BUNDLE_MANIFEST = "manifest.json"
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+
+class _HashingFile:
+    """File wrapper that hashes and counts the bytes passing through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def _read_bundle_manifest(bundle_dir):
+    try:
+        with open(os.path.join(bundle_dir, IMAGE_BUNDLE_MANIFEST)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(STREAM_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _bundle_image_ids(images, image_ids):
+    return {image: image_ids.get(normalize_image_ref(image)) for image in images}
+
+
+def export_images(bundle_dir, profile=None, environment=None, parallelism=4):
+    """Save every image of the resolved config into one gzipped bundle with a digest manifest."""
+    config = load_compose_config(profile=profile, environment=environment)
+    images = sorted(set(resolve_service_images(config).values()))
+    image_ids = local_image_ids()
+    missing = [image for image in images if normalize_image_ref(image) not in image_ids]
+    if missing:
+        print(f"{len(missing)} image(s) are not available locally; pulling them first...")
+        pull_images_parallel(missing, parallelism=parallelism, skip_up_to_date=False)
+        image_ids = local_image_ids()
+
+    ids = _bundle_image_ids(images, image_ids)
+    archive_path = os.path.join(bundle_dir, IMAGE_BUNDLE_ARCHIVE)
+    previous = _read_bundle_manifest(bundle_dir)
+    if (previous and os.path.exists(archive_path)
+            and {entry["ref"]: entry["id"] for entry in previous.get("images", [])} == ids):
+        print(f"Image bundle in {bundle_dir} is already up to date ({len(images)} images).")
+        return previous
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    partial_path = archive_path + ".partial"
+    print(f"Exporting {len(images)} image(s) to {archive_path}...")
+    started = time.monotonic()
+    cmd = ["docker", "save", *images]
+    with TRACER.span(command_label(cmd), "subprocess", command=" ".join(cmd)) as attributes:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        uncompressed = 0
+        try:
+            with open(partial_path, "wb") as raw:
+                hashed = _HashingFile(raw)
+                with gzip.GzipFile(fileobj=hashed, mode="wb", compresslevel=1, mtime=0) as archive:
+                    for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_BYTES), b""):
+                        uncompressed += len(chunk)
+                        archive.write(chunk)
+            stderr = process.communicate()[1]
+            attributes.update(exit_code=process.returncode, output_bytes=uncompressed)
+            if process.returncode != 0:
+                raise RuntimeError(f"docker save failed: {stderr.decode('utf-8', 'replace').strip()}")
+            os.replace(partial_path, archive_path)
+        except BaseException:
+            process.kill()
+            process.wait()
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+            raise
+
+    manifest = {
+        "format": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "profile": profile,
+        "environment": environment,
+        "archive": {
+            "file": IMAGE_BUNDLE_ARCHIVE,
+            "sha256": hashed.sha256.hexdigest(),
+            "bytes": hashed.bytes,
+            "uncompressed_bytes": uncompressed,
+        },
+        "images": [{"ref": image, "id": ids[image]} for image in images],
+    }
+    write_json_atomic(manifest, os.path.join(bundle_dir, IMAGE_BUNDLE_MANIFEST))
+    print(f"Exported {uncompressed / 1e9:.2f} GB of image data as {hashed.bytes / 1e9:.2f} GB "
+          f"in {time.monotonic() - started:.1f}s.")
+    return manifest
+
+
+def import_images(bundle_dir):
+    """Load a bundle written by export_images once its digest checks out; True when all images are present."""
+    manifest = _read_bundle_manifest(bundle_dir)
+    if not manifest:
+        print(f"Error: no readable {IMAGE_BUNDLE_MANIFEST} in {bundle_dir}")
+        return False
+    wanted = {entry["ref"]: entry["id"] for entry in manifest["images"]}
+    present = _bundle_image_ids(wanted, local_image_ids())
+    missing = [image for image, image_id in wanted.items() if present[image] != image_id]
+    if not missing:
+        print(f"All {len(wanted)} bundled images are already loaded.")
+        return True
+
+    archive_path = os.path.join(bundle_dir, manifest["archive"]["file"])
+    started = time.monotonic()
+    print(f"Verifying {archive_path}...")
+    try:
+        digest = _file_sha256(archive_path)
+    except OSError as e:
+        print(f"Error: could not read {archive_path}: {e}")
+        return False
+    if digest != manifest["archive"]["sha256"]:
+        print(f"Error: {archive_path} does not match the digest in its manifest; the bundle is corrupt.")
+        return False
+
+    print(f"Importing {len(missing)} of {len(wanted)} image(s) from {archive_path}...")
+    cmd = ["docker", "load"]
+    with TRACER.span(command_label(cmd), "subprocess", command=" ".join(cmd)) as attributes:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with gzip.open(archive_path, "rb") as archive:
+                for chunk in iter(lambda: archive.read(STREAM_CHUNK_BYTES), b""):
+                    process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except (OSError, EOFError) as e:
+            process.kill()
+            process.wait()
+            print(f"Error: could not read {archive_path}: {e}")
+            return False
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        stdout, stderr = process.stdout.read(), process.stderr.read()
+        process.wait()
+        attributes.update(exit_code=process.returncode, output_bytes=len(stdout) + len(stderr))
+
+    if process.returncode != 0:
+        print(f"Error: docker load failed: {stderr.decode('utf-8', 'replace').strip()}")
+        return False
+
+    present = _bundle_image_ids(wanted, local_image_ids())
+    still_missing = [image for image, image_id in wanted.items() if present[image] != image_id]
+    for image in still_missing:
+        print(f"  {image}: not available after import")
+    print(f"Imported bundle in {time.monotonic() - started:.1f}s.")
+    return not still_missing
 
 
 def verify_compose_configuration(profile=None, environment=None):
     """Validate Docker Compose configuration before deployment actions."""
     print("Verifying Docker Compose configuration...")
-    cmd = compose_base_command(profile=profile, environment=environment)
-    cmd.extend(["config", "-q"])
-    run_command(cmd)
+    try:
+        load_compose_config(profile=profile, environment=environment)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr or e.stdout)
+        raise
 
 
 def stop_existing_containers(profile=None, environment=None):
@@ -104,84 +655,1229 @@ def start_local_ai(profile=None, environment=None):
     run_command(cmd)
 
 
-def refresh_running_ollama_and_openwebui(profile=None, environment=None):
+def refresh_running_ollama_and_openwebui(profile=None, environment=None, parallelism=4):
     """Update running Ollama/Open WebUI containers with latest images."""
     print("Refreshing running Ollama and Open WebUI services...")
-    services = get_update_services(profile)
-    update_ollama_and_openwebui_images(profile=profile, environment=environment)
+    services = get_update_services(profile, environment)
+    update_ollama_and_openwebui_images(
+        profile=profile, environment=environment, parallelism=parallelism
+    )
 
     cmd = compose_base_command(profile=profile, environment=environment)
     cmd.extend(["up", "-d", "--no-deps", "--force-recreate", *services])
     run_command(cmd)
 
 
-def generate_searxng_secret_key():
-    """Generate a secret key for SearXNG based on the current platform."""
-    print("Checking SearXNG settings...")
+DEPLOY_STATE_FILE = ".localai-deploy-state.json"
 
-    settings_path = os.path.join("searxng", "settings.yml")
-    settings_base_path = os.path.join("searxng", "settings-base.yml")
 
-    if not os.path.exists(settings_base_path):
-        print(f"Warning: SearXNG base settings file not found at {settings_base_path}")
-        return
+def normalize_image_ref(image):
+    """Normalize an image reference the way ``docker images`` lists it."""
+    for prefix in ("docker.io/library/", "docker.io/"):
+        if image.startswith(prefix):
+            image = image[len(prefix):]
+            break
+    if "@" not in image and ":" not in image.rsplit("/", 1)[-1]:
+        image += ":latest"
+    return image
 
-    if not os.path.exists(settings_path):
-        print(f"SearXNG settings.yml not found. Creating from {settings_base_path}...")
-        try:
-            shutil.copyfile(settings_base_path, settings_path)
-            print(f"Created {settings_path} from {settings_base_path}")
-        except Exception as e:
-            print(f"Error creating settings.yml: {e}")
-            return
+
+def local_image_ids():
+    """Map locally available ``repository:tag`` references to image IDs."""
+    result = run_process(
+        ["docker", "images", "--no-trunc", "--format", "{{.Repository}}:{{.Tag}} {{.ID}}"],
+        capture_output=True, text=True, check=False,
+    )
+    if result.returncode != 0:
+        return {}
+    ids = {}
+    for line in result.stdout.splitlines():
+        ref, _, image_id = line.strip().partition(" ")
+        if image_id and not ref.endswith(":<none>"):
+            ids[ref] = image_id
+    return ids
+
+
+def service_config_hashes(config, image_ids=None):
+    """Hash each service's resolved config plus the ID of its local image."""
+    image_ids = image_ids or {}
+    hashes = {}
+    for service, definition in config.get("services", {}).items():
+        image = definition.get("image")
+        material = {
+            "config": definition,
+            "image_id": image_ids.get(normalize_image_ref(image)) if image else None,
+        }
+        encoded = json.dumps(material, sort_keys=True, separators=(",", ":"))
+        hashes[service] = hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+    return hashes
+
+
+def service_dependents(config, services):
+    """Return ``services`` plus every service that transitively depends on them."""
+    dependents = {}
+    for service in config.get("services", {}):
+        for dependency in service_dependencies(config, service):
+            dependents.setdefault(dependency, set()).add(service)
+
+    affected = set()
+    pending = list(services)
+    while pending:
+        service = pending.pop()
+        if service not in affected:
+            affected.add(service)
+            pending.extend(dependents.get(service, ()))
+    return affected
+
+
+def load_deploy_state(path=DEPLOY_STATE_FILE):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_incremental_deploy(config, previous_hashes, image_ids=None):
+    """Return ``(hashes, recreate, removed)``: new hashes, changed services plus dependents, removed ones."""
+    hashes = service_config_hashes(config, image_ids)
+    previous_hashes = previous_hashes or {}
+    changed = [service for service, digest in hashes.items() if previous_hashes.get(service) != digest]
+    removed = sorted(set(previous_hashes) - set(hashes))
+    recreate = sorted(service_dependents(config, changed) & set(hashes))
+    return hashes, recreate, removed
+
+
+def record_deploy_state(profile=None, environment=None, config=None, path=DEPLOY_STATE_FILE):
+    """Store the hashes of what is now deployed, as the baseline for --incremental."""
+    try:
+        config = config or load_compose_config(profile=profile, environment=environment)
+        hashes = service_config_hashes(config, local_image_ids())
+        write_json_atomic(
+            {"profile": profile, "environment": environment, "services": hashes}, path
+        )
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print(f"Warning: could not record deploy state for --incremental: {e}")
+
+
+def incremental_deploy(profile=None, environment=None, path=DEPLOY_STATE_FILE):
+    """Recreate only changed services (and their dependents), leaving the rest running."""
+    print("Planning incremental deploy...")
+    started = time.monotonic()
+    config = load_compose_config(profile=profile, environment=environment)
+    state = load_deploy_state(path) or {}
+    hashes, recreate, removed = plan_incremental_deploy(
+        config, state.get("services"), local_image_ids()
+    )
+
+    if not state:
+        print(f"No deploy state at {path}; starting all services without recreating running ones.")
+        recreate = []
+    elif recreate:
+        print(f"Recreating changed services: {', '.join(recreate)}")
+        cmd = compose_base_command(profile=profile, environment=environment)
+        cmd.extend(["up", "-d", "--no-deps", "--force-recreate", *recreate])
+        run_command(cmd)
     else:
-        print(f"SearXNG settings.yml already exists at {settings_path}")
+        print("No service configuration changed.")
+    if removed:
+        print(f"Removing services no longer defined: {', '.join(removed)}")
 
-    print("Generating SearXNG secret key...")
+    # Starts anything missing or stopped and removes orphans, but never
+    # touches containers that are already running with the current config.
+    cmd = compose_base_command(profile=profile, environment=environment)
+    cmd.extend(["up", "-d", "--no-recreate", "--remove-orphans"])
+    run_command(cmd)
+
+    write_json_atomic({"profile": profile, "environment": environment, "services": hashes}, path)
+    print(f"Incremental deploy finished in {time.monotonic() - started:.1f}s "
+          f"({len(recreate)} of {len(hashes)} services recreated).")
+
+
+# Readiness probes for services without a Compose healthcheck:
+# (kind, container port, HTTP path).
+SERVICE_PROBES = {
+    "n8n": ("http", 5678, "/healthz"),
+    "open-webui": ("http", 8080, "/health"),
+    "flowise": ("http", 3001, "/api/v1/ping"),
+    "qdrant": ("http", 6333, "/readyz"),
+    "neo4j": ("http", 7474, "/"),
+    "langfuse-worker": ("http", 3030, "/api/health"),
+    "langfuse-web": ("http", 3000, "/api/public/health"),
+    "searxng": ("http", 8080, "/healthz"),
+    "ollama-cpu": ("http", 11434, "/api/version"),
+    "ollama-gpu": ("http", 11434, "/api/version"),
+    "ollama-gpu-amd": ("http", 11434, "/api/version"),
+    "caddy": ("tcp", 80, None),
+}
+
+
+def compose_containers(profile=None, environment=None):
+    """Return ``docker compose ps`` state keyed by service name."""
+    cmd = compose_base_command(profile=profile, environment=environment)
+    cmd.extend(["ps", "--all", "--format", "json"])
+    result = run_process(cmd, capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        return {}
+    output = result.stdout.strip()
+    if output.startswith("["):
+        entries = json.loads(output)
+    else:
+        # Newer Compose releases print one JSON object per line.
+        entries = [json.loads(line) for line in output.splitlines() if line.strip()]
+    return {entry.get("Service"): entry for entry in entries}
 
-    system = platform.system()
 
+def published_port(container, target_port):
+    """Host port a container port is published on, or None."""
+    for publisher in container.get("Publishers") or []:
+        if publisher.get("TargetPort") == target_port and publisher.get("PublishedPort"):
+            return publisher["PublishedPort"]
+    return None
+
+
+def probe_endpoint(kind, port, path=None, timeout=2):
+    """True when an HTTP endpoint answers below 500, or a TCP port accepts."""
     try:
-        if system == "Windows":
-            print("Detected Windows platform, using PowerShell to generate secret key...")
-            ps_command = [
-                "powershell", "-Command",
-                "$randomBytes = New-Object byte[] 32; " +
-                "(New-Object Security.Cryptography.RNGCryptoServiceProvider).GetBytes($randomBytes); " +
-                "$secretKey = -join ($randomBytes | ForEach-Object { \"{0:x2}\" -f $_ }); " +
-                "(Get-Content searxng/settings.yml) -replace 'ultrasecretkey', $secretKey | Set-Content searxng/settings.yml"
-            ]
-            subprocess.run(ps_command, check=True)
+        if kind == "tcp":
+            with socket.create_connection(("127.0.0.1", port), timeout=timeout):
+                return True
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as response:
+            return response.status < 500
+    except urllib.error.HTTPError as e:
+        return e.code < 500
+    except (OSError, ValueError):
+        return False
+
+
+def check_service_ready(service, container):
+    """Return ``(state, check)``: ready, unprobed, completed, failed or waiting, and the signal used."""
+    if not container:
+        return "waiting", "container"
+    state = container.get("State", "")
+    if state == "exited":
+        return ("completed" if container.get("ExitCode") == 0 else "failed"), "exit code"
+    health = container.get("Health", "")
+    if health:
+        return ("ready" if health == "healthy" else "waiting"), "healthcheck"
+    if state != "running":
+        return "waiting", "container"
+
+    kind, target_port, path = SERVICE_PROBES.get(service, (None, None, None))
+    port = published_port(container, target_port) if kind else None
+    if port is None:
+        # Nothing reachable from the host to probe; running is all that is known.
+        return "unprobed", "running"
+    return ("ready" if probe_endpoint(kind, port, path) else "waiting"), kind
+
+
+def wait_for_services(profile=None, environment=None, services=None, timeout=300, interval=2):
+    """Poll every service concurrently until all are ready or ``timeout`` passes; prints a time-to-ready table."""
+    if services is None:
+        services = list(load_compose_config(profile=profile, environment=environment).get("services", {}))
+    print(f"Waiting up to {timeout}s for {len(services)} services to become ready...")
+    started = time.monotonic()
+    deadline = started + timeout
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(services))) as pool:
+        while True:
+            pending = [service for service in services if service not in results]
+            containers = compose_containers(profile=profile, environment=environment)
+            checks = pool.map(lambda service: check_service_ready(service, containers.get(service)), pending)
+            for service, (state, check) in zip(pending, checks):
+                if state != "waiting":
+                    elapsed = time.monotonic() - started
+                    results[service] = (state, check, elapsed)
+                    print(f"  {service}: {state} after {elapsed:.1f}s ({check})")
+            if len(results) == len(services) or time.monotonic() >= deadline:
+                break
+            time.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+
+    for service in services:
+        results.setdefault(service, ("timeout", "-", None))
+    print_readiness_table(results)
+    unprobed = [service for service, (state, _, _) in results.items() if state == "unprobed"]
+    if unprobed:
+        print(f"Running but not probed (no healthcheck or published port): {', '.join(unprobed)}")
+    return all(state in ("ready", "completed", "unprobed") for state, _, _ in results.values())
+
+
+def print_readiness_table(results):
+    width = max(len("SERVICE"), *(len(service) for service in results))
+    labels = {service: "running (unprobed)" if state == "unprobed" else state
+              for service, (state, _, _) in results.items()}
+    status_width = max(len("STATUS"), *(len(label) for label in labels.values()))
+    print(f"{'SERVICE':<{width}}  {'STATUS':<{status_width}}  {'CHECK':<11}  {'SECONDS':>7}")
+    ordered = sorted(results.items(), key=lambda item: -(item[1][2] if item[1][2] is not None else float("inf")))
+    for service, (state, check, elapsed) in ordered:
+        seconds = f"{elapsed:.1f}" if elapsed is not None else "-"
+        print(f"{service:<{width}}  {labels[service]:<{status_width}}  {check:<11}  {seconds:>7}")
+
+
+DEFAULT_WARM_MODELS = "qwen2.5:7b-instruct-q4_K_M,nomic-embed-text"
+
+
+def ollama_request(base_url, path, payload=None, timeout=600):
+    """Call the Ollama API and return the decoded JSON response."""
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(
+        base_url.rstrip("/") + path, data=data, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read() or b"{}")
+
+
+def meminfo_bytes(field):
+    """A field such as MemAvailable from /proc/meminfo, or None where it cannot be read."""
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
 
-        elif system == "Darwin":
-            print("Detected macOS platform, using sed command with empty string parameter...")
-            openssl_cmd = ["openssl", "rand", "-hex", "32"]
-            random_key = subprocess.check_output(openssl_cmd).decode('utf-8').strip()
-            sed_cmd = ["sed", "-i", "", f"s|ultrasecretkey|{random_key}|g", settings_path]
-            subprocess.run(sed_cmd, check=True)
+def available_memory_bytes():
+    """MemAvailable from /proc/meminfo, or None where it cannot be read."""
+    return meminfo_bytes("MemAvailable")
 
+
+def gpu_memory_bytes(profile):
+    """Free VRAM summed over the GPUs ``profile`` uses, or None where it cannot be read."""
+    if profile == "gpu-nvidia":
+        try:
+            result = run_process(["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"],
+                                 capture_output=True, text=True, check=False)
+            if result.returncode == 0:
+                return sum(int(line) for line in result.stdout.split()) * 1024 * 1024 or None
+        except (OSError, ValueError):
+            pass
+        return None
+    if profile == "gpu-amd":
+        free = 0
+        drm = "/sys/class/drm"
+        for card in sorted(os.listdir(drm)) if os.path.isdir(drm) else []:
+            device = os.path.join(drm, card, "device")
+            try:
+                with open(os.path.join(device, "mem_info_vram_total")) as total, \
+                        open(os.path.join(device, "mem_info_vram_used")) as used:
+                    free += int(total.read()) - int(used.read())
+            except (OSError, ValueError):
+                continue
+        return free or None
+    return None
+
+
+def model_memory_budget(profile=None):
+    """Memory models load into: VRAM on the GPU profiles, MemAvailable otherwise."""
+    if profile in ("gpu-nvidia", "gpu-amd"):
+        return gpu_memory_bytes(profile)
+    return available_memory_bytes()
+
+
+def ollama_pull_running():
+    """True while an ollama-pull container is still downloading models."""
+    try:
+        result = run_process(["docker", "ps", "--quiet", "--filter", "name=ollama-pull", "--filter", "status=running"],
+                             capture_output=True, text=True, check=False)
+    except OSError:
+        return False
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def warm_model(base_url, model, keep_alive="24h", deadline=None, pulling=None):
+    """Load ``model`` and pin it for ``keep_alive``, retrying transient failures until ``deadline``."""
+    started = time.monotonic()
+    endpoints = [
+        ("/api/generate", {"model": model, "prompt": "", "keep_alive": keep_alive}),
+        ("/api/embed", {"model": model, "input": "", "keep_alive": keep_alive}),
+    ]
+    last_error = None
+    while True:
+        retry = False
+        for path, payload in endpoints:
+            try:
+                ollama_request(base_url, path, payload)
+                return {"model": model, "status": "loaded", "seconds": time.monotonic() - started}
+            except urllib.error.HTTPError as e:
+                last_error = f"HTTP {e.code}"
+                if e.code == 400:
+                    continue
+                # A model that is still being pulled answers 404; anything else will not fix itself.
+                retry = e.code == 404 and pulling is not None and pulling()
+                break
+            except (OSError, ValueError) as e:
+                last_error = str(e)
+                retry = True
+                break
+        if not retry or deadline is None or time.monotonic() >= deadline:
+            return {"model": model, "status": f"failed ({last_error})",
+                    "seconds": time.monotonic() - started}
+        time.sleep(min(5, max(0.0, deadline - time.monotonic())))
+
+
+def warm_ollama_models(models, base_url="http://127.0.0.1:11434", keep_alive="24h",
+                       max_parallel=2, memory_budget=None, timeout=900, profile=None):
+    """Warm several models concurrently, largest first, within ``memory_budget`` and ``max_parallel`` loads."""
+    models = [model for model in dict.fromkeys(models) if model]
+    if not models:
+        return []
+    deadline = time.monotonic() + timeout
+    print(f"Warming Ollama models: {', '.join(models)}...")
+    while True:
+        try:
+            ollama_request(base_url, "/api/version", timeout=5)
+            break
+        except (OSError, ValueError):
+            if time.monotonic() >= deadline:
+                print(f"Ollama at {base_url} did not respond; skipping model warm-up.")
+                return []
+            time.sleep(2)
+
+    try:
+        installed = ollama_request(base_url, "/api/tags", timeout=10).get("models", [])
+    except (OSError, ValueError):
+        installed = None
+    sizes = {entry.get("name"): entry.get("size", 0) for entry in installed or []}
+    missing = [model for model in models if model not in sizes and f"{model}:latest" not in sizes]
+    skipped = []
+    if installed is not None and missing and not ollama_pull_running():
+        skipped = [{"model": model, "status": "not installed", "seconds": 0.0, "size": 0} for model in missing]
+        models = [model for model in models if model not in missing]
+        print(f"  Not installed and no ollama-pull is running: {', '.join(missing)}")
+    size_of = {model: sizes.get(model, sizes.get(f"{model}:latest", 0)) for model in models}
+    if memory_budget is None:
+        memory_budget = model_memory_budget(profile)
+
+    condition = threading.Condition()
+    in_flight = {"count": 0, "bytes": 0}
+
+    def fits(size):
+        if in_flight["count"] == 0:
+            return True
+        if in_flight["count"] >= max(1, max_parallel):
+            return False
+        return memory_budget is None or in_flight["bytes"] + size <= memory_budget
+
+    def load(model):
+        size = size_of[model]
+        with condition:
+            condition.wait_for(lambda: fits(size))
+            in_flight["count"] += 1
+            in_flight["bytes"] += size
+        try:
+            result = warm_model(base_url, model, keep_alive, deadline, pulling=ollama_pull_running)
+        finally:
+            with condition:
+                in_flight["count"] -= 1
+                in_flight["bytes"] -= size
+                condition.notify_all()
+        result["size"] = size
+        print(f"  {model}: {result['status']} in {result['seconds']:.1f}s", flush=True)
+        return result
+
+    ordered = sorted(models, key=lambda model: -size_of[model])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(ordered))) as pool:
+        results = list(pool.map(load, ordered)) + skipped
+
+    width = max(len("MODEL"), *(len(result["model"]) for result in results))
+    print(f"{'MODEL':<{width}}  {'SIZE_GB':>7}  {'SECONDS':>7}  STATUS")
+    for result in results:
+        print(f"{result['model']:<{width}}  {result['size'] / 1e9:>7.1f}  "
+              f"{result['seconds']:>7.1f}  {result['status']}")
+    return results
+
+
+PROVISION_STATE_FILE = ".localai-provision-state.json"
+# (service, kind, directory) of the exported workflows and tools --provision imports.
+PROVISION_SOURCES = (
+    ("n8n", "workflows", os.path.join("n8n", "backup", "workflows")),
+    ("n8n", "workflows", "n8n-tool-workflows"),
+    ("flowise", "tools", "flowise"),
+    ("flowise", "chatflows", "flowise"),
+)
+PROVISION_ENDPOINTS = {
+    ("n8n", "workflows"): "/api/v1/workflows",
+    ("flowise", "chatflows"): "/api/v1/chatflows",
+    ("flowise", "tools"): "/api/v1/tools",
+}
+# Fields the n8n public API and Flowise accept on create/update.
+N8N_WORKFLOW_FIELDS = ("name", "nodes", "connections", "settings")
+FLOWISE_TOOL_FIELDS = ("name", "description", "color", "iconSrc", "schema", "func")
+PROVISION_SYMBOLS = {"create": "+", "update": "~", "exists": "=", "unchanged": "="}
+
+
+def api_request(method, url, payload=None, headers=None, timeout=30):
+    """Send a JSON request and return the decoded response (None when empty)."""
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(
+        url, data=data, method=method,
+        headers={"Content-Type": "application/json", "Accept": "application/json", **(headers or {})},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+    return json.loads(body) if body else None
+
+
+def env_setting(name, env_path=".env"):
+    """A setting from the process environment, falling back to the .env file."""
+    if os.environ.get(name):
+        return os.environ[name]
+    try:
+        with open(env_path) as file:
+            content = file.read()
+    except OSError:
+        return None
+    for match in _ENV_LINE.finditer(content):
+        if match.group("key") == name:
+            return match.group("value").strip().strip("\"'") or None
+    return None
+
+
+def provision_headers(service, env_path=".env"):
+    """Auth headers for ``service``'s API, or None when n8n has no API key configured."""
+    if service == "n8n":
+        api_key = env_setting("N8N_API_KEY", env_path)
+        return {"X-N8N-API-KEY": api_key} if api_key else None
+    api_key = env_setting("FLOWISE_API_KEY", env_path)
+    if api_key:
+        return {"Authorization": f"Bearer {api_key}"}
+    username = env_setting("FLOWISE_USERNAME", env_path)
+    password = env_setting("FLOWISE_PASSWORD", env_path)
+    if username and password:
+        token = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+        return {"Authorization": f"Basic {token}"}
+    return {}
+
+
+def provision_payload(kind, path):
+    """The API request body for the export at ``path``."""
+    with open(path, encoding="utf-8") as file:
+        data = json.load(file)
+    if kind == "workflows":
+        payload = {field: data[field] for field in N8N_WORKFLOW_FIELDS if field in data}
+        payload.setdefault("settings", {})
+        return payload
+    if kind == "tools":
+        return {field: data[field] for field in FLOWISE_TOOL_FIELDS if field in data}
+    return {
+        "name": os.path.splitext(os.path.basename(path))[0],
+        "flowData": json.dumps(data, separators=(",", ":"), sort_keys=True),
+        "type": "CHATFLOW",
+    }
+
+
+def content_hash(payload):
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def collect_provision_items(root="."):
+    """Every importable export in the repo, with its payload and content hash."""
+    items = []
+    seen = set()
+    for service, kind, directory in PROVISION_SOURCES:
+        try:
+            names = sorted(name for name in os.listdir(os.path.join(root, directory)) if name.endswith(".json"))
+        except OSError:
+            continue
+        for name in names:
+            if service == "flowise" and name.endswith("-CustomTool.json") != (kind == "tools"):
+                continue
+            path = os.path.join(root, directory, name)
+            try:
+                payload = provision_payload(kind, path)
+            except (OSError, ValueError) as e:
+                print(f"Warning: skipping {path}: {e}")
+                continue
+            key = (service, kind, payload.get("name"))
+            if not payload.get("name") or key in seen:
+                print(f"Warning: skipping {path}: missing or duplicate {kind} name")
+                continue
+            seen.add(key)
+            items.append({"service": service, "kind": kind, "name": payload["name"], "path": path,
+                          "payload": payload, "sha256": content_hash(payload)})
+    return items
+
+
+def list_remote(base_url, service, kind, headers, timeout=30):
+    """Everything of ``kind`` that already exists in ``service``."""
+    url = base_url.rstrip("/") + PROVISION_ENDPOINTS[(service, kind)]
+    if service != "n8n":
+        return api_request("GET", url, headers=headers, timeout=timeout) or []
+    results, cursor = [], None
+    while True:
+        query = "?limit=250" + (f"&cursor={urllib.parse.quote(cursor)}" if cursor else "")
+        page = api_request("GET", url + query, headers=headers, timeout=timeout) or {}
+        results.extend(page.get("data", []))
+        cursor = page.get("nextCursor")
+        if not cursor:
+            return results
+
+
+def wait_for_remote(base_url, service, kind, headers, timeout=120, interval=2):
+    """list_remote() once the API answers; auth errors are raised straight away."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return list_remote(base_url, service, kind, headers)
+        except urllib.error.HTTPError as e:
+            if e.code in (401, 403) or time.monotonic() >= deadline:
+                raise
+        except (urllib.error.URLError, OSError, ValueError):
+            if time.monotonic() >= deadline:
+                raise
+        time.sleep(interval)
+
+
+def plan_provisioning(items, remote, state):
+    """Decide per item whether to create, update or leave it, matching remote objects by name."""
+    plan = []
+    for item in items:
+        existing = remote.get((item["service"], item["kind"]), {}).get(item["name"])
+        record = state.get(f"{item['service']}/{item['kind']}", {}).get(item["name"])
+        if existing is None:
+            action = "create"
+        elif not record or record.get("id") != existing.get("id"):
+            action = "exists"
+        elif record.get("sha256") == item["sha256"]:
+            action = "unchanged"
         else:
-            print("Detected Linux/Unix platform, using standard sed command...")
-            openssl_cmd = ["openssl", "rand", "-hex", "32"]
-            random_key = subprocess.check_output(openssl_cmd).decode('utf-8').strip()
-            sed_cmd = ["sed", "-i", f"s|ultrasecretkey|{random_key}|g", settings_path]
-            subprocess.run(sed_cmd, check=True)
+            action = "update"
+        plan.append({"action": action, "item": item, "remote": existing})
+    return plan
 
-        print("SearXNG secret key generated successfully.")
 
-    except Exception as e:
-        print(f"Error generating SearXNG secret key: {e}")
-        print("You may need to manually generate the secret key using the commands:")
-        print("  - Linux: sed -i \"s|ultrasecretkey|$(openssl rand -hex 32)|g\" searxng/settings.yml")
-        print("  - macOS: sed -i '' \"s|ultrasecretkey|$(openssl rand -hex 32)|g\" searxng/settings.yml")
-        print("  - Windows (PowerShell):")
-        print("    $randomBytes = New-Object byte[] 32")
-        print("    (New-Object Security.Cryptography.RNGCryptoServiceProvider).GetBytes($randomBytes)")
-        print("    $secretKey = -join ($randomBytes | ForEach-Object { \"{0:x2}\" -f $_ })")
-        print("    (Get-Content searxng/settings.yml) -replace 'ultrasecretkey', $secretKey | Set-Content searxng/settings.yml")
-
-
-def check_and_fix_docker_compose_for_searxng():
+def _comparable(kind, payload):
+    fields = {"workflows": N8N_WORKFLOW_FIELDS, "tools": FLOWISE_TOOL_FIELDS}.get(kind, ("name", "flowData"))
+    data = {field: payload[field] for field in fields if field in payload}
+    if kind == "chatflows" and isinstance(data.get("flowData"), str):
+        try:
+            data["flowData"] = json.loads(data["flowData"])
+        except ValueError:
+            pass
+    return json.dumps(data, indent=2, sort_keys=True).splitlines()
+
+
+def provision_diff(step, max_lines=40):
+    """Unified diff between what the service has and what would be sent."""
+    item = step["item"]
+    before = _comparable(item["kind"], step["remote"]) if step["remote"] else []
+    lines = list(difflib.unified_diff(before, _comparable(item["kind"], item["payload"]),
+                                      f"{item['service']}:{item['name']}", item["path"], lineterm="", n=1))
+    if len(lines) > max_lines:
+        lines = lines[:max_lines] + [f"... {len(lines) - max_lines} more lines"]
+    return lines
+
+
+def _apply_provision_step(step, base_url, headers, timeout):
+    item = step["item"]
+    url = base_url.rstrip("/") + PROVISION_ENDPOINTS[(item["service"], item["kind"])]
+    if step["action"] == "create":
+        result = api_request("POST", url, item["payload"], headers, timeout)
+    else:
+        result = api_request("PUT", f"{url}/{step['remote']['id']}", item["payload"], headers, timeout)
+    return (result or {}).get("id") or (step["remote"] or {}).get("id")
+
+
+def provision_services(base_urls, parallelism=4, dry_run=False, state_path=PROVISION_STATE_FILE,
+                       ready_timeout=120, root=".", env_path=".env", timeout=30):
+    """Import the repo's n8n workflows and Flowise chatflows/tools in bulk; returns the plan."""
+    state = load_deploy_state(state_path) or {}
+    items = collect_provision_items(root)
+    headers, remote = {}, {}
+    for service in sorted({item["service"] for item in items}):
+        headers[service] = provision_headers(service, env_path)
+        if headers[service] is None:
+            print(f"Skipping {service} provisioning: set N8N_API_KEY (n8n Settings > n8n API) to enable it.")
+            continue
+        for kind in sorted({item["kind"] for item in items if item["service"] == service}):
+            try:
+                existing = wait_for_remote(base_urls[service], service, kind, headers[service], ready_timeout)
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                print(f"Skipping {service} {kind}: {base_urls[service]} is not usable ({e})")
+                continue
+            remote[(service, kind)] = {}
+            for entry in existing:
+                remote[(service, kind)].setdefault(entry.get("name"), entry)
+    items = [item for item in items if (item["service"], item["kind"]) in remote]
+    plan = plan_provisioning(items, remote, state)
+
+    for step in plan:
+        item = step["item"]
+        print(f"{PROVISION_SYMBOLS[step['action']]} {item['service']} {item['kind'][:-1]} "
+              f"'{item['name']}' ({step['action']})")
+        if dry_run and step["action"] in ("create", "update"):
+            for line in provision_diff(step):
+                print(f"    {line}")
+    if dry_run:
+        return plan
+
+    started = time.monotonic()
+    pending = [step for step in plan if step["action"] in ("create", "update")]
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        futures = {
+            pool.submit(_apply_provision_step, step, base_urls[step["item"]["service"]],
+                        headers[step["item"]["service"]], timeout): step
+            for step in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            step = futures[future]
+            try:
+                step["id"] = future.result()
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                step["error"] = str(e)
+                failed += 1
+                print(f"  {step['item']['name']}: {step['action']} failed ({e})")
+
+    for step in plan:
+        item = step["item"]
+        remote_id = step.get("id") or (step["remote"] or {}).get("id")
+        if "error" not in step and remote_id:
+            state.setdefault(f"{item['service']}/{item['kind']}", {})[item["name"]] = {
+                "id": remote_id, "sha256": item["sha256"],
+            }
+    try:
+        write_json_atomic(state, state_path)
+    except OSError as e:
+        print(f"Warning: could not record provisioning state: {e}")
+
+    counts = {action: sum(1 for step in plan if step["action"] == action) for action in PROVISION_SYMBOLS}
+    print(f"Provisioned in {time.monotonic() - started:.1f}s: {counts['create']} created, "
+          f"{counts['update']} updated, {counts['unchanged'] + counts['exists']} already present, "
+          f"{failed} failed.")
+    return plan
+
+
+# Relative share of the host each heavy service gets under --profile auto.
+# "ollama" stands for whichever Ollama service the chosen profile runs.
+DEFAULT_RESOURCE_WEIGHTS = {
+    "ollama": 6,
+    "clickhouse": 2,
+    "neo4j": 2,
+    "langfuse-worker": 1,
+    "langfuse-web": 1,
+    "open-webui": 1,
+    "n8n": 1,
+    "flowise": 1,
+}
+OLLAMA_PROFILE_SERVICES = {"cpu": "ollama-cpu", "gpu-nvidia": "ollama-gpu", "gpu-amd": "ollama-gpu-amd"}
+# Left for the host and the small services without limits (Postgres, Redis, Caddy, ...).
+RESERVED_CPUS = 1.0
+RESERVED_MEMORY_FRACTION = 0.15
+MIN_SERVICE_MEMORY = 256 * 1024 * 1024
+MIB = 1024 * 1024
+
+
+def total_memory_bytes():
+    """Physical memory of the host, or None where it cannot be determined."""
+    total = meminfo_bytes("MemTotal")
+    if total is None:
+        try:
+            total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (AttributeError, ValueError, OSError):
+            return None
+    return total
+
+
+def detect_host(dev_dir="/dev"):
+    """Cores, memory and GPU vendor visible to Docker on this host."""
+    gpu = None
+    try:
+        devices = set(os.listdir(dev_dir))
+    except OSError:
+        devices = set()
+    if "nvidiactl" in devices or any(re.fullmatch(r"nvidia\d+", name) for name in devices):
+        gpu = "nvidia"
+    elif "kfd" in devices:
+        gpu = "amd"
+    return {"cpus": os.cpu_count() or 1, "memory_bytes": total_memory_bytes(), "gpu": gpu}
+
+
+def choose_profile(host):
+    """Compose profile for the detected hardware."""
+    return {"nvidia": "gpu-nvidia", "amd": "gpu-amd"}.get(host["gpu"], "cpu")
+
+
+def parse_resource_weights(spec):
+    """Merge a ``service=weight,...`` spec onto the defaults; weight 0 drops a service."""
+    weights = dict(DEFAULT_RESOURCE_WEIGHTS)
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, sep, value = item.partition("=")
+        try:
+            weight = float(value)
+        except ValueError:
+            weight = -1
+        if not sep or weight < 0:
+            raise ValueError(f"invalid resource weight {item!r}, expected service=weight")
+        weights[name.strip()] = weight
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def plan_resource_limits(host, profile, weights=None):
+    """Split the host's cores and memory (minus a reserve) across ``profile``'s services by weight."""
+    weights = dict(DEFAULT_RESOURCE_WEIGHTS if weights is None else weights)
+    ollama_weight = weights.pop("ollama", 0)
+    if profile in OLLAMA_PROFILE_SERVICES and ollama_weight:
+        weights[OLLAMA_PROFILE_SERVICES[profile]] = ollama_weight
+    total_weight = sum(weights.values())
+    if not total_weight or not host.get("memory_bytes"):
+        return {}
+
+    cpus = max(1.0, host["cpus"] - RESERVED_CPUS)
+    memory = host["memory_bytes"] * (1 - RESERVED_MEMORY_FRACTION)
+    plan = {}
+    for service, weight in weights.items():
+        share = weight / total_weight
+        plan[service] = {
+            "cpus": max(min(1.0, cpus), round(cpus * share, 2)),
+            "memory_bytes": max(MIN_SERVICE_MEMORY, int(memory * share) // MIB * MIB),
+        }
+    return plan
+
+
+def service_tuning(service, limits, profile):
+    """Environment that makes a service size itself to its limits."""
+    memory_mib = limits["memory_bytes"] // MIB
+    if service in OLLAMA_PROFILE_SERVICES.values():
+        if profile == "cpu":
+            # On CPU every parallel slot competes for the same cores.
+            parallel = max(1, min(4, int(limits["cpus"] // 4)))
+        else:
+            parallel = 4
+        return {
+            "OLLAMA_NUM_PARALLEL": str(parallel),
+            "OLLAMA_MAX_LOADED_MODELS": "2" if memory_mib >= 16 * 1024 else "1",
+        }
+    if service == "neo4j":
+        return {
+            "NEO4J_server_memory_heap_initial__size": f"{memory_mib * 2 // 5}m",
+            "NEO4J_server_memory_heap_max__size": f"{memory_mib * 2 // 5}m",
+            "NEO4J_server_memory_pagecache_size": f"{memory_mib * 7 // 20}m",
+        }
+    if service in ("langfuse-web", "langfuse-worker"):
+        return {"NODE_OPTIONS": f"--max-old-space-size={memory_mib * 3 // 4}"}
+    return {}
+
+
+def clickhouse_limits_xml(memory_bytes):
+    """ClickHouse server config capping memory use below the container limit."""
+    return (
+        "<!-- Generated by start_services.py --profile auto; edits are overwritten. -->\n"
+        "<clickhouse>\n"
+        f"    <max_server_memory_usage>{memory_bytes * 4 // 5}</max_server_memory_usage>\n"
+        f"    <mark_cache_size>{min(5 * 1024 * MIB, memory_bytes // 10)}</mark_cache_size>\n"
+        "</clickhouse>\n"
+    )
+
+
+def render_limits_override(plan, profile):
+    """Compose override content for ``plan``, written as JSON (which is valid YAML)."""
+    services = {}
+    for service, limits in sorted(plan.items()):
+        definition = {"cpus": limits["cpus"], "mem_limit": f"{limits['memory_bytes'] // MIB}m"}
+        environment = service_tuning(service, limits, profile)
+        if environment:
+            definition["environment"] = environment
+        if service == "clickhouse":
+            definition["volumes"] = [
+                f"./{CLICKHOUSE_LIMITS_FILE}:/etc/clickhouse-server/config.d/localai-limits.xml:ro"
+            ]
+        services[service] = definition
+    return (
+        "# Generated by start_services.py --profile auto from the host's cores and memory.\n"
+        "# Only applied by --profile auto runs; edits are overwritten on the next one.\n"
+        + json.dumps({"services": services}, indent=2) + "\n"
+    )
+
+
+def auto_size_stack(weights_spec=None, host=None):
+    """Pick the profile for this host, write the per-service limits override and return the profile."""
+    global _limits_override_active
+    host = host or detect_host()
+    profile = choose_profile(host)
+    memory_gb = (host["memory_bytes"] or 0) / 1e9
+    print(f"Detected {host['cpus']} cores, {memory_gb:.1f} GB RAM, "
+          f"GPU: {host['gpu'] or 'none'} -> using profile '{profile}'")
+
+    plan = plan_resource_limits(host, profile, parse_resource_weights(weights_spec))
+    if not plan:
+        print("Could not size services for this host; starting without resource limits.")
+        return profile
+    if "clickhouse" in plan:
+        render_file(CLICKHOUSE_LIMITS_FILE, clickhouse_limits_xml(plan["clickhouse"]["memory_bytes"]), mode=0o644)
+    written = render_file(LIMITS_OVERRIDE_FILE, render_limits_override(plan, profile), mode=0o644)
+    _limits_override_active = True
+    print(f"{'Wrote' if written else 'Unchanged'} {LIMITS_OVERRIDE_FILE}:")
+    width = max(len(service) for service in plan)
+    for service, limits in sorted(plan.items(), key=lambda item: -item[1]["memory_bytes"]):
+        print(f"  {service:<{width}}  {limits['cpus']:>5.2f} cpus  {limits['memory_bytes'] / 2**30:>6.1f} GiB")
+    return profile
+
+
+SEARXNG_SECRET_PLACEHOLDER = "ultrasecretkey"
+
+
+def generate_searxng_secret_key(settings_dir="searxng"):
+    """Render searxng/settings.yml with a generated secret key if it is missing or a placeholder."""
+    print("Checking SearXNG settings...")
+
+    settings_path = os.path.join(settings_dir, "settings.yml")
+    settings_base_path = os.path.join(settings_dir, "settings-base.yml")
+
+    source = settings_path if os.path.exists(settings_path) else settings_base_path
+    try:
+        with open(source, newline="") as file:
+            content = file.read()
+    except FileNotFoundError:
+        print(f"Warning: SearXNG base settings file not found at {settings_base_path}")
+        return
+
+    if SEARXNG_SECRET_PLACEHOLDER in content:
+        content = content.replace(SEARXNG_SECRET_PLACEHOLDER, secrets.token_hex(32))
+    try:
+        base_mode = os.stat(settings_base_path).st_mode & 0o777
+    except OSError:
+        base_mode = 0o644
+    try:
+        written = render_file(settings_path, content, mode=base_mode)
+    except OSError as e:
+        print(f"Error writing {settings_path}: {e}")
+        return
+    if written:
+        print(f"Rendered {settings_path} with a generated secret key.")
+    else:
+        print(f"SearXNG settings.yml is up to date at {settings_path}")
+
+
+def _hex_secret(nbytes):
+    return lambda: secrets.token_hex(nbytes)
+
+
+# .env.example values that are placeholders for generated secrets, and how to
+# generate each one. JWT_SECRET is handled separately because the Supabase API
+# keys are signed with it.
+ENV_SECRET_PLACEHOLDERS = {
+    "N8N_ENCRYPTION_KEY": ("super-secret-key", _hex_secret(32)),
+    "N8N_USER_MANAGEMENT_JWT_SECRET": ("even-more-secret", _hex_secret(32)),
+    "POSTGRES_PASSWORD": ("your-super-secret-and-long-postgres-password", _hex_secret(24)),
+    "DASHBOARD_PASSWORD": ("this_password_is_insecure_and_should_be_updated", _hex_secret(16)),
+    "NEO4J_AUTH": ("neo4j/password", lambda: f"neo4j/{secrets.token_hex(16)}"),
+    "CLICKHOUSE_PASSWORD": ("super-secret-key-1", _hex_secret(32)),
+    "MINIO_ROOT_PASSWORD": ("super-secret-key-2", _hex_secret(32)),
+    "LANGFUSE_SALT": ("super-secret-key-3", _hex_secret(32)),
+    "NEXTAUTH_SECRET": ("super-secret-key-4", _hex_secret(32)),
+    "ENCRYPTION_KEY": ("generate-with-openssl", _hex_secret(32)),
+    "SECRET_KEY_BASE": ("UpNVntn3cDxHJpq99YMc1T1AQgQpc8kfYTuRgBiYa15BLrx8etQoXz3gZv1/u2oq", _hex_secret(32)),
+    "VAULT_ENC_KEY": ("your-32-character-encryption-key", _hex_secret(16)),
+    "LOGFLARE_PUBLIC_ACCESS_TOKEN": ("your-super-secret-and-long-logflare-key-public", _hex_secret(32)),
+    "LOGFLARE_PRIVATE_ACCESS_TOKEN": ("your-super-secret-and-long-logflare-key-private", _hex_secret(32)),
+}
+JWT_SECRET_PLACEHOLDER = "your-super-secret-jwt-token-with-at-least-32-characters-long"
+SUPABASE_KEY_ROLES = {"ANON_KEY": "anon", "SERVICE_ROLE_KEY": "service_role"}
+
+_ENV_LINE = re.compile(r"^(?P<key>[A-Za-z_][A-Za-z0-9_]*)=(?P<value>[^#\r\n]*?)(?P<rest>\s*(?:#.*)?)$", re.MULTILINE)
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def supabase_jwt(secret, role, issued_at=None, lifetime_days=5 * 365):
+    """Sign a Supabase API key (an HS256 JWT for ``role``) with ``secret``."""
+    issued_at = int(time.time()) if issued_at is None else issued_at
+    header = {"alg": "HS256", "typ": "JWT"}
+    payload = {"role": role, "iss": "supabase", "iat": issued_at, "exp": issued_at + lifetime_days * 86400}
+    signing_input = ".".join(
+        _b64url(json.dumps(part, separators=(",", ":")).encode("utf-8")) for part in (header, payload)
+    )
+    signature = hmac.new(secret.encode("utf-8"), signing_input.encode("ascii"), hashlib.sha256).digest()
+    return f"{signing_input}.{_b64url(signature)}"
+
+
+def env_placeholders(content):
+    """Names of variables in ``content`` that still hold a generated-secret placeholder."""
+    placeholders = []
+    for match in _ENV_LINE.finditer(content):
+        key, value = match.group("key"), match.group("value").strip().strip("\"'")
+        if key in ENV_SECRET_PLACEHOLDERS and value == ENV_SECRET_PLACEHOLDERS[key][0]:
+            placeholders.append(key)
+        elif key == "JWT_SECRET" and value == JWT_SECRET_PLACEHOLDER:
+            placeholders.append(key)
+    return placeholders
+
+
+def fill_env_secrets(content):
+    """Replace secret placeholders in .env ``content``; returns (content, filled names)."""
+    targets = set(env_placeholders(content))
+    values = {key: ENV_SECRET_PLACEHOLDERS[key][1]() for key in targets if key in ENV_SECRET_PLACEHOLDERS}
+    if "JWT_SECRET" in targets:
+        values["JWT_SECRET"] = secrets.token_hex(32)
+        issued_at = int(time.time())
+        for key, role in SUPABASE_KEY_ROLES.items():
+            values[key] = supabase_jwt(values["JWT_SECRET"], role, issued_at)
+
+    def substitute(match):
+        key = match.group("key")
+        if key not in values:
+            return match.group(0)
+        return f"{key}={values[key]}{match.group('rest')}"
+
+    return _ENV_LINE.sub(substitute, content), sorted(values)
+
+
+def render_env_secrets(env_path=".env", example_path=".env.example", replace_placeholders=False):
+    """Create .env from .env.example with generated secrets; fill an existing one only if ``replace_placeholders``."""
+    try:
+        with open(env_path, newline="") as file:
+            content = file.read()
+        exists = True
+    except FileNotFoundError:
+        try:
+            with open(example_path, newline="") as file:
+                content = file.read()
+        except FileNotFoundError:
+            return []
+        exists = False
+
+    if exists and not replace_placeholders:
+        placeholders = env_placeholders(content)
+        if placeholders:
+            print(f"Warning: {env_path} still uses example values for: {', '.join(placeholders)}")
+            print("  Run with --generate-secrets to replace them (only before the first deploy).")
+        return []
+
+    content, filled = fill_env_secrets(content)
+    if render_file(env_path, content, mode=0o600):
+        action = "Filled" if exists else "Created"
+        print(f"{action} {env_path} with {len(filled)} generated secrets.")
+    return filled
+
+
+def render_secrets(replace_env_placeholders=False):
+    """In-process templating pass for every generated secret the stack needs."""
+    render_env_secrets(replace_placeholders=replace_env_placeholders)
+    generate_searxng_secret_key()
+
+
+CADDYFILE_PATH = "Caddyfile"
+CADDY_IMAGE = "docker.io/library/caddy:2-alpine"
+# Hostname defaults from the caddy service in docker-compose.yml, used when validating.
+CADDY_DEFAULT_HOSTS = {
+    "N8N_HOSTNAME": ":8001",
+    "WEBUI_HOSTNAME": ":8002",
+    "FLOWISE_HOSTNAME": ":8003",
+    "OLLAMA_HOSTNAME": ":8004",
+    "SEARXNG_HOSTNAME": ":8006",
+    "LANGFUSE_HOSTNAME": ":8007",
+    "NEO4J_HOSTNAME": ":8008",
+    "LETSENCRYPT_EMAIL": "internal",
+}
+# Proxied services. "stream" services send chat tokens as SSE/NDJSON and must
+# not be buffered; "immutable" paths hold content-hashed build assets.
+CADDY_SITES = (
+    {"title": "N8N", "host": "N8N_HOSTNAME", "upstream": "n8n:5678", "stream": True,
+     "immutable": ("/assets/*",)},
+    {"title": "Open WebUI", "host": "WEBUI_HOSTNAME", "upstream": "open-webui:8080", "stream": True,
+     "immutable": ("/_app/immutable/*",)},
+    {"title": "Flowise", "host": "FLOWISE_HOSTNAME", "upstream": "flowise:3001", "stream": True,
+     "immutable": ("/assets/*",)},
+    {"title": "Langfuse", "host": "LANGFUSE_HOSTNAME", "upstream": "langfuse-web:3000", "stream": False,
+     "immutable": ("/_next/static/*",)},
+    {"title": "Ollama API", "host": "OLLAMA_HOSTNAME", "upstream": "ollama:11434", "stream": True,
+     "immutable": (), "disabled": True},
+    {"title": "Neo4j", "host": "NEO4J_HOSTNAME", "upstream": "neo4j:7474", "stream": False,
+     "immutable": ()},
+)
+# Per --environment tuning. Private traffic stays on the machine or LAN, where
+# heavy compression costs more CPU than it saves; public traffic crosses the
+# internet and holds more concurrent connections.
+CADDY_PROFILES = {
+    "private": {"gzip_level": 1, "minimum_length": 4096, "keepalive": "60s", "idle_conns": 16},
+    "public": {"gzip_level": 5, "minimum_length": 1024, "keepalive": "120s", "idle_conns": 64},
+}
+# Streams (text/event-stream, application/x-ndjson) are deliberately absent.
+CADDY_COMPRESSIBLE_TYPES = (
+    "text/html*", "text/css*", "text/plain*", "text/javascript*",
+    "application/javascript*", "application/json*", "image/svg+xml*",
+)
+CADDY_SEARXNG_BLOCK = """\
+# # SearXNG
+# {$SEARXNG_HOSTNAME} {
+#     encode zstd gzip
+#
+#     @api {
+#         path /config
+#         path /healthz
+#         path /stats/errors
+#         path /stats/checker
+#     }
+#     @search {
+#         path /search
+#     }
+#     @imageproxy {
+#         path /image_proxy
+#     }
+#     @static {
+#         path /static/*
+#     }
+#
+#     header {
+#         # CSP (https://content-security-policy.com)
+#         Content-Security-Policy "upgrade-insecure-requests; default-src 'none'; script-src 'self'; style-src 'self' 'unsafe-inline'; form-action 'self' https://github.com/searxng/searxng/issues/new; font-src 'self'; frame-ancestors 'self'; base-uri 'self'; connect-src 'self' https://overpass-api.de; img-src * data:; frame-src https://www.youtube-nocookie.com https://player.vimeo.com https://www.dailymotion.com https://www.deezer.com https://www.mixcloud.com https://w.soundcloud.com https://embed.spotify.com;"
+#         # Disable some browser features
+#         Permissions-Policy "accelerometer=(),camera=(),geolocation=(),gyroscope=(),magnetometer=(),microphone=(),payment=(),usb=()"
+#         # Set referrer policy
+#         Referrer-Policy "no-referrer"
+#         # Force clients to use HTTPS
+#         Strict-Transport-Security "max-age=31536000"
+#         # Prevent MIME type sniffing from the declared Content-Type
+#         X-Content-Type-Options "nosniff"
+#         # X-Robots-Tag (comment to allow site indexing)
+#         X-Robots-Tag "noindex, noarchive, nofollow"
+#         # Remove "Server" header
+#         -Server
+#     }
+#
+#     header @api {
+#         Access-Control-Allow-Methods "GET, OPTIONS"
+#         Access-Control-Allow-Origin "*"
+#     }
+#
+#     route {
+#         # Cache policy
+#         header Cache-Control "max-age=0, no-store"
+#         header @search Cache-Control "max-age=5, private"
+#         header @imageproxy Cache-Control "max-age=604800, public"
+#         header @static Cache-Control "max-age=31536000, public, immutable"
+#     }
+#
+#     # SearXNG (uWSGI)
+#     reverse_proxy searxng:8080 {
+#         header_up X-Forwarded-Port {http.request.port}
+#         header_up X-Real-IP {http.request.remote.host}
+#         # https://github.com/searx/searx-docker/issues/24
+#         header_up Connection "close"
+#     }
+# }
+"""
+
+
+def _caddy_site(site):
+    lines = [f"{{${site['host']}}} {{"]
+    if site["title"] == "N8N":
+        lines += ["    # For domains, Caddy will automatically use Let's Encrypt",
+                  "    # For localhost/port addresses, HTTPS won't be enabled"]
+    lines.append("    import compress")
+    if site["immutable"]:
+        lines += [f"    @immutable path {' '.join(site['immutable'])}",
+                  '    header @immutable Cache-Control "public, max-age=31536000, immutable"']
+    lines.append(f"    reverse_proxy {site['upstream']} {{")
+    if site["stream"]:
+        lines += ["        # Pass streamed chat tokens on as soon as they arrive",
+                  "        flush_interval -1"]
+    lines += ["        import upstream_pool", "    }", "}"]
+    if site.get("disabled"):
+        lines = ["# " + line for line in lines]
+    return [f"# {'# ' if site.get('disabled') else ''}{site['title']}"] + lines
+
+
+def render_caddyfile(environment="private"):
+    """The Caddyfile for ``environment``'s performance profile."""
+    profile = CADDY_PROFILES.get(environment, CADDY_PROFILES["private"])
+    lines = [
+        f"# Generated by start_services.py --render-caddyfile ({environment} profile).",
+        "# Tune CADDY_SITES/CADDY_PROFILES there and re-render; add extra sites as caddy-addon/*.conf,",
+        "# which can use the compress and upstream_pool snippets below.",
+        "{",
+        "    # Global options - works for both environments",
+        "    email {$LETSENCRYPT_EMAIL}",
+        "}",
+        "",
+        "# Compress text responses; event streams are left alone so they are never buffered",
+        "(compress) {",
+        "    encode {",
+        "        zstd",
+        f"        gzip {profile['gzip_level']}",
+        f"        minimum_length {profile['minimum_length']}",
+        "        match {",
+        *(f"            header Content-Type {content_type}" for content_type in CADDY_COMPRESSIBLE_TYPES),
+        "        }",
+        "    }",
+        "}",
+        "",
+        "# Reuse upstream connections instead of opening one per request",
+        "(upstream_pool) {",
+        "    transport http {",
+        f"        keepalive {profile['keepalive']}",
+        f"        keepalive_idle_conns {profile['idle_conns']}",
+        f"        keepalive_idle_conns_per_host {profile['idle_conns']}",
+        "    }",
+        "}",
+    ]
+    for site in CADDY_SITES:
+        lines += [""] + _caddy_site(site)
+    lines += ["", "import /etc/caddy/addons/*.conf", ""]
+    return "\n".join(lines) + "\n" + CADDY_SEARXNG_BLOCK
+
+
+def validate_caddyfile(content):
+    """Run ``caddy validate`` on ``content``; returns (valid, output), with None when caddy cannot run."""
+    hosts = {name: os.environ.get(name) or default for name, default in CADDY_DEFAULT_HOSTS.items()}
+    # Inside the project directory so Docker Desktop can bind-mount it.
+    with tempfile.TemporaryDirectory(prefix=".localai-caddy-", dir=".") as directory:
+        with open(os.path.join(directory, "Caddyfile"), "w") as file:
+            file.write(content)
+        if shutil.which("caddy"):
+            cmd = ["caddy", "validate", "--config", os.path.join(directory, "Caddyfile"), "--adapter", "caddyfile"]
+            kwargs = {"env": {**os.environ, **hosts}}
+        elif shutil.which("docker"):
+            cmd = ["docker", "run", "--rm",
+                   "-v", f"{os.path.abspath(os.path.join(directory, 'Caddyfile'))}:/etc/caddy/Caddyfile:ro",
+                   "-v", f"{os.path.abspath('caddy-addon')}:/etc/caddy/addons:ro"]
+            for name, value in hosts.items():
+                cmd += ["-e", f"{name}={value}"]
+            cmd += [CADDY_IMAGE, "caddy", "validate", "--config", "/etc/caddy/Caddyfile", "--adapter", "caddyfile"]
+            kwargs = {}
+        else:
+            return None, "neither caddy nor docker was found"
+        result = run_process(cmd, capture_output=True, text=True, check=False, **kwargs)
+    output = (result.stderr or result.stdout).strip()
+    if cmd[0] == "docker" and result.returncode == 125:
+        # Docker failed to start the container, so the config was never checked.
+        return False, f"docker could not run caddy validate: {output}"
+    return result.returncode == 0, output
+
+
+def render_caddyfile_for(environment, path=CADDYFILE_PATH):
+    """Render, validate and rewrite the bind-mounted Caddyfile in place; True when it changed."""
+    content = render_caddyfile(environment)
+    try:
+        with open(path, newline="") as file:
+            if file.read() == content:
+                print(f"{path} is up to date for the {environment} profile.")
+                return False
+    except FileNotFoundError:
+        pass
+
+    valid, output = validate_caddyfile(content)
+    if valid is False:
+        print(f"Error: the rendered {path} did not pass caddy validate; keeping the current file.")
+        print(output)
+        return False
+    if valid is None:
+        print(f"Warning: could not run caddy validate ({output.splitlines()[-1] if output else 'unknown'}); "
+              "writing the rendered file unvalidated.")
+    with open(path, "w", newline="") as file:
+        file.write(content)
+    print(f"Rendered {path} with the {environment} performance profile.")
+    return True
+
+
+def check_and_fix_docker_compose_for_searxng(profile=None, environment=None):
     """Check and modify docker-compose.yml for SearXNG first run."""
     docker_compose_path = "docker-compose.yml"
     if not os.path.exists(docker_compose_path):
@@ -195,7 +1891,7 @@ def check_and_fix_docker_compose_for_searxng():
         is_first_run = True
 
         try:
-            container_check = subprocess.run(
+            container_check = run_process(
                 ["docker", "ps", "--filter", "name=searxng", "--format", "{{.Names}}"],
                 capture_output=True, text=True, check=True
             )
@@ -205,7 +1901,7 @@ def check_and_fix_docker_compose_for_searxng():
                 container_name = next(container for container in searxng_containers if container)
                 print(f"Found running SearXNG container: {container_name}")
 
-                container_check = subprocess.run(
+                container_check = run_process(
                     ["docker", "exec", container_name, "sh", "-c", "[ -f /etc/searxng/uwsgi.ini ] && echo 'found' || echo 'not_found'"],
                     capture_output=True, text=True, check=False
                 )
@@ -221,6 +1917,19 @@ def check_and_fix_docker_compose_for_searxng():
         except Exception as e:
             print(f"Error checking Docker container: {e} - assuming first run")
 
+        # The resolved (cached) Compose model answers whether cap_drop is in
+        # effect, so the compose file is only rewritten when it must change.
+        try:
+            cap_drop_active = searxng_cap_drop_active(
+                load_compose_config(profile=profile, environment=environment)
+            )
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            cap_drop_active = None
+        if cap_drop_active is not None and cap_drop_active != is_first_run:
+            state = "disabled" if is_first_run else "enabled"
+            print(f"SearXNG 'cap_drop: - ALL' is already {state}.")
+            return
+
         if is_first_run:
             print("First run detected for SearXNG. Temporarily removing 'cap_drop: - ALL' directive...")
             modified_content, was_modified = _toggle_searxng_cap_drop(content, disable=True)
@@ -271,35 +1980,173 @@ def _toggle_searxng_cap_drop(content, disable):
     return updated_content, True
 
 
+def wait_if_requested(args):
+    """Block until the stack is ready when --wait was given; exit 1 if it never is."""
+    if not args.wait:
+        return
+    with TRACER.span("wait for services"):
+        ready = wait_for_services(args.profile, args.environment, timeout=args.wait_timeout)
+    if not ready:
+        print(f"Not all services became ready within {args.wait_timeout}s.")
+        sys.exit(1)
+
+
+def warm_models_if_requested(args):
+    """Load and pin the --warm-models list so the first chat hits a hot model."""
+    if not args.warm_models:
+        return
+    keep_alive = args.keep_alive
+    if keep_alive.lstrip("-").isdigit():
+        # Ollama reads bare numbers as seconds but strings must carry a unit.
+        keep_alive = int(keep_alive)
+    with TRACER.span("warm models"):
+        warm_ollama_models(args.warm_models.split(","), base_url=args.ollama_url, keep_alive=keep_alive,
+                           profile=args.profile)
+
+
+def provision_if_requested(args):
+    """Bulk-import workflows and tools when --provision or --provision-dry-run was given."""
+    if not (args.provision or args.provision_dry_run):
+        return
+    with TRACER.span("provision workflows"):
+        provision_services(
+            {"n8n": args.n8n_url, "flowise": args.flowise_url},
+            parallelism=args.provision_parallelism,
+            dry_run=args.provision_dry_run,
+        )
+
+
+def deploy(args):
+    """Run the startup phases selected by ``args``, each recorded as a trace span."""
+    # Rendered first: Compose reads .env while resolving the configuration.
+    with TRACER.span("render secrets"):
+        render_secrets(replace_env_placeholders=args.generate_secrets)
+
+    if args.render_caddyfile:
+        with TRACER.span("render caddyfile"):
+            render_caddyfile_for(args.environment)
+
+    with TRACER.span("verify compose configuration"):
+        verify_compose_configuration(args.profile, args.environment)
+
+    if args.export_images:
+        with TRACER.span("export images"):
+            export_images(args.export_images, args.profile, args.environment, args.pull_parallelism)
+        return
+    if args.import_images:
+        with TRACER.span("import images"):
+            imported = import_images(args.import_images)
+        if not imported:
+            sys.exit(1)
+
+    if args.update_running_images:
+        with TRACER.span("refresh running images"):
+            refresh_running_ollama_and_openwebui(args.profile, args.environment, args.pull_parallelism)
+        wait_if_requested(args)
+        warm_models_if_requested(args)
+        provision_if_requested(args)
+        return
+
+    with TRACER.span("searxng first-run check"):
+        check_and_fix_docker_compose_for_searxng(args.profile, args.environment)
+
+    if args.pull_all:
+        with TRACER.span("pull images"):
+            pull_all_images(args.profile, args.environment, args.pull_parallelism)
+    elif args.update_images:
+        with TRACER.span("pull images"):
+            update_ollama_and_openwebui_images(args.profile, args.environment, args.pull_parallelism)
+
+    if args.incremental:
+        with TRACER.span("incremental deploy"):
+            incremental_deploy(args.profile, args.environment)
+    else:
+        with TRACER.span("stop containers"):
+            stop_existing_containers(args.profile, args.environment)
+        with TRACER.span("start containers"):
+            start_local_ai(args.profile, args.environment)
+        with TRACER.span("record deploy state"):
+            record_deploy_state(args.profile, args.environment)
+    wait_if_requested(args)
+    warm_models_if_requested(args)
+    provision_if_requested(args)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Start the local AI services.')
-    parser.add_argument('--profile', choices=['cpu', 'gpu-nvidia', 'gpu-amd', 'none'], default='gpu-nvidia',
-                      help='Profile to use for Docker Compose (default: gpu-nvidia)')
+    parser.add_argument('--profile', choices=['cpu', 'gpu-nvidia', 'gpu-amd', 'none', 'auto'], default='gpu-nvidia',
+                      help="Profile to use for Docker Compose (default: gpu-nvidia). 'auto' picks one from the "
+                           'host hardware and writes per-service CPU/memory limits')
+    parser.add_argument('--resource-weights', metavar='SERVICE=WEIGHT,...',
+                      help='Adjust the share of cores/memory each service gets with --profile auto '
+                           f"(defaults: {','.join(f'{k}={v}' for k, v in DEFAULT_RESOURCE_WEIGHTS.items())})")
     parser.add_argument('--environment', choices=['private', 'public'], default='private',
                       help='Environment to use for Docker Compose (default: private)')
     parser.add_argument('--update-images', action='store_true',
                       help='Pull the latest Ollama and Open WebUI images before restarting services')
     parser.add_argument('--update-running-images', action='store_true',
                       help='Pull and recreate only running Ollama/Open WebUI services without full stack restart')
+    parser.add_argument('--pull-all', action='store_true',
+                      help='Pull every image used by the selected profile in parallel before starting')
+    parser.add_argument('--pull-parallelism', type=int, default=4,
+                      help='Maximum number of images pulled at the same time (default: 4)')
+    parser.add_argument('--incremental', action='store_true',
+                      help='Recreate only services whose resolved config or image changed, instead of a full restart')
+    parser.add_argument('--wait', action='store_true',
+                      help='Wait until every service is healthy/serving and print a time-to-ready table')
+    parser.add_argument('--wait-timeout', type=int, default=300,
+                      help='Seconds to wait for services with --wait before failing (default: 300)')
+    parser.add_argument('--warm-models', nargs='?', const=DEFAULT_WARM_MODELS, default=None,
+                      help='Comma-separated Ollama models to load and pin after startup '
+                           f'(default when given without a value: {DEFAULT_WARM_MODELS})')
+    parser.add_argument('--keep-alive', default='24h',
+                      help="How long warmed models stay loaded, as an Ollama keep_alive (default: 24h, -1 = forever)")
+    parser.add_argument('--ollama-url', default='http://127.0.0.1:11434',
+                      help='Ollama API URL used for model warm-up (default: http://127.0.0.1:11434)')
+    parser.add_argument('--generate-secrets', action='store_true',
+                      help='Replace example placeholder secrets in an existing .env with generated values '
+                           '(a missing .env is always created from .env.example with generated secrets)')
+    parser.add_argument('--render-caddyfile', action='store_true',
+                      help='Render the Caddyfile from the performance profile for --environment '
+                           '(compression, unbuffered chat streaming, upstream keep-alive, asset caching)')
+    parser.add_argument('--provision', action='store_true',
+                      help='After startup, import the bundled n8n workflows and Flowise chatflows/tools '
+                           'that are not there yet')
+    parser.add_argument('--provision-dry-run', action='store_true',
+                      help='Show what --provision would create or update, with a diff, without changing anything')
+    parser.add_argument('--provision-parallelism', type=int, default=4,
+                      help='Maximum concurrent API calls while provisioning (default: 4)')
+    parser.add_argument('--n8n-url', default='http://127.0.0.1:5678',
+                      help='n8n URL used for provisioning (default: http://127.0.0.1:5678)')
+    parser.add_argument('--flowise-url', default='http://127.0.0.1:3001',
+                      help='Flowise URL used for provisioning (default: http://127.0.0.1:3001)')
+    parser.add_argument('--export-images', metavar='DIR',
+                      help="Save every image the profile uses into a compressed bundle in DIR and exit")
+    parser.add_argument('--import-images', metavar='DIR',
+                      help='Load images from a bundle made with --export-images before starting, for offline hosts')
+    parser.add_argument('--trace', metavar='PATH',
+                      help='Record how long each startup phase and command takes, write a Chrome trace '
+                           'JSON to PATH and print a summary table on exit')
     args = parser.parse_args()
 
     if args.update_images and args.update_running_images:
         parser.error("--update-images and --update-running-images cannot be used together")
+    if args.import_images and (args.export_images or args.pull_all or args.update_images or args.update_running_images):
+        parser.error("--import-images loads images from a bundle and cannot be combined with exporting or pulling")
+    if args.profile == "auto":
+        try:
+            with TRACER.span("auto-size resources"):
+                args.profile = auto_size_stack(args.resource_weights)
+        except ValueError as e:
+            parser.error(str(e))
+    elif os.path.exists(LIMITS_OVERRIDE_FILE):
+        print(f"Note: ignoring {LIMITS_OVERRIDE_FILE}; its limits are only applied with --profile auto.")
 
-    verify_compose_configuration(args.profile, args.environment)
-
-    if args.update_running_images:
-        refresh_running_ollama_and_openwebui(args.profile, args.environment)
-        return
-
-    generate_searxng_secret_key()
-    check_and_fix_docker_compose_for_searxng()
-
-    if args.update_images:
-        update_ollama_and_openwebui_images(args.profile, args.environment)
-
-    stop_existing_containers(args.profile, args.environment)
-    start_local_ai(args.profile, args.environment)
+    try:
+        deploy(args)
+    finally:
+        if args.trace:
+            write_trace(args.trace)
 
 
 if __name__ == "__main__":
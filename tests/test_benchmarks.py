@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.bench_n8n_pipe import compare_results, percentile, summarize_ms
+from benchmarks.loadtest_stack import LoadTestConfig, find_saturation, load_transcripts, replica_plan
+from benchmarks.stub_servers import (
+    StubN8nAgentServer,
+    StubN8nConfig,
+    StubN8nServer,
+    StubOllamaConfig,
+    StubOllamaServer,
+    stream_json_lines,
+)
+
+
+async def raw_post(url: str, payload: dict) -> tuple[int, dict, bytes]:
+    """POST ``payload`` with a bare asyncio connection and de-chunk the reply."""
+    host, port = url.removeprefix("http://").split(":")
+    reader, writer = await asyncio.open_connection(host, int(port))
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        b"POST /webhook HTTP/1.1\r\nHost: stub\r\nConnection: close\r\n"
+        b"Content-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    )
+    await writer.drain()
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+    status = int(head.split(" ", 2)[1])
+    headers = {
+        name.strip().lower(): value.strip()
+        for name, value in (line.split(":", 1) for line in head.split("\r\n")[1:] if ":" in line)
+    }
+    if headers.get("transfer-encoding") == "chunked":
+        data = b""
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            data += chunk[:-2]
+    else:
+        data = await reader.readexactly(int(headers["content-length"]))
+    writer.close()
+    return status, headers, data
+
+
+class TestStubN8nServer(unittest.IsolatedAsyncioTestCase):
+    async def test_json_reply_uses_response_field(self):
+        config = StubN8nConfig(latency=0, tokens=3)
+        async with StubN8nServer(config) as server:
+            status, _, data = await raw_post(server.url, {"chatInput": "hi"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(data), {"output": "token0 token1 hi"})
+        self.assertEqual(server.requests, 1)
+
+    async def test_stream_sends_ndjson_chunks(self):
+        config = StubN8nConfig(latency=0, tokens=2, stream=True)
+        async with StubN8nServer(config) as server:
+            status, headers, data = await raw_post(server.url, {"chatInput": "hi"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["transfer-encoding"], "chunked")
+        events = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+        self.assertEqual([event["type"] for event in events], ["begin", "item", "item", "end"])
+        self.assertEqual("".join(event.get("content", "") for event in events), "token0 hi")
+
+    async def test_error_rate_injects_503(self):
+        config = StubN8nConfig(latency=0, error_rate=1.0)
+        async with StubN8nServer(config) as server:
+            status, _, data = await raw_post(server.url, {"chatInput": "hi"})
+
+        self.assertEqual(status, 503)
+        self.assertIn(b"injected failure", data)
+        self.assertEqual(server.errors, 1)
+
+
+class TestStubOllamaServer(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_streams_tokens_after_ttft(self):
+        config = StubOllamaConfig(ttft=0.05, tokens=3, tokens_per_s=1000)
+        async with StubOllamaServer(config) as server:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            chunks = []
+            async for chunk in stream_json_lines(server.url, "/api/chat", {"messages": [{"content": "hi"}]}):
+                chunks.append((loop.time() - started, chunk))
+
+        self.assertGreaterEqual(chunks[0][0], 0.05)
+        self.assertEqual([chunk["done"] for _, chunk in chunks], [False, False, False, True])
+        self.assertEqual("".join(chunk["message"]["content"] for _, chunk in chunks), "word0 word1 word2 ")
+        self.assertEqual(chunks[-1][1]["eval_count"], 3)
+
+    async def test_requests_beyond_num_parallel_queue(self):
+        config = StubOllamaConfig(ttft=0.02, tokens=1, num_parallel=1)
+        async with StubOllamaServer(config) as server:
+            async def generate():
+                return [chunk async for chunk in stream_json_lines(server.url, "/api/generate", {"prompt": "x"})]
+
+            results = await asyncio.gather(*(generate() for _ in range(3)))
+
+        self.assertTrue(all(result[-1]["done"] for result in results))
+        self.assertEqual(server.requests, 3)
+        self.assertGreaterEqual(server.max_waiting, 2)
+        self.assertEqual(server.active, 0)
+
+
+class TestStubN8nAgentServer(unittest.IsolatedAsyncioTestCase):
+    async def test_answers_from_ollama_and_remembers_the_session(self):
+        async with StubOllamaServer(StubOllamaConfig(ttft=0, tokens=2, tokens_per_s=1000)) as ollama:
+            async with StubN8nAgentServer(StubN8nConfig(latency=0), ollama_urls=[ollama.url]) as agent:
+                for question in ("first", "second"):
+                    status, _, data = await raw_post(agent.url, {"sessionId": "chat-1", "chatInput": question})
+                    self.assertEqual(status, 200)
+                    self.assertEqual(json.loads(data), {"output": "word0 word1 "})
+                await raw_post(agent.url, {"sessionId": "chat-2", "chatInput": "other"})
+
+        self.assertEqual(
+            [message["content"] for message in agent.memory["chat-1"]],
+            ["first", "word0 word1 ", "second", "word0 word1 "],
+        )
+        self.assertEqual(len(agent.memory["chat-2"]), 2)
+        self.assertEqual(ollama.requests, 3)
+
+
+class TestLoadTestAnalysis(unittest.TestCase):
+    @staticmethod
+    def level(concurrency, turns_per_s):
+        return {
+            "concurrency": concurrency,
+            "turns_per_s": turns_per_s,
+            "tokens_per_s": turns_per_s * 10,
+            "latency_ms": {"p95": 100.0 * concurrency},
+            "ttft_ms": {"p95": 10.0 * concurrency},
+        }
+
+    def test_saturation_is_last_level_that_still_scaled(self):
+        levels = [self.level(1, 2.0), self.level(2, 4.0), self.level(4, 7.0), self.level(8, 7.3)]
+
+        saturation = find_saturation(levels, min_gain=0.10)
+
+        self.assertEqual(saturation["concurrency"], 4)
+        self.assertEqual(saturation["latency_p95_ms"], 400.0)
+        self.assertIsNone(find_saturation(levels[:3], min_gain=0.10))
+
+    def test_replica_plan_scales_the_tested_topology(self):
+        config = LoadTestConfig(n8n_replicas=1, ollama_replicas=2)
+
+        plan = replica_plan({"concurrency": 8}, config, target_users=50)
+
+        self.assertEqual(plan, {"target_users": 50, "n8n_replicas": 7, "ollama_replicas": 14})
+        self.assertIsNone(replica_plan(None, config, 50))
+
+    def test_transcripts_accept_strings_or_chat_messages(self):
+        data = [
+            ["hello", "and then?"],
+            [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"},
+             {"role": "assistant", "content": "hey"}, {"role": "user", "content": "bye"}],
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "transcripts.json")
+            with open(path, "w") as handle:
+                json.dump(data, handle)
+
+            self.assertEqual(load_transcripts(path), [["hello", "and then?"], ["hi", "bye"]])
+
+
+class TestBenchmarkReport(unittest.TestCase):
+    def test_percentile_uses_nearest_rank(self):
+        values = [float(i) for i in range(1, 101)]
+
+        self.assertEqual(percentile(values, 0.50), 50.0)
+        self.assertEqual(percentile(values, 0.99), 99.0)
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(summarize_ms([0.001, 0.003])["max"], 3.0)
+
+    def test_compare_flags_regressions_beyond_tolerance(self):
+        baseline = {"requests_per_s": 100.0, "latency_ms": {"p50": 10.0, "p95": 20.0, "p99": 30.0}}
+        current = {
+            "requests_per_s": 95.0,
+            "latency_ms": {"p50": 10.5, "p95": 25.0, "p99": 30.0},
+            "ttft_ms": {"p50": None, "p95": None, "p99": None},
+        }
+
+        regressions = compare_results(current, baseline, tolerance=0.10)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("latency_ms.p95"))
@@ -1,5 +1,11 @@
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import time
 import unittest
-from unittest.mock import patch, Mock
+from unittest.mock import patch, AsyncMock, Mock
 
 import sys
 import types
@@ -17,16 +23,111 @@ if "pydantic" not in sys.modules:
     pydantic_stub.Field = _field
     sys.modules["pydantic"] = pydantic_stub
 
-if "requests" not in sys.modules:
-    requests_stub = types.ModuleType("requests")
+if "httpx" not in sys.modules:
+    httpx_stub = types.ModuleType("httpx")
 
-    def _post(*args, **kwargs):
-        raise RuntimeError("requests.post stub should be mocked in tests")
+    class _AsyncClient:
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("httpx.AsyncClient stub should be mocked in tests")
 
-    requests_stub.post = _post
-    sys.modules["requests"] = requests_stub
+    class _Limits:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
 
-from n8n_pipe import Pipe
+    class _Timeout:
+        def __init__(self, timeout=None, **kwargs):
+            self.timeout = timeout
+            self.__dict__.update(kwargs)
+
+    class _TransportError(Exception):
+        pass
+
+    httpx_stub.AsyncClient = _AsyncClient
+    httpx_stub.Limits = _Limits
+    httpx_stub.Timeout = _Timeout
+    httpx_stub.TransportError = _TransportError
+    for _name in ("ConnectError", "ConnectTimeout", "PoolTimeout", "RemoteProtocolError", "ReadTimeout"):
+        setattr(httpx_stub, _name, type(_name, (_TransportError,), {}))
+    httpx_stub.Response = object
+    sys.modules["httpx"] = httpx_stub
+
+import httpx
+
+from n8n_pipe import (
+    CallMetrics,
+    CircuitBreaker,
+    ConcurrencyLimiter,
+    ContextTracker,
+    Endpoint,
+    Histogram,
+    LoadBalancer,
+    MicroBatcher,
+    Pipe,
+    QueueFullError,
+    ResponseCache,
+    extract_event_info,
+    extract_json_field,
+)
+
+
+def json_response(data, status_code=200):
+    content = json.dumps(data).encode()
+    return Mock(status_code=status_code, content=content, text=content.decode())
+
+
+def error_response(status_code, text):
+    return Mock(status_code=status_code, content=text.encode(), text=text)
+
+
+def mock_client(response=None, post=None):
+    """Client whose streamed requests are answered by ``post``, so tests can
+    assert on ``client.post`` calls and return buffered mock responses."""
+    client = Mock(is_closed=False)
+    client.post = post or AsyncMock(return_value=response)
+    client.aclose = AsyncMock()
+
+    @contextlib.asynccontextmanager
+    async def stream(method, url, **kwargs):
+        response = await client.post(url, **kwargs)
+        if not isinstance(getattr(response, "headers", None), dict):
+            response.headers = {}
+
+        async def aiter_bytes():
+            yield response.content
+
+        response.aiter_bytes = aiter_bytes
+        yield response
+
+    client.stream = stream
+    return client
+
+
+def mock_stream_client(lines, content_type="application/json", status_code=200):
+    response = Mock(status_code=status_code, headers={"content-type": content_type})
+    response.aread = AsyncMock()
+
+    async def aiter_lines():
+        for line in lines:
+            yield line
+
+    response.aiter_lines = aiter_lines
+
+    async def aiter_bytes():
+        yield "\n".join(lines).encode()
+
+    response.aiter_bytes = aiter_bytes
+
+    @contextlib.asynccontextmanager
+    async def stream(method, url, **kwargs):
+        yield response
+
+    client = mock_client()
+    client.stream = stream
+    return client
+
+
+async def collect(stream):
+    return [token async for token in stream]
 
 
 class TestPipe(unittest.IsolatedAsyncioTestCase):
@@ -79,11 +180,10 @@ class TestPipe(unittest.IsolatedAsyncioTestCase):
         pipe.valves.response_field = "output"
         body = {"messages": [{"role": "user", "content": "hello"}]}
 
-        with patch("n8n_pipe.requests.post") as mock_post:
-            response = Mock(status_code=200)
-            response.json.return_value = {"output": "workflow reply"}
-            mock_post.return_value = response
+        response = json_response({"output": "workflow reply"})
+        client = mock_client(response)
 
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
             result = await pipe.pipe(body)
 
         self.assertEqual(result, "workflow reply")
@@ -94,10 +194,9 @@ class TestPipe(unittest.IsolatedAsyncioTestCase):
         pipe.valves.n8n_url = "https://example.test/webhook"
         body = {"messages": [{"role": "user", "content": "hello"}]}
 
-        with patch("n8n_pipe.requests.post") as mock_post:
-            response = Mock(status_code=500, text="server error")
-            mock_post.return_value = response
+        client = mock_client(error_response(500, "server error"))
 
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
             result = await pipe.pipe(body)
 
         self.assertIn("error", result)
@@ -119,6 +218,1002 @@ class TestPipe(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(emitted_events[0]["data"]["description"], "first")
         self.assertEqual(emitted_events[1]["data"]["description"], "done")
 
+    async def test_emit_status_throttles_each_chat_separately(self):
+        pipe = Pipe()
+        pipe.valves.emit_interval = 100
+        emitted_events = []
+
+        def emitter_for(chat_id):
+            request_info = {"chat_id": chat_id, "message_id": "m"}
+
+            async def emitter(event):
+                emitted_events.append((request_info["chat_id"], event["data"]["description"]))
+
+            return emitter
+
+        busy, quiet = emitter_for("busy"), emitter_for("quiet")
+        await pipe.emit_status(busy, "info", "busy 1", False)
+        await pipe.emit_status(busy, "info", "busy 2", False)
+        await pipe.emit_status(quiet, "info", "quiet 1", False)
+        await pipe.emit_status(busy, "info", "Complete", True)
+        await pipe.emit_status(quiet, "info", "Complete", True)
+
+        self.assertEqual([d for c, d in emitted_events if c == "busy"], ["busy 1", "Complete"])
+        self.assertEqual([d for c, d in emitted_events if c == "quiet"], ["quiet 1", "Complete"])
+
+    async def test_emit_status_coalesces_bursts_into_latest_event(self):
+        pipe = Pipe()
+        pipe.valves.emit_interval = 0.05
+        emitted_events = []
+
+        async def emitter(event):
+            emitted_events.append(event["data"]["description"])
+
+        for step in range(5):
+            await pipe.emit_status(emitter, "info", f"step {step}", False)
+        await asyncio.sleep(0.1)
+        await pipe.emit_status(emitter, "info", "Complete", True)
+
+        self.assertEqual(emitted_events, ["step 0", "step 4", "Complete"])
+        self.assertEqual(pipe.status_stats()["coalesced"], 3)
+
+    async def test_slow_emitter_does_not_block_caller(self):
+        pipe = Pipe()
+        pipe.valves.emit_interval = 0
+        emitted_events = []
+
+        async def emitter(event):
+            await asyncio.sleep(0.2)
+            emitted_events.append(event["data"]["description"])
+
+        started = time.monotonic()
+        await pipe.emit_status(emitter, "info", "working", False)
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(emitted_events, [])
+
+        await pipe.emit_status(emitter, "info", "Complete", True)
+        self.assertEqual(emitted_events, ["working", "Complete"])
+        self.assertEqual(pipe.status_stats()["sessions"], 0)
+
+    async def test_event_info_is_resolved_once_per_emitter(self):
+        pipe = Pipe()
+        pipe.valves.emit_interval = 0
+        request_info = {"chat_id": "c", "message_id": "m"}
+
+        async def emitter(event):
+            return request_info
+
+        with patch("n8n_pipe.extract_event_info", wraps=extract_event_info) as extract:
+            for _ in range(3):
+                await pipe.emit_status(emitter, "info", "tick", False)
+            await pipe.emit_status(emitter, "info", "Complete", True)
+
+        self.assertEqual(extract.call_count, 1)
+
+    async def test_client_is_pooled_and_reused_across_calls(self):
+        pipe = Pipe()
+        pipe.valves.n8n_url = "https://example.test/webhook"
+        pipe.valves.pool_max_connections = 7
+        response = json_response({"output": "ok"})
+        client = mock_client(response)
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client) as factory:
+            await pipe.pipe({"messages": [{"role": "user", "content": "a"}]})
+            await pipe.pipe({"messages": [{"role": "user", "content": "b"}]})
+
+        factory.assert_called_once()
+        self.assertEqual(factory.call_args.kwargs["limits"].max_connections, 7)
+        self.assertEqual(client.post.await_count, 2)
+
+        await pipe.close()
+        client.aclose.assert_awaited_once()
+
+    async def test_client_rebuilt_when_transport_valves_change(self):
+        pipe = Pipe()
+        first, second = mock_client(), mock_client()
+
+        with patch("n8n_pipe.httpx.AsyncClient", side_effect=[first, second]):
+            self.assertIs(pipe._get_client(), first)
+            pipe.valves.keepalive_expiry = 5.0
+            self.assertIs(pipe._get_client(), second)
+            await asyncio.sleep(0)
+
+        first.aclose.assert_awaited_once()
+
+    async def test_concurrent_calls_overlap_upstream_round_trips(self):
+        pipe = Pipe()
+        pipe.valves.n8n_url = "https://example.test/webhook"
+        in_flight = []
+
+        async def slow_post(url, **kwargs):
+            question = json.loads(kwargs["content"])["chatInput"]
+            in_flight.append(question)
+            await asyncio.sleep(0.05)
+            response = json_response({"output": question})
+            return response
+
+        client = mock_client(post=slow_post)
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            started = asyncio.get_running_loop().time()
+            results = await asyncio.gather(
+                *(
+                    pipe.pipe({"messages": [{"role": "user", "content": str(i)}]})
+                    for i in range(5)
+                )
+            )
+            elapsed = asyncio.get_running_loop().time() - started
+
+        self.assertEqual(results, ["0", "1", "2", "3", "4"])
+        self.assertLess(elapsed, 0.2)
+
+    async def test_streaming_yields_n8n_stream_items_as_they_arrive(self):
+        pipe = Pipe()
+        pipe.valves.stream_response = True
+        body = {"messages": [{"role": "user", "content": "hello"}]}
+        client = mock_stream_client(
+            [
+                '{"type":"begin","metadata":{}}',
+                '{"type":"item","content":"Hel"}',
+                '{"type":"item","content":"lo"}',
+                '{"type":"end","metadata":{}}',
+            ]
+        )
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            tokens = await collect(await pipe.pipe(body))
+
+        self.assertEqual(tokens, ["Hel", "lo"])
+        self.assertEqual(body["messages"][-1], {"role": "assistant", "content": "Hello"})
+
+    async def test_streaming_parses_server_sent_events(self):
+        pipe = Pipe()
+        pipe.valves.stream_response = True
+        body = {"messages": [{"role": "user", "content": "hello"}]}
+        client = mock_stream_client(
+            ['data: {"output": "a"}', "", "data: b", "", "data: [DONE]", ""],
+            content_type="text/event-stream",
+        )
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            tokens = await collect(await pipe.pipe(body))
+
+        self.assertEqual(tokens, ["a", "b"])
+
+    async def test_streaming_falls_back_to_single_shot_json(self):
+        pipe = Pipe()
+        pipe.valves.stream_response = True
+        body = {"messages": [{"role": "user", "content": "hello"}]}
+        client = mock_stream_client(["{", '  "output": "whole reply"', "}"])
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            tokens = await collect(await pipe.pipe(body))
+
+        self.assertEqual(tokens, ["whole reply"])
+        self.assertEqual(body["messages"][-1]["content"], "whole reply")
+
+    async def test_streaming_non_200_reports_error(self):
+        pipe = Pipe()
+        pipe.valves.stream_response = True
+        pipe.valves.max_retries = 0
+        emitted_events = []
+
+        async def emitter(event):
+            emitted_events.append(event)
+
+        client = mock_stream_client([], status_code=502)
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            stream = await pipe.pipe(
+                {"messages": [{"role": "user", "content": "hi"}]},
+                __event_emitter__=emitter,
+            )
+            tokens = await collect(stream)
+
+        self.assertIn("502", tokens[-1])
+        self.assertEqual(emitted_events[-1]["data"]["level"], "error")
+
+    async def test_cache_hit_skips_network_for_normalized_repeat(self):
+        pipe = Pipe()
+        pipe.valves.cache_enabled = True
+        pipe.valves.cache_scope = "global"
+        response = json_response({"output": "cached reply"})
+        client = mock_client(response)
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            first = await pipe.pipe({"messages": [{"role": "user", "content": "What is n8n?"}]})
+            second = await pipe.pipe({"messages": [{"role": "user", "content": "  what IS   n8n? "}]})
+
+        self.assertEqual(first, "cached reply")
+        self.assertEqual(second, "cached reply")
+        self.assertEqual(client.post.await_count, 1)
+        self.assertEqual(pipe.cache_stats()["hits"], 1)
+        self.assertEqual(pipe.cache_stats()["misses"], 1)
+
+    async def test_cache_does_not_share_follow_ups_across_histories(self):
+        pipe = Pipe()
+        pipe.valves.cache_enabled = True
+        pipe.valves.cache_scope = "global"
+        client = mock_client(
+            post=AsyncMock(
+                side_effect=[
+                    json_response({"output": "about n8n"}),
+                    json_response({"output": "about Ollama"}),
+                ]
+            )
+        )
+
+        def conversation(topic):
+            return {
+                "messages": [
+                    {"role": "user", "content": topic},
+                    {"role": "assistant", "content": "..."},
+                    {"role": "user", "content": "and then?"},
+                ]
+            }
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            first = await pipe.pipe(conversation("Tell me about n8n"))
+            second = await pipe.pipe(conversation("Tell me about Ollama"))
+            repeat = await pipe.pipe(conversation("Tell me about n8n"))
+
+        self.assertEqual(
+            (first, second, repeat), ("about n8n", "about Ollama", "about n8n")
+        )
+        self.assertEqual(client.post.await_count, 2)
+        self.assertEqual(pipe.cache_stats()["size"], 2)
+
+    async def test_cache_disabled_by_default(self):
+        pipe = Pipe()
+        response = json_response({"output": "reply"})
+        client = mock_client(response)
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            for _ in range(2):
+                await pipe.pipe({"messages": [{"role": "user", "content": "same"}]})
+
+        self.assertEqual(client.post.await_count, 2)
+
+    async def test_cache_does_not_store_errors(self):
+        pipe = Pipe()
+        pipe.valves.cache_enabled = True
+        client = mock_client(error_response(500, "workflow failed"))
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            for _ in range(2):
+                result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("error", result)
+        self.assertEqual(client.post.await_count, 2)
+        self.assertEqual(pipe.cache_stats()["size"], 0)
+
+    async def test_identical_concurrent_calls_share_one_upstream_request(self):
+        pipe = Pipe()
+        release = asyncio.Event()
+
+        async def slow_post(url, **kwargs):
+            await release.wait()
+            response = json_response({"output": "shared"})
+            return response
+
+        client = mock_client(post=AsyncMock(side_effect=slow_post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            calls = [
+                asyncio.ensure_future(
+                    pipe.pipe({"messages": [{"role": "user", "content": "same"}]})
+                )
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*calls)
+
+        self.assertEqual(results, ["shared"] * 3)
+        self.assertEqual(client.post.await_count, 1)
+        self.assertEqual(pipe.coalesce_stats(), {"leaders": 1, "coalesced": 2, "in_flight": 0})
+
+    async def test_coalesced_callers_all_receive_upstream_error(self):
+        pipe = Pipe()
+        release = asyncio.Event()
+
+        async def failing_post(url, **kwargs):
+            await release.wait()
+            return error_response(500, "workflow failed")
+
+        client = mock_client(post=AsyncMock(side_effect=failing_post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            calls = [
+                asyncio.ensure_future(
+                    pipe.pipe({"messages": [{"role": "user", "content": "same"}]})
+                )
+                for _ in range(2)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*calls)
+
+        self.assertEqual(client.post.await_count, 1)
+        self.assertTrue(all("500" in result["error"] for result in results))
+
+    async def test_session_scoped_coalescing_keeps_chats_separate(self):
+        pipe = Pipe()
+        response = json_response({"output": "reply"})
+        client = mock_client(post=AsyncMock(return_value=response))
+
+        def emitter_for(chat_id):
+            request_info = {"chat_id": chat_id, "message_id": "m"}
+
+            async def emitter(event):
+                return request_info
+
+            return emitter
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            await asyncio.gather(
+                pipe.pipe({"messages": [{"role": "user", "content": "q"}]}, __event_emitter__=emitter_for("a")),
+                pipe.pipe({"messages": [{"role": "user", "content": "q"}]}, __event_emitter__=emitter_for("b")),
+            )
+
+        self.assertEqual(client.post.await_count, 2)
+        self.assertEqual(pipe.coalesce_stats()["coalesced"], 0)
+
+    async def test_batch_mode_sends_one_array_and_demultiplexes_replies(self):
+        pipe = Pipe()
+        pipe.valves.batch_enabled = True
+        pipe.valves.batch_max_wait_ms = 20
+        posted = []
+
+        async def post(url, content, **kwargs):
+            items = json.loads(content)
+            posted.append(items)
+            return json_response(
+                [{"requestId": i["requestId"], "output": f"re: {i['chatInput']}"} for i in reversed(items)]
+            )
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            results = await asyncio.gather(
+                *(pipe.pipe({"messages": [{"role": "user", "content": q}]}) for q in ("a", "b", "c"))
+            )
+
+        self.assertEqual(results, ["re: a", "re: b", "re: c"])
+        self.assertEqual(len(posted), 1)
+        self.assertEqual(len({item["requestId"] for item in posted[0]}), 3)
+        self.assertEqual(pipe.batch_stats()["batches"], 1)
+
+    async def test_batch_item_error_only_fails_that_chat(self):
+        pipe = Pipe()
+        pipe.valves.batch_enabled = True
+
+        async def post(url, content, **kwargs):
+            return json_response(
+                [
+                    {"requestId": i["requestId"], "error": "agent crashed"}
+                    if i["chatInput"] == "bad"
+                    else {"requestId": i["requestId"], "output": "ok"}
+                    for i in json.loads(content)
+                ]
+            )
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            good, bad = await asyncio.gather(
+                pipe.pipe({"messages": [{"role": "user", "content": "good"}]}),
+                pipe.pipe({"messages": [{"role": "user", "content": "bad"}]}),
+            )
+
+        self.assertEqual(good, "ok")
+        self.assertIn("agent crashed", bad["error"])
+        self.assertEqual(client.post.await_count, 1)
+
+    async def test_batch_flushes_early_at_max_size(self):
+        pipe = Pipe()
+        pipe.valves.batch_enabled = True
+        pipe.valves.batch_max_size = 2
+        pipe.valves.batch_max_wait_ms = 10_000
+
+        async def post(url, content, **kwargs):
+            return json_response(
+                [{"requestId": i["requestId"], "output": "ok"} for i in json.loads(content)]
+            )
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            results = await asyncio.wait_for(
+                asyncio.gather(
+                    *(pipe.pipe({"messages": [{"role": "user", "content": q}]}) for q in ("a", "b"))
+                ),
+                timeout=1,
+            )
+
+        self.assertEqual(results, ["ok", "ok"])
+
+    async def test_response_over_size_limit_is_rejected_from_content_length(self):
+        pipe = Pipe()
+        pipe.valves.max_response_bytes = 10
+        response = json_response({"output": "x" * 100})
+        response.headers = {"content-length": str(len(response.content))}
+        client = mock_client(response)
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("byte limit", result["error"])
+
+    async def test_response_over_size_limit_is_aborted_while_reading(self):
+        pipe = Pipe()
+        pipe.valves.max_response_bytes = 10
+        client = mock_client(json_response({"output": "x" * 100}))
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("byte limit", result["error"])
+
+    async def test_payload_is_serialized_once_across_retries(self):
+        pipe = Pipe()
+        pipe.valves.retry_backoff_base = 0
+        client = mock_client(
+            post=AsyncMock(side_effect=[error_response(503, "busy"), json_response({"output": "ok"})])
+        )
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client), patch.object(
+            pipe, "_encode_payload", wraps=pipe._encode_payload
+        ) as encode:
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertEqual(result, "ok")
+        self.assertEqual(encode.call_count, 1)
+        first, second = (c.kwargs["content"] for c in client.post.await_args_list)
+        self.assertIs(first, second)
+
+    async def test_retries_503_with_backoff_then_succeeds(self):
+        pipe = Pipe()
+        pipe.valves.retry_backoff_base = 0
+        ok = json_response({"output": "recovered"})
+        client = mock_client(
+            post=AsyncMock(side_effect=[error_response(503, "busy"), ok])
+        )
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertEqual(result, "recovered")
+        self.assertEqual(client.post.await_count, 2)
+        self.assertEqual(client.post.call_args.kwargs["timeout"].connect, 10.0)
+
+    async def test_does_not_retry_workflow_errors_or_read_timeouts(self):
+        pipe = Pipe()
+        pipe.valves.retry_backoff_base = 0
+        client = mock_client(post=AsyncMock(side_effect=httpx.ReadTimeout("timed out")))
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("timed out", result["error"])
+        self.assertEqual(client.post.await_count, 1)
+
+    async def test_dropped_connection_is_not_retried(self):
+        pipe = Pipe()
+        pipe.valves.retry_backoff_base = 0
+        pipe.valves.max_retries = 3
+        client = mock_client(
+            post=AsyncMock(side_effect=httpx.RemoteProtocolError("Server disconnected"))
+        )
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("Server disconnected", result["error"])
+        self.assertEqual(client.post.await_count, 1)
+
+    async def test_connect_errors_exhaust_retries(self):
+        pipe = Pipe()
+        pipe.valves.retry_backoff_base = 0
+        pipe.valves.max_retries = 3
+        client = mock_client(post=AsyncMock(side_effect=httpx.ConnectError("refused")))
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            result = await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        self.assertIn("refused", result["error"])
+        self.assertEqual(client.post.await_count, 4)
+
+    async def test_circuit_opens_and_fails_fast(self):
+        pipe = Pipe()
+        pipe.valves.max_retries = 0
+        pipe.valves.circuit_failure_threshold = 2
+        pipe.valves.emit_interval = 0
+        emitted_events = []
+
+        async def emitter(event):
+            emitted_events.append(event["data"]["description"])
+
+        client = mock_client(error_response(502, "bad gateway"))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            for i in range(3):
+                result = await pipe.pipe(
+                    {"messages": [{"role": "user", "content": str(i)}]},
+                    __event_emitter__=emitter,
+                )
+
+        self.assertEqual(client.post.await_count, 2)
+        self.assertIn("circuit breaker is open", result["error"])
+        self.assertEqual(pipe.circuit_state(), "open")
+        self.assertTrue(any("circuit open" in e for e in emitted_events))
+
+    async def test_round_robin_spreads_calls_across_endpoints(self):
+        pipe = Pipe()
+        pipe.valves.n8n_url = "https://a.test/hook, https://b.test/hook"
+        pipe.valves.coalesce_requests = False
+        response = json_response({"output": "ok"})
+        client = mock_client(response)
+
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            for i in range(4):
+                await pipe.pipe({"messages": [{"role": "user", "content": str(i)}]})
+
+        urls = [call.args[0] for call in client.post.call_args_list]
+        self.assertEqual(urls, ["https://a.test/hook", "https://b.test/hook"] * 2)
+
+    async def test_failing_endpoint_is_ejected_and_retry_uses_another(self):
+        pipe = Pipe()
+        pipe.valves.n8n_url = "https://a.test/hook\nhttps://b.test/hook"
+        pipe.valves.circuit_failure_threshold = 1
+        pipe.valves.retry_backoff_base = 0
+        ok = json_response({"output": "ok"})
+
+        async def post(url, **kwargs):
+            if url.startswith("https://a."):
+                raise httpx.ConnectError("refused")
+            return ok
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            results = [
+                await pipe.pipe({"messages": [{"role": "user", "content": str(i)}]})
+                for i in range(3)
+            ]
+
+        self.assertEqual(results, ["ok"] * 3)
+        self.assertEqual(client.post.await_count, 4)
+        self.assertEqual(pipe.endpoint_stats()["https://a.test/hook"]["state"], "open")
+        self.assertEqual(pipe.circuit_state(), "closed")
+
+    async def test_forward_context_sends_only_new_messages_per_chat(self):
+        pipe = Pipe()
+        pipe.valves.forward_context = True
+        sent = []
+
+        async def post(url, **kwargs):
+            sent.append(json.loads(kwargs["content"])["context"])
+            return json_response({"output": f"reply {len(sent)}"})
+
+        request_info = {"chat_id": "chat-1", "message_id": "m"}
+
+        async def emitter(event):
+            return request_info
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        body = {"messages": [{"role": "user", "content": "first"}]}
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            await pipe.pipe(body, __event_emitter__=emitter)
+            body["messages"].append({"role": "user", "content": "second"})
+            await pipe.pipe(body, __event_emitter__=emitter)
+
+        self.assertEqual(sent[0], {"reset": True, "messages": []})
+        self.assertEqual(
+            sent[1],
+            {
+                "reset": False,
+                "messages": [{"role": "assistant", "content": "reply 1"}],
+            },
+        )
+
+
+class TestLoadBalancer(unittest.TestCase):
+    def make_balancer(self, count=3):
+        balancer = LoadBalancer()
+        balancer.configure([f"https://n{i}.test" for i in range(count)], 1, 30)
+        return balancer
+
+    def test_session_affinity_is_stable_and_skips_ejected_endpoints(self):
+        balancer = self.make_balancer()
+        first = balancer.pick("session_affinity", "chat-1")
+        self.assertIs(balancer.pick("session_affinity", "chat-1"), first)
+
+        first.breaker.record_failure()
+        moved = balancer.pick("session_affinity", "chat-1")
+        self.assertIsNot(moved, first)
+        self.assertIs(balancer.pick("session_affinity", "chat-1"), moved)
+
+    def test_least_outstanding_prefers_idle_endpoint(self):
+        balancer = self.make_balancer(2)
+        busy, idle = balancer.endpoints.values()
+        busy.outstanding = 3
+
+        self.assertIs(balancer.pick("least_outstanding"), idle)
+
+    def test_recovered_endpoint_ramps_weight_gradually(self):
+        endpoint = Endpoint("https://n.test")
+        endpoint.recovered_at = 100.0
+
+        self.assertAlmostEqual(endpoint.weight(30, 115.0), 0.5)
+        self.assertEqual(endpoint.weight(30, 131.0), 1.0)
+        self.assertIsNone(endpoint.recovered_at)
+
+class TestContextTracker(unittest.TestCase):
+    def test_edited_history_resets_cursor(self):
+        tracker = ContextTracker()
+        messages = [
+            {"role": "user", "content": "a"},
+            {"role": "assistant", "content": "b"},
+            {"role": "user", "content": "c"},
+        ]
+        _, pending = tracker.delta("chat", messages, 0)
+        tracker.commit(pending)
+
+        edited = [{"role": "user", "content": "A"}] + messages[1:]
+        context, _ = tracker.delta("chat", edited, 0)
+
+        self.assertTrue(context["reset"])
+        self.assertEqual(len(context["messages"]), 2)
+
+    def test_uncommitted_delta_is_resent(self):
+        tracker = ContextTracker()
+        messages = [{"role": "user", "content": "a"}, {"role": "user", "content": "b"}]
+        tracker.delta("chat", messages, 0)
+
+        context, _ = tracker.delta("chat", messages, 0)
+
+        self.assertTrue(context["reset"])
+        self.assertEqual(context["messages"], messages[:1])
+
+    def test_char_budget_keeps_newest_turns(self):
+        tracker = ContextTracker()
+        messages = [
+            {"role": "user", "content": "old message"},
+            {"role": "assistant", "content": [{"type": "text", "text": "1234"}]},
+            {"role": "user", "content": "newest"},
+            {"role": "user", "content": "question"},
+        ]
+
+        context, _ = tracker.delta(None, messages, 8)
+
+        self.assertTrue(context["truncated"])
+        self.assertEqual(
+            context["messages"],
+            [
+                {"role": "assistant", "content": "34"},
+                {"role": "user", "content": "newest"},
+            ],
+        )
+
+    def test_cursor_store_is_bounded(self):
+        tracker = ContextTracker(max_sessions=2)
+        for chat_id in ("a", "b", "c"):
+            tracker.commit(tracker.delta(chat_id, [], 0)[1])
+
+        self.assertTrue(tracker.delta("a", [], 0)[0]["reset"])
+        self.assertFalse(tracker.delta("c", [], 0)[0]["reset"])
+
+
+class TestExtractJsonField(unittest.TestCase):
+    def test_stops_at_field_without_orjson(self):
+        raw = b'{"meta": {"docs": ["}", 1]}, "output": "answer", "rest": not-json'
+
+        with patch("n8n_pipe.orjson", None):
+            self.assertEqual(extract_json_field(raw, "output"), "answer")
+
+    def test_missing_field_raises_key_error(self):
+        with patch("n8n_pipe.orjson", None):
+            with self.assertRaises(KeyError):
+                extract_json_field(b'{"other": 1}', "output")
+
+        with self.assertRaises(KeyError):
+            extract_json_field(b'{"other": 1}', "output")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_half_open_allows_single_probe_and_closes_on_success(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        with patch("n8n_pipe.time.monotonic", return_value=100.0):
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+        with patch("n8n_pipe.time.monotonic", return_value=111.0):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertFalse(breaker.allow())
+            breaker.record_success()
+            self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+        with patch("n8n_pipe.time.monotonic", return_value=100.0):
+            for _ in range(3):
+                breaker.record_failure()
+        with patch("n8n_pipe.time.monotonic", return_value=111.0):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow())
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_lru_eviction_keeps_recently_used_entries(self):
+        cache = ResponseCache(max_entries=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_expired_entries_are_misses(self):
+        cache = ResponseCache(max_entries=2, ttl=10)
+
+        with patch("n8n_pipe.time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with patch("n8n_pipe.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 1, "evictions": 0, "size": 0})
+
+
+class TestConcurrencyLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_waiters_are_granted_in_fifo_order(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=5)
+        order = []
+
+        async def worker(name):
+            async with limiter.slot():
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(worker(i) for i in range(4)))
+
+        self.assertEqual(order, [0, 1, 2, 3])
+        self.assertEqual(limiter.stats(), {"active": 0, "queued": 0, "rejected": 0})
+
+    async def test_full_queue_rejects_immediately(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1)
+        await limiter.acquire()
+        queued = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+
+        with self.assertRaises(QueueFullError):
+            await limiter.acquire()
+
+        limiter.release()
+        await queued
+        self.assertEqual(limiter.stats(), {"active": 1, "queued": 0, "rejected": 1})
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=5)
+        await limiter.acquire()
+        first = asyncio.ensure_future(limiter.acquire())
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        limiter.release()
+        await second
+
+        self.assertEqual(limiter.stats()["active"], 1)
+        self.assertEqual(limiter.stats()["queued"], 0)
+
+    async def test_positions_follow_grants_and_cancellations(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=5)
+        await limiter.acquire()
+        positions = {name: [] for name in "abc"}
+
+        def waiter(name):
+            async def on_queued(position):
+                positions[name].append(position)
+
+            return asyncio.ensure_future(limiter.acquire(on_queued))
+
+        a, b, c = waiter("a"), waiter("b"), waiter("c")
+        await asyncio.sleep(0)
+        b.cancel()
+        await asyncio.gather(b, return_exceptions=True)
+        await asyncio.sleep(0)
+        limiter.release()
+        await a
+        await asyncio.sleep(0)
+
+        self.assertEqual(positions["a"], [0])
+        self.assertEqual(positions["c"], [2, 0])
+        self.assertEqual(limiter.stats()["queued"], 1)
+        limiter.release()
+        await c
+
+    async def test_pipe_reports_queue_position_while_waiting(self):
+        pipe = Pipe()
+        pipe.valves.max_concurrent_requests = 1
+        pipe.valves.emit_interval = 0
+        pipe.valves.coalesce_requests = False
+        release = asyncio.Event()
+        emitted_events = []
+
+        async def emitter(event):
+            emitted_events.append(event["data"]["description"])
+
+        async def slow_post(url, **kwargs):
+            await release.wait()
+            response = json_response({"output": "ok"})
+            return response
+
+        client = mock_client(post=AsyncMock(side_effect=slow_post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            calls = [
+                asyncio.ensure_future(
+                    pipe.pipe({"messages": [{"role": "user", "content": str(i)}]}, __event_emitter__=emitter)
+                )
+                for i in range(3)
+            ]
+            for _ in range(5):
+                await asyncio.sleep(0)
+            self.assertEqual(pipe.limiter_stats()["queued"], 2)
+            release.set()
+            results = await asyncio.gather(*calls)
+
+        self.assertEqual(results, ["ok"] * 3)
+        self.assertIn("Queued (0 ahead)", emitted_events)
+        self.assertIn("Queued (1 ahead)", emitted_events)
+
+    async def test_pipe_rejects_when_queue_is_full(self):
+        pipe = Pipe()
+        pipe.valves.max_concurrent_requests = 1
+        pipe.valves.max_queue_size = 0
+        pipe.valves.coalesce_requests = False
+        release = asyncio.Event()
+
+        async def slow_post(url, **kwargs):
+            await release.wait()
+            response = json_response({"output": "ok"})
+            return response
+
+        client = mock_client(post=AsyncMock(side_effect=slow_post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            first = asyncio.ensure_future(pipe.pipe({"messages": [{"role": "user", "content": "a"}]}))
+            await asyncio.sleep(0)
+            rejected = await pipe.pipe({"messages": [{"role": "user", "content": "b"}]})
+            release.set()
+            await first
+
+        self.assertIn("queue is full", rejected["error"])
+
+
+class TestMicroBatcher(unittest.IsolatedAsyncioTestCase):
+    async def test_missing_result_fails_only_that_item(self):
+        async def send(entries):
+            return {request_id: item * 2 for request_id, item in entries[:1]}
+
+        batcher = MicroBatcher(send, max_size=10, max_wait=0)
+        first, second = await asyncio.gather(
+            batcher.submit(1), batcher.submit(2), return_exceptions=True
+        )
+
+        self.assertEqual(first, 2)
+        self.assertIn("no result", str(second))
+
+    async def test_send_failure_fails_whole_batch(self):
+        async def send(entries):
+            raise RuntimeError("webhook down")
+
+        batcher = MicroBatcher(send, max_size=10, max_wait=0)
+        results = await asyncio.gather(
+            batcher.submit(1), batcher.submit(2), return_exceptions=True
+        )
+
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(batcher.stats()["batches"], 1)
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    async def test_pipe_records_phase_timings_sizes_and_status_per_endpoint(self):
+        pipe = Pipe()
+        pipe.valves.n8n_url = "https://a.test/hook"
+
+        async def post(url, **kwargs):
+            trace = kwargs["extensions"]["trace"]
+            for event in (
+                "connection.connect_tcp.started",
+                "connection.connect_tcp.complete",
+                "http11.send_request_headers.started",
+                "http11.receive_response_headers.complete",
+            ):
+                await trace(event, {})
+            return json_response({"output": "ok"})
+
+        client = mock_client(post=AsyncMock(side_effect=post))
+        with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+            await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        latency = pipe.metrics_snapshot()["latency"]["https://a.test/hook"]
+        for phase in ("queue_wait", "connect", "ttfb", "decode", "total"):
+            self.assertEqual(latency[phase]["count"], 1, phase)
+        self.assertIsNotNone(latency["total"]["p99"])
+
+        text = pipe.prometheus_metrics()
+        self.assertIn(
+            'n8n_pipe_phase_seconds_count{phase="total",endpoint="https://a.test/hook"} 1',
+            text,
+        )
+        self.assertIn(
+            'n8n_pipe_responses_total{endpoint="https://a.test/hook",status="200"} 1', text
+        )
+        self.assertIn('n8n_pipe_payload_bytes_count{direction="request"', text)
+        self.assertIn('n8n_pipe_calls_total{outcome="upstream"} 1', text)
+
+    async def test_metrics_textfile_is_written_atomically(self):
+        pipe = Pipe()
+        client = mock_client(json_response({"output": "ok"}))
+
+        with tempfile.TemporaryDirectory() as directory:
+            pipe.valves.metrics_textfile = os.path.join(directory, "n8n_pipe.prom")
+            with patch("n8n_pipe.httpx.AsyncClient", return_value=client):
+                await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+            with open(pipe.valves.metrics_textfile) as handle:
+                self.assertIn("n8n_pipe_phase_seconds_bucket", handle.read())
+            self.assertEqual(os.listdir(directory), ["n8n_pipe.prom"])
+
+    async def test_langfuse_receives_one_span_per_phase(self):
+        pipe = Pipe()
+        pipe.valves.langfuse_enabled = True
+        langfuse = Mock()
+        client = mock_client(json_response({"output": "ok"}))
+
+        with patch("n8n_pipe.Langfuse", return_value=langfuse), patch(
+            "n8n_pipe.httpx.AsyncClient", return_value=client
+        ):
+            await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        trace = langfuse.trace.return_value
+        self.assertEqual(langfuse.trace.call_args.kwargs["name"], "n8n_pipe")
+        span_names = {call.kwargs["name"] for call in trace.span.call_args_list}
+        self.assertEqual(span_names, {"queue_wait", "decode", "total"})
+
+    async def test_langfuse_v3_client_is_reported_once(self):
+        pipe = Pipe()
+        pipe.valves.langfuse_enabled = True
+        langfuse = Mock(spec=["start_span", "flush"])
+
+        with patch("n8n_pipe.Langfuse", return_value=langfuse), patch(
+            "n8n_pipe.httpx.AsyncClient",
+            side_effect=lambda **kwargs: mock_client(json_response({"output": "ok"})),
+        ), self.assertLogs("n8n_pipe", level="WARNING") as logs:
+            for _ in range(3):
+                await pipe.pipe({"messages": [{"role": "user", "content": "q"}]})
+
+        langfuse_warnings = [line for line in logs.output if "Langfuse" in line]
+        self.assertEqual(len(langfuse_warnings), 1)
+        self.assertIn("langfuse<3", langfuse_warnings[0])
+
+
+class TestHistogram(unittest.TestCase):
+    def test_quantiles_interpolate_within_buckets(self):
+        histogram = Histogram((1.0, 2.0, float("inf")))
+        for value in (0.5, 1.5, 1.5, 1.5, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 3, 1])
+        self.assertAlmostEqual(histogram.quantile(0.5), 1.5)
+        self.assertEqual(histogram.quantile(0.99), 2.0)
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_call_metrics_sums_repeated_phases(self):
+        call = CallMetrics()
+        call.span("queue_wait", 1.0, 1.5)
+        call.span("queue_wait", 2.0, 2.25)
+
+        self.assertAlmostEqual(call.duration("queue_wait"), 0.75)
+        self.assertIsNone(call.duration("connect"))
+
 
 if __name__ == "__main__":
     unittest.main()
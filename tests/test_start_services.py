@@ -1,6 +1,50 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from unittest.mock import patch
 
-from start_services import _toggle_searxng_cap_drop
+import start_services
+from start_services import (
+    _toggle_searxng_cap_drop,
+    Tracer,
+    check_service_ready,
+    choose_profile,
+    detect_host,
+    export_images,
+    command_label,
+    generate_searxng_secret_key,
+    get_update_services,
+    import_images,
+    load_compose_config,
+    parse_resource_weights,
+    plan_resource_limits,
+    provision_services,
+    render_caddyfile,
+    render_caddyfile_for,
+    render_limits_override,
+    render_env_secrets,
+    searxng_cap_drop_active,
+    supabase_jwt,
+    incremental_deploy,
+    normalize_image_ref,
+    plan_incremental_deploy,
+    pull_images_parallel,
+    probe_endpoint,
+    resolve_service_images,
+    wait_for_services,
+    warm_ollama_models,
+)
 
 
 COMPOSE_FIXTURE = """services:
@@ -48,5 +92,813 @@ class TestStartServices(unittest.TestCase):
         self.assertIn("  searxng:\r\n    container_name: searxng\r\n    cap_drop:\r\n      - ALL", restored)
 
 
+
+def completed(cmd, returncode=0, stdout="", stderr=""):
+    return subprocess.CompletedProcess(cmd, returncode, stdout=stdout, stderr=stderr)
+
+
+class TestImagePulls(unittest.TestCase):
+    def test_resolve_service_images_follows_dependencies(self):
+        config = {
+            "services": {
+                "langfuse-web": {"image": "langfuse/langfuse:3", "depends_on": {"postgres": {}}},
+                "postgres": {"image": "postgres:17"},
+                "built-locally": {"build": "."},
+                "flowise": {"image": "flowiseai/flowise"},
+            }
+        }
+
+        images = resolve_service_images(config, ["langfuse-web", "built-locally"])
+
+        self.assertEqual(images, {"langfuse-web": "langfuse/langfuse:3", "postgres": "postgres:17"})
+        self.assertEqual(len(resolve_service_images(config)), 3)
+
+    @patch("start_services.time.sleep")
+    def test_parallel_pull_retries_only_failed_image(self, _sleep):
+        calls = []
+        failures = {"flaky/image": 1}
+
+        def run(cmd, **kwargs):
+            image = cmd[-1]
+            calls.append(image)
+            if failures.get(image):
+                failures[image] -= 1
+                return completed(cmd, 1, stderr="TLS handshake timeout")
+            return completed(cmd)
+
+        with patch("start_services.subprocess.run", side_effect=run):
+            results = pull_images_parallel(
+                ["stable/image", "flaky/image", "stable/image"], skip_up_to_date=False
+            )
+
+        self.assertEqual(sorted(calls), ["flaky/image", "flaky/image", "stable/image"])
+        attempts = {result["image"]: result["attempts"] for result in results}
+        self.assertEqual(attempts, {"stable/image": 1, "flaky/image": 2})
+
+    @patch("start_services.time.sleep")
+    def test_parallel_pull_raises_with_failed_images(self, _sleep):
+        with patch("start_services.subprocess.run", return_value=completed([], 1)):
+            with self.assertRaises(RuntimeError) as raised:
+                pull_images_parallel(["broken/image"], retries=2, skip_up_to_date=False)
+
+        self.assertIn("broken/image", str(raised.exception))
+
+    def test_parallel_pull_skips_images_matching_remote_digest(self):
+        def run(cmd, **kwargs):
+            if cmd[:3] == ["docker", "image", "inspect"]:
+                return completed(cmd, stdout='["n8nio/n8n@sha256:abc"]')
+            if cmd[:3] == ["docker", "buildx", "imagetools"]:
+                return completed(cmd, stdout='{"digest": "sha256:abc"}')
+            raise AssertionError(f"unexpected command {cmd}")
+
+        with patch("start_services.subprocess.run", side_effect=run):
+            results = pull_images_parallel(["n8nio/n8n:latest"])
+
+        self.assertEqual(results[0]["status"], "up-to-date")
+
+
+
+STACK_CONFIG = {
+    "services": {
+        "postgres": {"image": "postgres:17"},
+        "minio": {"image": "minio/minio"},
+        "langfuse-worker": {"image": "langfuse/langfuse-worker:3", "depends_on": {"postgres": {}, "minio": {}}},
+        "langfuse-web": {"image": "langfuse/langfuse:3", "depends_on": {"postgres": {}}},
+        "qdrant": {"image": "qdrant/qdrant"},
+    }
+}
+
+
+class TestIncrementalDeploy(unittest.TestCase):
+    def test_unchanged_stack_recreates_nothing(self):
+        hashes, _, _ = plan_incremental_deploy(STACK_CONFIG, None)
+
+        _, recreate, removed = plan_incremental_deploy(STACK_CONFIG, hashes)
+
+        self.assertEqual(recreate, [])
+        self.assertEqual(removed, [])
+
+    def test_changed_service_recreates_dependents_only(self):
+        hashes, _, _ = plan_incremental_deploy(STACK_CONFIG, None)
+        changed = json.loads(json.dumps(STACK_CONFIG))
+        changed["services"]["postgres"]["environment"] = {"POSTGRES_PASSWORD": "new"}
+
+        _, recreate, _ = plan_incremental_deploy(changed, hashes)
+
+        self.assertEqual(recreate, ["langfuse-web", "langfuse-worker", "postgres"])
+
+    def test_new_local_image_counts_as_change(self):
+        hashes, _, _ = plan_incremental_deploy(STACK_CONFIG, None, {"qdrant/qdrant:latest": "sha256:old"})
+
+        _, recreate, _ = plan_incremental_deploy(STACK_CONFIG, hashes, {"qdrant/qdrant:latest": "sha256:new"})
+
+        self.assertEqual(recreate, ["qdrant"])
+
+    def test_normalize_image_ref_matches_docker_images_output(self):
+        self.assertEqual(normalize_image_ref("docker.io/library/caddy:2-alpine"), "caddy:2-alpine")
+        self.assertEqual(normalize_image_ref("flowiseai/flowise"), "flowiseai/flowise:latest")
+        self.assertEqual(normalize_image_ref("localhost:5000/app"), "localhost:5000/app:latest")
+
+    def test_incremental_deploy_only_force_recreates_changed_services(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            state_path = os.path.join(tmp, "state.json")
+            hashes, _, _ = plan_incremental_deploy(STACK_CONFIG, None)
+            hashes["qdrant"] = "stale"
+            with open(state_path, "w") as file:
+                json.dump({"services": hashes}, file)
+
+            commands = []
+            with patch("start_services.load_compose_config", return_value=STACK_CONFIG), \
+                    patch("start_services.local_image_ids", return_value={}), \
+                    patch("start_services.run_command", side_effect=commands.append):
+                incremental_deploy("cpu", "private", path=state_path)
+
+            with open(state_path) as file:
+                saved = json.load(file)["services"]
+
+        self.assertEqual(commands[0][-4:], ["-d", "--no-deps", "--force-recreate", "qdrant"])
+        self.assertIn("--no-recreate", commands[1])
+        self.assertNotIn("down", sum(commands, []))
+        self.assertNotEqual(saved["qdrant"], "stale")
+
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200 if self.path == "/healthz" else 503)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestReadiness(unittest.TestCase):
+    def test_healthcheck_takes_precedence_over_probes(self):
+        self.assertEqual(
+            check_service_ready("postgres", {"State": "running", "Health": "starting"}),
+            ("waiting", "healthcheck"),
+        )
+        self.assertEqual(
+            check_service_ready("postgres", {"State": "running", "Health": "healthy"}),
+            ("ready", "healthcheck"),
+        )
+
+    def test_one_shot_containers_complete_or_fail_on_exit_code(self):
+        self.assertEqual(check_service_ready("ollama-pull-llama-cpu", {"State": "exited", "ExitCode": 0})[0], "completed")
+        self.assertEqual(check_service_ready("ollama-pull-llama-cpu", {"State": "exited", "ExitCode": 1})[0], "failed")
+
+    def test_unpublished_service_is_reported_unprobed_not_ready(self):
+        self.assertEqual(check_service_ready("n8n", {"State": "running", "Publishers": []}), ("unprobed", "running"))
+        self.assertEqual(check_service_ready("minio", {"State": "running"}), ("unprobed", "running"))
+
+        output = io.StringIO()
+        with patch("start_services.compose_containers", return_value={"minio": {"State": "running"}}), \
+                redirect_stdout(output):
+            self.assertTrue(wait_for_services(services=["minio"], timeout=5))
+
+        self.assertIn("running (unprobed)", output.getvalue())
+        self.assertNotIn("minio: ready", output.getvalue())
+
+    def test_http_probe_uses_published_port(self):
+        server = HTTPServer(("127.0.0.1", 0), _HealthHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            port = server.server_address[1]
+            self.assertTrue(probe_endpoint("http", port, "/healthz"))
+            self.assertFalse(probe_endpoint("http", port, "/broken"))
+            self.assertTrue(probe_endpoint("tcp", port))
+            container = {"State": "running", "Publishers": [{"TargetPort": 8080, "PublishedPort": port}]}
+            self.assertEqual(check_service_ready("searxng", container), ("ready", "http"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @patch("start_services.time.sleep")
+    def test_wait_polls_until_all_ready_and_reports_timeouts(self, _sleep):
+        snapshots = iter([
+            {"postgres": {"State": "running", "Health": "starting"}},
+            {"postgres": {"State": "running", "Health": "healthy"}, "qdrant": {"State": "created"}},
+        ])
+
+        def containers(**kwargs):
+            return next(snapshots, {"postgres": {"State": "running", "Health": "healthy"}})
+
+        with patch("start_services.compose_containers", side_effect=containers), \
+                patch("start_services.time.monotonic", side_effect=[0, 0, 1, 1, 2, 2, 3, 3, 4, 10, 10, 10]):
+            ready = wait_for_services(services=["postgres", "qdrant"], timeout=5, interval=1)
+
+        self.assertFalse(ready)
+
+
+
+class _FakeOllamaHandler(BaseHTTPRequestHandler):
+    models = {"big-chat:latest": 8_000_000_000, "small-chat:latest": 4_000_000_000, "embedder:latest": 300_000_000}
+    requests = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._reply(200, {"models": [{"name": n, "size": s} for n, s in self.models.items()]})
+        else:
+            self._reply(200, {"version": "0.0.0"})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append((self.path, payload))
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            if f"{payload['model']}:latest" not in cls.models:
+                self._reply(404, {"error": f"model '{payload['model']}' not found"})
+                return
+            if self.path == "/api/generate" and payload["model"].startswith("embedder"):
+                self._reply(400, {"error": "does not support generate"})
+                return
+            time.sleep(0.05)
+            self._reply(200, {"done": True})
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestModelWarmup(unittest.TestCase):
+    def setUp(self):
+        _FakeOllamaHandler.requests = []
+        _FakeOllamaHandler.max_active = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeOllamaHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_warms_chat_and_embedding_models_with_keep_alive(self):
+        results = warm_ollama_models(["small-chat", "embedder"], base_url=self.url, keep_alive=-1,
+                                     memory_budget=10**12)
+
+        self.assertEqual({r["model"]: r["status"] for r in results}, {"small-chat": "loaded", "embedder": "loaded"})
+        self.assertIn(("/api/embed", {"model": "embedder", "input": "", "keep_alive": -1}), _FakeOllamaHandler.requests)
+        self.assertTrue(all(payload["keep_alive"] == -1 for _, payload in _FakeOllamaHandler.requests))
+
+    def test_memory_budget_serializes_large_models(self):
+        warm_ollama_models(["big-chat", "small-chat"], base_url=self.url, memory_budget=9_000_000_000)
+
+        self.assertEqual(_FakeOllamaHandler.max_active, 1)
+        self.assertEqual(_FakeOllamaHandler.requests[0][1]["model"], "big-chat")
+
+    def test_unknown_model_fails_fast_when_nothing_is_pulling(self):
+        started = time.monotonic()
+        with patch("start_services.ollama_pull_running", return_value=False):
+            results = warm_ollama_models(["small-chat", "smal-chat"], base_url=self.url, memory_budget=10**12)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual({r["model"]: r["status"] for r in results},
+                         {"small-chat": "loaded", "smal-chat": "not installed"})
+        self.assertNotIn("smal-chat", [payload["model"] for _, payload in _FakeOllamaHandler.requests])
+
+    def test_gpu_profiles_budget_against_vram(self):
+        with patch("start_services.subprocess.run", return_value=completed([], stdout="6000\n2000\n")), \
+                patch("start_services.available_memory_bytes", return_value=1):
+            self.assertEqual(start_services.model_memory_budget("gpu-nvidia"), 8000 * 1024 * 1024)
+            self.assertEqual(start_services.model_memory_budget("cpu"), 1)
+        with patch("start_services.subprocess.run", side_effect=FileNotFoundError("nvidia-smi")):
+            self.assertIsNone(start_services.model_memory_budget("gpu-nvidia"))
+
+
+
+class TestComposeConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        with open("docker-compose.yml", "w") as file:
+            file.write("services: {}\n")
+        start_services._compose_configs.clear()
+        self.addCleanup(start_services._compose_configs.clear)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def run_compose(self, cmd, **kwargs):
+        self.calls += 1
+        return completed(cmd, stdout=json.dumps({"services": {"n8n": {"image": f"n8n:{self.calls}"}}}))
+
+    def test_config_is_resolved_once_until_files_change(self):
+        self.calls = 0
+        with patch("start_services.subprocess.run", side_effect=self.run_compose):
+            first = load_compose_config("cpu", "private")
+            self.assertIs(load_compose_config("cpu", "private"), first)
+            self.assertEqual(self.calls, 1)
+
+            with open(".env", "w") as file:
+                file.write("N8N_VERSION=2\n")
+            changed = load_compose_config("cpu", "private")
+            load_compose_config("gpu-nvidia", "private")
+
+        self.assertEqual(changed["services"]["n8n"]["image"], "n8n:2")
+        self.assertEqual(self.calls, 3)
+
+    def test_config_is_not_reused_across_runs(self):
+        self.calls = 0
+        with patch("start_services.subprocess.run", side_effect=self.run_compose):
+            load_compose_config("cpu", "private")
+            start_services._compose_configs.clear()
+            load_compose_config("cpu", "private")
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(os.listdir("."), ["docker-compose.yml"])
+
+    def test_failed_resolution_is_not_cached(self):
+        failure = subprocess.CalledProcessError(1, ["docker"], stderr="bad yaml")
+        with patch("start_services.subprocess.run", side_effect=failure):
+            with self.assertRaises(subprocess.CalledProcessError):
+                load_compose_config("cpu", "private")
+
+        self.assertEqual(start_services._compose_configs, {})
+
+    def test_profile_questions_are_answered_from_config(self):
+        config = {
+            "services": {
+                "open-webui": {"image": "ghcr.io/open-webui/open-webui:main"},
+                "ollama-gpu-amd": {"image": "ollama/ollama:rocm"},
+                "ollama-pull-llama-gpu-amd": {"image": "ollama/ollama:rocm", "entrypoint": ["/bin/sh"]},
+                "searxng": {"image": "searxng/searxng", "cap_drop": ["ALL"]},
+            }
+        }
+
+        self.assertEqual(get_update_services(config=config), ["open-webui", "ollama-gpu-amd"])
+        self.assertTrue(searxng_cap_drop_active(config))
+        del config["services"]["searxng"]["cap_drop"]
+        self.assertFalse(searxng_cap_drop_active(config))
+
+
+
+class TestTracing(unittest.TestCase):
+    def test_spans_nest_and_export_as_chrome_trace(self):
+        tracer = Tracer()
+        with tracer.span("pull images"):
+            with tracer.span("docker pull", "subprocess", exit_code=0):
+                pass
+        with self.assertRaises(RuntimeError):
+            with tracer.span("start containers"):
+                raise RuntimeError("boom")
+
+        trace = tracer.chrome_trace()
+        events = {event["name"]: event for event in trace["traceEvents"]}
+
+        self.assertEqual(events["pull images"]["ph"], "X")
+        self.assertEqual(events["docker pull"]["args"]["parent_span_id"], events["pull images"]["args"]["span_id"])
+        self.assertIn("boom", events["start containers"]["args"]["error"])
+        self.assertEqual(set(trace["otherData"]["phases_ms"]), {"pull images", "start containers"})
+        summary = "\n".join(tracer.summary_lines())
+        self.assertIn("(failed)", summary)
+        self.assertIn("docker pull", summary)
+
+    def test_run_process_records_exit_code_output_size_and_redacts(self):
+        tracer = Tracer()
+        cmd = ["docker", "login", "--password", "abc123"]
+        with patch("start_services.TRACER", tracer), \
+                patch("start_services.subprocess.run", return_value=completed(cmd, 0, stdout="ok\n", stderr="é")):
+            start_services.run_process(cmd, redact=("abc123",), capture_output=True, text=True)
+
+        attributes = tracer.spans[0]["attributes"]
+        self.assertEqual(attributes["exit_code"], 0)
+        self.assertEqual(attributes["output_bytes"], 5)
+        self.assertNotIn("abc123", attributes["command"])
+
+    def test_command_label_skips_option_values(self):
+        cmd = ["docker", "compose", "-p", "localai", "--profile", "cpu", "-f", "docker-compose.yml", "up", "-d"]
+
+        self.assertEqual(command_label(cmd), "docker compose up")
+        self.assertEqual(command_label(["docker", "pull", "--quiet", "n8n"]), "docker pull n8n")
+
+
+
+class TestSecretTemplating(unittest.TestCase):
+    EXAMPLE = (
+        "N8N_ENCRYPTION_KEY=super-secret-key\n"
+        "JWT_SECRET=your-super-secret-jwt-token-with-at-least-32-characters-long\n"
+        "ANON_KEY=demo\n"
+        "SERVICE_ROLE_KEY=demo\n"
+        "ENCRYPTION_KEY=generate-with-openssl # generate via `openssl rand -hex 32`\n"
+        "POSTGRES_DB=postgres\n"
+    )
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp.name, *parts)
+
+    def write(self, name, content):
+        with open(self.path(name), "w") as file:
+            file.write(content)
+
+    def read(self, name):
+        with open(self.path(name)) as file:
+            return file.read()
+
+    def test_searxng_settings_are_rendered_once_without_subprocesses(self):
+        self.write("settings-base.yml", 'server:\n  secret_key: "ultrasecretkey"\n')
+
+        with patch("start_services.subprocess.run") as run:
+            generate_searxng_secret_key(self.tmp.name)
+            rendered = self.read("settings.yml")
+            before = os.stat(self.path("settings.yml")).st_mtime_ns
+            with patch("start_services.write_text_atomic") as write:
+                generate_searxng_secret_key(self.tmp.name)
+
+        run.assert_not_called()
+        write.assert_not_called()
+        self.assertNotIn("ultrasecretkey", rendered)
+        self.assertRegex(rendered, r'secret_key: "[0-9a-f]{64}"')
+        self.assertEqual(os.stat(self.path("settings.yml")).st_mtime_ns, before)
+
+    def test_missing_env_is_created_from_example_with_generated_secrets(self):
+        self.write(".env.example", self.EXAMPLE)
+
+        filled = render_env_secrets(self.path(".env"), self.path(".env.example"))
+
+        env = dict(line.split("=", 1) for line in self.read(".env").splitlines())
+        self.assertEqual(filled, ["ANON_KEY", "ENCRYPTION_KEY", "JWT_SECRET", "N8N_ENCRYPTION_KEY", "SERVICE_ROLE_KEY"])
+        self.assertRegex(env["N8N_ENCRYPTION_KEY"], r"^[0-9a-f]{64}$")
+        self.assertTrue(env["ENCRYPTION_KEY"].endswith(" # generate via `openssl rand -hex 32`"))
+        self.assertEqual(env["POSTGRES_DB"], "postgres")
+        self.assertEqual(os.stat(self.path(".env")).st_mode & 0o777, 0o600)
+
+        header, payload, _ = env["ANON_KEY"].split(".")
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        self.assertEqual(claims["role"], "anon")
+        issued_at = claims["iat"]
+        self.assertEqual(supabase_jwt(env["JWT_SECRET"], "anon", issued_at), env["ANON_KEY"])
+
+    def test_existing_env_placeholders_are_only_replaced_on_request(self):
+        self.write(".env", self.EXAMPLE)
+
+        self.assertEqual(render_env_secrets(self.path(".env"), self.path("missing")), [])
+        self.assertEqual(self.read(".env"), self.EXAMPLE)
+
+        self.assertIn("JWT_SECRET", render_env_secrets(self.path(".env"), replace_placeholders=True))
+        filled = self.read(".env")
+        self.assertEqual(render_env_secrets(self.path(".env"), replace_placeholders=True), [])
+        self.assertEqual(self.read(".env"), filled)
+
+
+
+class TestResourceSizing(unittest.TestCase):
+    HOST = {"cpus": 9, "memory_bytes": 40 * 1024 ** 3, "gpu": None}
+
+    def test_profile_follows_gpu_devices(self):
+        with tempfile.TemporaryDirectory() as dev:
+            self.assertEqual(choose_profile(detect_host(dev)), "cpu")
+            open(os.path.join(dev, "kfd"), "w").close()
+            self.assertEqual(choose_profile(detect_host(dev)), "gpu-amd")
+            open(os.path.join(dev, "nvidia0"), "w").close()
+            self.assertEqual(choose_profile(detect_host(dev)), "gpu-nvidia")
+
+    def test_budget_is_split_by_weight_after_the_reserve(self):
+        plan = plan_resource_limits(self.HOST, "cpu", {"ollama": 3, "clickhouse": 1})
+
+        self.assertEqual(set(plan), {"ollama-cpu", "clickhouse"})
+        self.assertEqual(plan["ollama-cpu"]["cpus"], 6.0)
+        self.assertEqual(plan["clickhouse"]["cpus"], 2.0)
+        budget = self.HOST["memory_bytes"] * (1 - start_services.RESERVED_MEMORY_FRACTION)
+        self.assertAlmostEqual(plan["ollama-cpu"]["memory_bytes"] / budget, 0.75, places=3)
+        self.assertLessEqual(sum(limits["memory_bytes"] for limits in plan.values()), budget)
+        self.assertNotIn("ollama-cpu", plan_resource_limits(self.HOST, "none", {"ollama": 3, "n8n": 1}))
+
+    def test_weights_spec_overrides_and_drops_services(self):
+        weights = parse_resource_weights("ollama=10, flowise=0")
+
+        self.assertEqual(weights["ollama"], 10)
+        self.assertNotIn("flowise", weights)
+        with self.assertRaises(ValueError):
+            parse_resource_weights("ollama")
+
+    def test_override_carries_limits_and_tuning(self):
+        plan = plan_resource_limits(self.HOST, "cpu")
+
+        override = json.loads(render_limits_override(plan, "cpu").split("\n", 2)[2])["services"]
+
+        self.assertTrue(override["ollama-cpu"]["mem_limit"].endswith("m"))
+        self.assertIn("OLLAMA_NUM_PARALLEL", override["ollama-cpu"]["environment"])
+        self.assertIn("NEO4J_server_memory_heap_max__size", override["neo4j"]["environment"])
+        self.assertIn("config.d/localai-limits.xml", override["clickhouse"]["volumes"][0])
+
+    def test_override_only_applies_to_auto_runs(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            self.addCleanup(os.chdir, cwd)
+            with patch("start_services._limits_override_active", False):
+                with open(start_services.LIMITS_OVERRIDE_FILE, "w") as file:
+                    file.write("{}\n")
+                self.assertNotIn(start_services.LIMITS_OVERRIDE_FILE, start_services.compose_base_command("cpu"))
+
+                profile = start_services.auto_size_stack(host=self.HOST)
+                self.assertIn(start_services.LIMITS_OVERRIDE_FILE, start_services.compose_base_command(profile))
+
+
+
+FAKE_DOCKER = """import os, sys
+if sys.argv[1] == "save":
+    sys.stdout.buffer.write(("layers of " + " ".join(sys.argv[2:])).encode() * 1000)
+elif sys.argv[1] == "load":
+    with open(os.environ["FAKE_DOCKER_LOADED"], "wb") as file:
+        file.write(sys.stdin.buffer.read())
+    print("Loaded image")
+"""
+
+
+class TestImageBundles(unittest.TestCase):
+    CONFIG = {"services": {"n8n": {"image": "n8nio/n8n:latest"}, "db": {"image": "postgres:16"}}}
+    IDS = {"n8nio/n8n:latest": "sha256:aaa", "postgres:16": "sha256:bbb"}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        bin_dir = os.path.join(self.tmp.name, "bin")
+        os.mkdir(bin_dir)
+        docker = os.path.join(bin_dir, "docker")
+        with open(docker, "w") as file:
+            file.write(f"#!{sys.executable}\n{FAKE_DOCKER}")
+        os.chmod(docker, 0o755)
+        self.loaded = os.path.join(self.tmp.name, "loaded.tar")
+        environ = {"PATH": bin_dir + os.pathsep + os.environ["PATH"], "FAKE_DOCKER_LOADED": self.loaded}
+        for patcher in (
+            patch.dict(os.environ, environ),
+            patch("start_services.load_compose_config", return_value=self.CONFIG),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.bundle = os.path.join(self.tmp.name, "bundle")
+
+    def export(self):
+        with patch("start_services.local_image_ids", return_value=self.IDS):
+            return export_images(self.bundle, "cpu", "private")
+
+    def test_export_writes_one_compressed_archive_with_manifest(self):
+        manifest = self.export()
+
+        archive = os.path.join(self.bundle, "images.tar.gz")
+        with open(archive, "rb") as file:
+            data = file.read()
+        self.assertEqual(manifest["archive"]["sha256"], hashlib.sha256(data).hexdigest())
+        self.assertEqual(gzip.decompress(data), b"layers of n8nio/n8n:latest postgres:16" * 1000)
+        self.assertLess(len(data), manifest["archive"]["uncompressed_bytes"])
+        self.assertEqual([entry["id"] for entry in manifest["images"]], ["sha256:aaa", "sha256:bbb"])
+
+        with patch("start_services.subprocess.Popen") as popen:
+            self.assertEqual(self.export(), manifest)
+        popen.assert_not_called()
+
+    def test_import_streams_archive_into_docker_load(self):
+        self.export()
+
+        with patch("start_services.local_image_ids", side_effect=[{}, self.IDS]):
+            self.assertTrue(import_images(self.bundle))
+        with open(self.loaded, "rb") as file:
+            self.assertEqual(file.read(), b"layers of n8nio/n8n:latest postgres:16" * 1000)
+
+        with patch("start_services.local_image_ids", return_value=self.IDS), \
+                patch("start_services.subprocess.Popen") as popen:
+            self.assertTrue(import_images(self.bundle))
+        popen.assert_not_called()
+
+    def test_import_rejects_archive_that_does_not_match_manifest(self):
+        self.export()
+        with open(os.path.join(self.bundle, "images.tar.gz"), "ab") as file:
+            file.write(b"tampered")
+
+        with patch("start_services.local_image_ids", return_value={}), \
+                patch("start_services.subprocess.Popen") as popen:
+            self.assertFalse(import_images(self.bundle))
+        popen.assert_not_called()
+
+
+
+class _FakeAutomationHandler(BaseHTTPRequestHandler):
+    """In-memory stand-in for the n8n public API and the Flowise API."""
+
+    store = {}
+    writes = []
+    lock = threading.Lock()
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _collection(self):
+        path = self.path.split("?", 1)[0]
+        base, _, item_id = path.rpartition("/")
+        if base in self.store:
+            return base, item_id
+        return path, None
+
+    def do_GET(self):
+        collection, _ = self._collection()
+        if collection.startswith("/n8n"):
+            if self.headers.get("X-N8N-API-KEY") != "n8n-key":
+                self._reply(401, {"message": "unauthorized"})
+                return
+            self._reply(200, {"data": list(self.store[collection].values()), "nextCursor": None})
+        else:
+            self._reply(200, list(self.store[collection].values()))
+
+    def _write(self, method):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        collection, item_id = self._collection()
+        with self.lock:
+            type(self).writes.append((method, collection, payload["name"]))
+            item_id = item_id or f"id-{len(self.writes)}"
+            self.store[collection][item_id] = {**payload, "id": item_id}
+        time.sleep(0.02)
+        self._reply(200, self.store[collection][item_id])
+
+    def do_POST(self):
+        self._write("POST")
+
+    def do_PUT(self):
+        self._write("PUT")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProvisioning(unittest.TestCase):
+    def setUp(self):
+        _FakeAutomationHandler.store = {
+            "/n8n/api/v1/workflows": {},
+            "/flowise/api/v1/chatflows": {"hand-made": {"id": "hand-made", "name": "Existing Flow", "flowData": "{}"}},
+            "/flowise/api/v1/tools": {},
+        }
+        _FakeAutomationHandler.writes = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeAutomationHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.urls = {"n8n": f"{url}/n8n", "flowise": f"{url}/flowise"}
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        self.state = os.path.join(self.root, "state.json")
+        self.write("n8n/backup/workflows/a.json", {"name": "Agent", "nodes": [], "connections": {}, "id": "x", "active": True})
+        self.write("n8n-tool-workflows/b.json", {"name": "Tool", "nodes": [], "connections": {}, "settings": {}})
+        self.write("flowise/Existing Flow.json", {"nodes": [], "edges": []})
+        self.write("flowise/New Flow.json", {"nodes": [{"id": "n1"}], "edges": []})
+        self.write("flowise/search-CustomTool.json", {"name": "search", "description": "d", "func": "return 1"})
+        with open(os.path.join(self.root, ".env"), "w") as file:
+            file.write("N8N_API_KEY=n8n-key\n")
+
+    def write(self, relative_path, data):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(data, file)
+
+    def provision(self, **kwargs):
+        return provision_services(self.urls, parallelism=3, state_path=self.state, root=self.root,
+                                  env_path=os.path.join(self.root, ".env"), ready_timeout=0, **kwargs)
+
+    def test_first_run_creates_missing_items_concurrently_and_redeploys_are_no_ops(self):
+        plan = self.provision()
+
+        self.assertEqual({step["item"]["name"]: step["action"] for step in plan},
+                         {"Agent": "create", "Tool": "create", "Existing Flow": "exists",
+                          "New Flow": "create", "search": "create"})
+        self.assertEqual(sorted(name for _, _, name in _FakeAutomationHandler.writes),
+                         ["Agent", "New Flow", "Tool", "search"])
+        agent = next(w for w in _FakeAutomationHandler.store["/n8n/api/v1/workflows"].values() if w["name"] == "Agent")
+        self.assertEqual(set(agent), {"id", "name", "nodes", "connections", "settings"})
+
+        _FakeAutomationHandler.writes = []
+        plan = self.provision()
+
+        self.assertEqual(_FakeAutomationHandler.writes, [])
+        self.assertEqual({step["action"] for step in plan}, {"unchanged"})
+
+    def test_changed_export_updates_in_place(self):
+        self.provision()
+        _FakeAutomationHandler.writes = []
+        self.write("n8n-tool-workflows/b.json", {"name": "Tool", "nodes": [{"id": "new"}], "connections": {}})
+
+        self.provision()
+
+        self.assertEqual(_FakeAutomationHandler.writes, [("PUT", "/n8n/api/v1/workflows", "Tool")])
+        self.assertEqual(len(_FakeAutomationHandler.store["/n8n/api/v1/workflows"]), 2)
+
+    def test_dry_run_prints_diff_without_writing(self):
+        with patch("builtins.print") as printed:
+            plan = self.provision(dry_run=True)
+
+        output = "\n".join(" ".join(map(str, call.args)) for call in printed.call_args_list)
+        self.assertEqual(_FakeAutomationHandler.writes, [])
+        self.assertFalse(os.path.exists(self.state))
+        self.assertIn("+ n8n workflow 'Agent' (create)", output)
+        self.assertIn('+  "name": "Agent",', output)
+        self.assertEqual(len(plan), 5)
+
+    def test_n8n_is_skipped_without_api_key(self):
+        os.unlink(os.path.join(self.root, ".env"))
+
+        with patch.dict(os.environ, {"N8N_API_KEY": ""}):
+            plan = self.provision()
+
+        self.assertEqual({step["item"]["service"] for step in plan}, {"flowise"})
+
+
+
+class TestCaddyfileRendering(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "Caddyfile")
+
+    def test_committed_caddyfile_is_the_private_rendering(self):
+        repo_caddyfile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Caddyfile")
+        with open(repo_caddyfile) as file:
+            self.assertEqual(file.read(), render_caddyfile("private"))
+
+    def test_streaming_sites_are_unbuffered_and_profiles_differ(self):
+        private, public = render_caddyfile("private"), render_caddyfile("public")
+
+        webui = private.split("{$WEBUI_HOSTNAME} {", 1)[1].split("\n}\n", 1)[0]
+        self.assertIn("flush_interval -1", webui)
+        self.assertIn("import compress", webui)
+        self.assertNotIn("flush_interval", private.split("{$NEO4J_HOSTNAME} {", 1)[1].split("\n}\n", 1)[0])
+        self.assertNotIn("event-stream", private)
+        self.assertIn("gzip 1", private)
+        self.assertIn("gzip 5", public)
+        self.assertIn("keepalive_idle_conns 64", public)
+
+    def test_invalid_rendering_is_not_written(self):
+        with open(self.path, "w") as file:
+            file.write("old")
+
+        with patch("start_services.validate_caddyfile", return_value=(False, "Error: bad directive")):
+            self.assertFalse(render_caddyfile_for("public", self.path))
+
+        with open(self.path) as file:
+            self.assertEqual(file.read(), "old")
+
+    def test_rendering_rewrites_in_place_and_only_when_changed(self):
+        with open(self.path, "w") as file:
+            file.write("old")
+        inode = os.stat(self.path).st_ino
+
+        with patch("start_services.validate_caddyfile", return_value=(True, "Valid configuration")) as validate:
+            self.assertTrue(render_caddyfile_for("public", self.path))
+            self.assertFalse(render_caddyfile_for("public", self.path))
+
+        self.assertEqual(validate.call_count, 1)
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+    def test_docker_validation_mounts_the_file_like_compose(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        calls = []
+
+        def run(cmd, **kwargs):
+            mount = cmd[cmd.index("-v") + 1].rsplit(":", 2)[0]
+            calls.append((cmd, os.path.isfile(mount)))
+            return completed(cmd, returncode=125, stderr="mount error")
+
+        with patch("start_services.shutil.which", side_effect=lambda name: name if name == "docker" else None), \
+                patch("start_services.subprocess.run", side_effect=run):
+            valid, output = start_services.validate_caddyfile("{\n}\n")
+
+        cmd, mounted_file = calls[0]
+        volumes = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-v"]
+        self.assertTrue(volumes[0].endswith("/Caddyfile:/etc/caddy/Caddyfile:ro"))
+        self.assertEqual(volumes[1], os.path.join(self.tmp.name, "caddy-addon") + ":/etc/caddy/addons:ro")
+        self.assertTrue(mounted_file)
+        self.assertIs(valid, False)
+        self.assertIn("mount error", output)
+
+
 if __name__ == "__main__":
     unittest.main()